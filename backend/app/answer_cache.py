@@ -0,0 +1,140 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.config import settings
+from app.db import fetch_row_fingerprints
+from app.logger import setup_logger
+from app.semantic_cache import SemanticCache
+
+logger = setup_logger(__name__)
+
+def normalize_query(text: str) -> str:
+    """Lowercase, NFC, gộp khoảng trắng ("Mã  BOM X1?" == "mã bom x1?")"""
+    text = unicodedata.normalize("NFC", text or "").lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+# ================================================================================================
+# ANSWER CACHE (exact / semantic lookup, validated against the evidence rows)
+# ================================================================================================
+
+class AnswerCache:
+    """
+    Cache câu trả lời /api/query.
+    - entry gắn với: tham số truy vấn (top_k, min_score), các bảng đã chọn, và fingerprint
+      (md5 nội dung, app.db.row_fingerprint) của các dòng đã dùng làm context
+    - tra exact theo câu hỏi đã chuẩn hoá (không cần embed), rồi theo embedding câu hỏi
+      (cosine >= threshold, cùng bảng và tham số)
+    - trước khi trả về, kiểm tra lại fingerprint các dòng bằng 1 query theo khoá chính mỗi bảng;
+      dòng bị sửa / xoá thì entry bị xoá (invalidate)
+    """
+
+    def __init__(self, threshold: float, max_entries: int, ttl_seconds: float):
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._semantic = SemanticCache("answers", threshold, max_entries, ttl_seconds)
+        self._exact: "OrderedDict[Tuple[str, int, float], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "stale": 0, "stored": 0}
+
+    @staticmethod
+    def _params(top_k: int, min_score: float) -> Tuple[int, float]:
+        return int(top_k), round(float(min_score), 4)
+
+    def _is_fresh(self, entry: Dict[str, Any]) -> bool:
+        if self.ttl_seconds > 0 and time.time() - entry["created_at"] > self.ttl_seconds:
+            return False
+        try:
+            current = fetch_row_fingerprints(list(entry["evidence"].keys()))
+        except Exception as e:
+            logger.warning("Answer cache validation failed: %s", e)
+            return False
+        return all(current.get(k) == fp for k, fp in entry["evidence"].items())
+
+    def _drop(self, entry: Dict[str, Any]):
+        with self._lock:
+            self._exact.pop(entry["text_key"], None)
+        self._semantic.invalidate(lambda meta: meta.get("entry") is entry)
+        self.stats["stale"] += 1
+
+    def get_exact(self, query_text: str, top_k: int, min_score: float) -> Optional[Dict[str, Any]]:
+        key = (normalize_query(query_text), *self._params(top_k, min_score))
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry is not None:
+                self._exact.move_to_end(key)
+        if entry is None:
+            return None
+        if not self._is_fresh(entry):
+            self._drop(entry)
+            return None
+        self.stats["exact_hits"] += 1
+        return entry
+
+    def get_similar(self, query_vec: Sequence[float], tables: Sequence[Tuple[str, str, float]],
+                    top_k: int, min_score: float) -> Optional[Dict[str, Any]]:
+        table_key = tuple(sorted(f"{s}.{t}" for s, t, _ in tables))
+        params = self._params(top_k, min_score)
+        found = self._semantic.get(
+            query_vec, match=lambda meta: meta["tables"] == table_key and meta["params"] == params
+        )
+        if not found:
+            return None
+        entry, similarity = found
+        if not self._is_fresh(entry):
+            self._drop(entry)
+            return None
+        self.stats["semantic_hits"] += 1
+        logger.info("Answer cache hit (similarity=%.3f)", similarity)
+        return entry
+
+    def put(self, query_text: str, query_vec: Sequence[float], tables: Sequence[Tuple[str, str, float]],
+            top_k: int, min_score: float, answer: str, hits: List[Dict[str, Any]], used_contexts: List[Any]):
+        """Lưu câu trả lời; cần row_fp của từng hit (similarity_search_table tính từ các dòng top-k)"""
+        evidence = {(h["table"], h["id"]): h.get("row_fp") for h in hits}
+        if not evidence or any(fp is None for fp in evidence.values()):
+            return
+        params = self._params(top_k, min_score)
+        text_key = (normalize_query(query_text), *params)
+        table_key = tuple(sorted(f"{s}.{t}" for s, t, _ in tables))
+        entry = {
+            "text_key": text_key,
+            "tables": table_key,
+            "answer": answer,
+            "used_contexts": used_contexts,
+            "evidence": evidence,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._exact[text_key] = entry
+            self._exact.move_to_end(text_key)
+            while len(self._exact) > self.max_entries:
+                self._exact.popitem(last=False)
+        self._semantic.put(query_vec, entry, {"tables": table_key, "params": params, "entry": entry})
+        self.stats["stored"] += 1
+
+    def invalidate(self, table: Optional[str] = None) -> int:
+        """Xoá entry dùng bảng `table` ("schema.table"), hoặc toàn bộ nếu None"""
+        def hit(tables: Tuple[str, ...]) -> bool:
+            return table is None or table in tables
+
+        with self._lock:
+            keys = [k for k, e in self._exact.items() if hit(e["tables"])]
+            for k in keys:
+                self._exact.pop(k)
+        removed = self._semantic.invalidate(lambda meta: hit(meta["tables"]))
+        return max(removed, len(keys))
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            exact_entries = len(self._exact)
+        return {**self.stats, "exact_entries": exact_entries, "semantic": self._semantic.metrics()}
+
+answer_cache = AnswerCache(
+    threshold=settings.APP_ANSWER_CACHE_SIMILARITY,
+    max_entries=settings.APP_ANSWER_CACHE_SIZE,
+    ttl_seconds=settings.APP_ANSWER_CACHE_TTL_SECONDS,
+)
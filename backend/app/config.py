@@ -17,15 +17,46 @@ class Settings(BaseSettings):
     # Gemini
     GOOGLE_API_KEY: str = os.getenv("GOOGLE_API_KEY")
     APP_GEMINI_MODEL: str = os.getenv("APP_GEMINI_MODEL", "gemini-2.0-flash")
+    # Adaptive rate limit shared by all Gemini calls (requests/second)
+    APP_GEMINI_RATE_INITIAL: float = float(os.getenv("APP_GEMINI_RATE_INITIAL", "1.0"))
+    APP_GEMINI_RATE_MIN: float = float(os.getenv("APP_GEMINI_RATE_MIN", "0.1"))
+    APP_GEMINI_RATE_MAX: float = float(os.getenv("APP_GEMINI_RATE_MAX", "10.0"))
+    APP_GEMINI_RATE_BURST: int = int(os.getenv("APP_GEMINI_RATE_BURST", "3"))
+    # Cache model đã resolve (list_models) và kết quả health check (giây)
+    APP_GEMINI_MODEL_REFRESH_SECONDS: int = int(os.getenv("APP_GEMINI_MODEL_REFRESH_SECONDS", "3600"))
+    APP_GEMINI_HEALTH_TTL_SECONDS: int = int(os.getenv("APP_GEMINI_HEALTH_TTL_SECONDS", "60"))
 
     # App
     # Pydantic will coerce env strings to the annotated types
     APP_RELOAD: bool = os.getenv("APP_RELOAD", "false") in ["1", "true", "True", "TRUE"]
     APP_TOP_K: int = int(os.getenv("APP_TOP_K", "5"))
     APP_MIN_SCORE: float = float(os.getenv("APP_MIN_SCORE", "0.3"))
+    # Cache metadata bảng embedding (dimension, số dòng, index), nạp lại sau TTL (giây)
+    APP_TABLE_META_TTL_SECONDS: int = int(os.getenv("APP_TABLE_META_TTL_SECONDS", "600"))
+    # Context gửi Gemini: tổng token, token tối đa mỗi dòng, số dòng cache field đã tách
+    APP_CONTEXT_TOKEN_BUDGET: int = int(os.getenv("APP_CONTEXT_TOKEN_BUDGET", "3000"))
+    APP_CONTEXT_ROW_TOKENS: int = int(os.getenv("APP_CONTEXT_ROW_TOKENS", "400"))
+    APP_CONTEXT_CACHE_SIZE: int = int(os.getenv("APP_CONTEXT_CACHE_SIZE", "2048"))
+    # Cache câu trả lời: câu hỏi giống hệt hoặc cosine >= similarity, cùng bảng + cùng dữ liệu
+    APP_ANSWER_CACHE_ENABLED: bool = os.getenv("APP_ANSWER_CACHE_ENABLED", "true") in ["1", "true", "True", "TRUE"]
+    APP_ANSWER_CACHE_SIMILARITY: float = float(os.getenv("APP_ANSWER_CACHE_SIMILARITY", "0.97"))
+    APP_ANSWER_CACHE_SIZE: int = int(os.getenv("APP_ANSWER_CACHE_SIZE", "1024"))
+    APP_ANSWER_CACHE_TTL_SECONDS: int = int(os.getenv("APP_ANSWER_CACHE_TTL_SECONDS", "3600"))
+    # OCR: số process (0 = min(4, số CPU)) và số kết quả cache theo hash ảnh
+    APP_OCR_WORKERS: int = int(os.getenv("APP_OCR_WORKERS", "0"))
+    APP_OCR_CACHE_SIZE: int = int(os.getenv("APP_OCR_CACHE_SIZE", "256"))
     APP_LOG_DIR: str = os.getenv("APP_LOG_DIR", "logs")
 
     APP_TABLE_SCHEMAS_JSON: str = Field(default="")
+    # Router chọn bảng bằng embedding; chỉ hỏi Gemini khi top-1 thấp hoặc cách top-2 < margin
+    APP_TABLE_ROUTER_MIN_SIMILARITY: float = float(os.getenv("APP_TABLE_ROUTER_MIN_SIMILARITY", "0.35"))
+    APP_TABLE_ROUTER_MARGIN: float = float(os.getenv("APP_TABLE_ROUTER_MARGIN", "0.05"))
+    # Cache quyết định của Gemini theo embedding câu hỏi
+    APP_TABLE_ROUTER_CACHE_SIMILARITY: float = float(os.getenv("APP_TABLE_ROUTER_CACHE_SIMILARITY", "0.92"))
+    # Số bảng tối đa truy vấn song song cho 1 câu hỏi; bảng phụ phải cách bảng top <= margin
+    APP_RETRIEVAL_MAX_TABLES: int = int(os.getenv("APP_RETRIEVAL_MAX_TABLES", "3"))
+    APP_RETRIEVAL_TABLE_MARGIN: float = float(os.getenv("APP_RETRIEVAL_TABLE_MARGIN", "0.1"))
+    APP_TABLE_ROUTER_CACHE_SIZE: int = int(os.getenv("APP_TABLE_ROUTER_CACHE_SIZE", "512"))
 
     # model_config = SettingsConfigDict(env_file=".env", case_sensitive=False)
     model_config = SettingsConfigDict(env_file=".env.locally", case_sensitive=False)
@@ -0,0 +1,134 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.config import settings
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Ước lượng token không cần tokenizer: mỗi từ / dấu câu ~ 1 token
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def count_tokens(text: str) -> int:
+    return len(_TOKEN_RE.findall(text))
+
+def _words(text: str) -> Set[str]:
+    return {w for w in _WORD_RE.findall(text.lower()) if len(w) > 1}
+
+def _is_empty(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip()) or value in ([], {})
+
+# ================================================================================================
+# CONTEXT BUILDER (dedupe hits, trim fields by relevance, enforce a token budget)
+# ================================================================================================
+
+class ContextBuilder:
+    """
+    Dựng context cho Gemini từ các hit k-NN:
+    - bỏ hit trùng (cùng bảng#id hoặc cùng nội dung)
+    - mỗi dòng được tách thành các field "key: value" (original_data + dòng content_text chưa có);
+      field liên quan tới câu hỏi được giữ trước, tối đa row_tokens token mỗi dòng
+    - tổng context không vượt quá token_budget; hit điểm cao được ưu tiên
+    Các field đã tách được cache theo bảng#id (LRU), tính lại khi content_text của dòng thay đổi.
+    """
+
+    def __init__(self, token_budget: int, row_tokens: int, cache_size: int = 2048):
+        self.token_budget = token_budget
+        self.row_tokens = row_tokens
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Tuple[Optional[str], List[Tuple[str, int, Set[str]]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _row_fields(self, hit: Dict[str, Any]) -> List[Tuple[str, int, Set[str]]]:
+        """[(field line, token count, words)] của 1 dòng, dùng cache theo bảng#id"""
+        key = f"{hit.get('table')}#{hit.get('id')}"
+        content_text = hit.get("content_text")
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == content_text:
+                self._cache.move_to_end(key)
+                return cached[1]
+
+        original = hit.get("original_data")
+        if isinstance(original, str):
+            try:
+                original = json.loads(original)
+            except ValueError:
+                original = {"original_data": original}
+        lines: List[str] = []
+        if isinstance(original, dict):
+            for k, v in original.items():
+                if _is_empty(v):
+                    continue
+                value = v if isinstance(v, str) else json.dumps(v, ensure_ascii=False, default=str)
+                lines.append(f"{k}: {value.strip()}")
+        seen = {re.sub(r"\s+", " ", line).lower() for line in lines}
+        for line in (content_text or "").split("\n"):
+            norm = re.sub(r"\s+", " ", line).strip().lower()
+            if norm and norm not in seen:
+                seen.add(norm)
+                lines.append(line.strip())
+
+        fields = [(line, count_tokens(line), _words(line)) for line in lines]
+        with self._lock:
+            self._cache[key] = (content_text, fields)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return fields
+
+    def _trim(self, fields: List[Tuple[str, int, Set[str]]], query_words: Set[str], budget: int) -> Tuple[List[str], int]:
+        # Field trùng nhiều từ với câu hỏi được chọn trước, sau đó giữ nguyên thứ tự gốc
+        order = sorted(range(len(fields)), key=lambda i: -len(fields[i][2] & query_words))
+        chosen: List[int] = []
+        used = 0
+        for i in order:
+            if used + fields[i][1] > budget:
+                continue
+            chosen.append(i)
+            used += fields[i][1]
+        return [fields[i][0] for i in sorted(chosen)], used
+
+    def build(self, hits: List[Dict[str, Any]], query_text: str) -> Tuple[List[str], List[Dict[str, Any]]]:
+        """Trả về (context_strings, các hit đã dùng) theo thứ tự điểm giảm dần"""
+        query_words = _words(query_text)
+        ordered = sorted(hits, key=lambda h: h.get("rank_score", h.get("score") or 0.0), reverse=True)
+
+        contexts: List[str] = []
+        used_hits: List[Dict[str, Any]] = []
+        seen_ids: Set[str] = set()
+        seen_bodies: Set[str] = set()
+        remaining = self.token_budget
+        for h in ordered:
+            row_id = f"{h.get('table')}#{h.get('id')}"
+            if row_id in seen_ids:
+                continue
+            fields = self._row_fields(h)
+            body_key = "\n".join(sorted(f[0].lower() for f in fields))
+            if body_key in seen_bodies:
+                continue
+            header = f"[{row_id} score={float(h.get('score') or 0.0):.3f}]"
+            budget = min(self.row_tokens, remaining - count_tokens(header))
+            if budget <= 0:
+                break
+            lines, used = self._trim(fields, query_words, budget)
+            if not lines:
+                continue
+            seen_ids.add(row_id)
+            seen_bodies.add(body_key)
+            contexts.append(header + "\n" + "\n".join(lines))
+            used_hits.append(h)
+            remaining -= used + count_tokens(header)
+
+        logger.info("Built context: %d/%d hits, ~%d tokens", len(used_hits), len(hits), self.token_budget - remaining)
+        return contexts, used_hits
+
+context_builder = ContextBuilder(
+    token_budget=settings.APP_CONTEXT_TOKEN_BUDGET,
+    row_tokens=settings.APP_CONTEXT_ROW_TOKENS,
+    cache_size=settings.APP_CONTEXT_CACHE_SIZE,
+)
@@ -1,5 +1,10 @@
+import hashlib
+import json
 import logging
-from typing import List, Tuple, Dict, Any, Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Any, Optional, Sequence
 
 import psycopg
 from psycopg.rows import dict_row
@@ -31,7 +36,17 @@ def _on_connect(conn):
     except Exception:
         pass
 
-pool = ConnectionPool(conninfo=dsn, open=_on_connect, kwargs={"row_factory": dict_row})
+pool = ConnectionPool(
+    conninfo=dsn,
+    open=_on_connect,
+    kwargs={"row_factory": dict_row},
+    min_size=max(4, settings.APP_RETRIEVAL_MAX_TABLES),
+)
+
+# Truy vấn k-NN song song trên nhiều bảng (mỗi bảng 1 connection từ pool)
+_search_executor = ThreadPoolExecutor(
+    max_workers=max(1, settings.APP_RETRIEVAL_MAX_TABLES), thread_name_prefix="knn"
+)
 
 def health_check_db() -> bool:
     try:
@@ -95,6 +110,79 @@ def get_embedding_dimension(schema: str, table: str) -> Optional[int]:
             logger.warning("Failed to read embedding dimension from %s.%s: %s", schema, table, e)
             return None
 
+# ---- Metadata theo bảng (dimension, số dòng ước lượng, loại index) ----
+_table_meta: Dict[Tuple[str, str], Dict[str, Any]] = {}
+_table_meta_lock = threading.Lock()
+
+def _load_table_meta(schema: str, table: str) -> Dict[str, Any]:
+    """Đọc metadata từ catalog; dimension lấy từ kiểu vector(N), nếu cột không khai báo N thì đọc 1 dòng."""
+    q = """
+    SELECT
+        format_type(a.atttypid, a.atttypmod) AS column_type,
+        CASE WHEN t.typname = 'vector' AND a.atttypmod > 0 THEN a.atttypmod END AS dimension,
+        GREATEST(c.reltuples, 0)::bigint AS row_estimate,
+        (
+            SELECT string_agg(DISTINCT am.amname, ',')
+            FROM pg_index i
+            JOIN pg_class ic ON ic.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = ic.relam
+            WHERE i.indrelid = c.oid AND a.attnum = ANY(i.indkey)
+        ) AS index_type
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attname = 'embedding' AND NOT a.attisdropped
+    JOIN pg_type t ON t.oid = a.atttypid
+    WHERE n.nspname = %s AND c.relname = %s;
+    """
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(q, (schema, table))
+        row = cur.fetchone()
+    meta: Dict[str, Any] = {
+        "column_type": row["column_type"] if row else None,
+        "dimension": row["dimension"] if row else None,
+        "row_estimate": int(row["row_estimate"]) if row else 0,
+        "index_type": row["index_type"] if row else None,
+        "loaded_at": time.time(),
+    }
+    if row and meta["dimension"] is None:
+        meta["dimension"] = get_embedding_dimension(schema, table)
+    return meta
+
+def get_table_meta(schema: str, table: str) -> Dict[str, Any]:
+    """Metadata bảng embedding từ cache; nạp lại khi hết APP_TABLE_META_TTL_SECONDS hoặc đã bị invalidate."""
+    key = (schema, table)
+    with _table_meta_lock:
+        meta = _table_meta.get(key)
+    if meta is not None and time.time() - meta["loaded_at"] < settings.APP_TABLE_META_TTL_SECONDS:
+        return meta
+    try:
+        meta = _load_table_meta(schema, table)
+    except Exception as e:
+        logger.warning("Failed to load table metadata for %s.%s: %s", schema, table, e)
+        return meta or {"dimension": None, "row_estimate": 0, "index_type": None, "column_type": None, "loaded_at": 0.0}
+    with _table_meta_lock:
+        _table_meta[key] = meta
+    return meta
+
+def invalidate_table_meta(schema: Optional[str] = None, table: Optional[str] = None):
+    """Xoá cache metadata (một bảng hoặc toàn bộ), gọi khi schema bảng thay đổi."""
+    with _table_meta_lock:
+        if schema is None or table is None:
+            _table_meta.clear()
+        else:
+            _table_meta.pop((schema, table), None)
+
+def warm_table_meta_cache() -> Dict[str, Dict[str, Any]]:
+    """Nạp metadata cho mọi bảng có cột embedding (gọi lúc startup)."""
+    invalidate_table_meta()
+    loaded: Dict[str, Dict[str, Any]] = {}
+    for schema, table in list_embedding_tables():
+        meta = get_table_meta(schema, table)
+        loaded[f"{schema}.{table}"] = meta
+        logger.info("Table %s.%s: dim=%s rows~%s index=%s", schema, table,
+                    meta["dimension"], meta["row_estimate"], meta["index_type"])
+    return loaded
+
 def _ensure_list(vec) -> List[float]:
     """
     Convert to list[float] and ensure no set sneaks in.
@@ -117,18 +205,45 @@ def _align_vector_dim(vec: List[float], target_dim: Optional[int]) -> List[float
         return vec[:target_dim]
     return vec + [0.0] * (target_dim - len(vec))
 
-def _table_topk(schema: str, table: str, query_text: str, top_k: int) -> List[Dict[str, Any]]:
+def row_fingerprint(content_text: Optional[str], original_data: Any) -> str:
     """
-    Embed text with the configured model, align dimension to table, and query top-k using pgvector operators.
+    Fingerprint nội dung 1 dòng, dùng để biết dòng đã đổi (vd. cache câu trả lời).
+    Tính trong Python trên các dòng top-k đã trả về, không để k-NN query md5 toàn bảng.
+    """
+    data = "" if original_data is None else json.dumps(original_data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(((content_text or "") + "\x00" + data).encode("utf-8")).hexdigest()
+
+def fetch_row_fingerprints(rows: Sequence[Tuple[str, Any]]) -> Dict[Tuple[str, Any], str]:
+    """{("schema.table", id): fingerprint} cho các dòng còn tồn tại, 1 query theo khoá chính mỗi bảng"""
+    by_table: Dict[str, List[Any]] = {}
+    for full_name, row_id in rows:
+        by_table.setdefault(full_name, []).append(row_id)
+    out: Dict[Tuple[str, Any], str] = {}
+    with pool.connection() as conn, conn.cursor() as cur:
+        for full_name, ids in by_table.items():
+            schema, table = full_name.split(".", 1)
+            cur.execute(
+                f'SELECT id, content_text, original_data FROM "{schema}"."{table}" WHERE id = ANY(%s);',
+                (ids,),
+            )
+            for r in cur.fetchall():
+                out[(full_name, r["id"])] = row_fingerprint(r["content_text"], r["original_data"])
+    return out
+
+def _table_topk(schema: str, table: str, query_text: str, top_k: int,
+                query_vec: Optional[List[float]] = None) -> List[Dict[str, Any]]:
+    """
+    Embed text with the configured model (unless query_vec is given), align dimension to table,
+    and query top-k using pgvector operators.
     """
     # 1) Embed via Ollama
-    q_vec_raw = embedding_service.embed(query_text)
+    q_vec_raw = query_vec if query_vec is not None else embedding_service.embed(query_text)
     q_vec = _ensure_list(q_vec_raw)
 
-    # 2) Align to table dimension if known
-    dim = get_embedding_dimension(schema, table)
+    # 2) Align to table dimension if known (cached metadata, no per-query lookup)
+    dim = get_table_meta(schema, table)["dimension"]
     q_vec = _align_vector_dim(q_vec, dim)
-    if dim is not None:
+    if dim is not None and dim != len(q_vec_raw):
         logger.info("Embedding model '%s': query dim=%d, aligned to table %s.%s dim=%d",
                     settings.APP_EMBEDDING_MODEL, len(q_vec_raw), schema, table, dim)
 
@@ -140,7 +255,7 @@ def _table_topk(schema: str, table: str, query_text: str, top_k: int) -> List[Di
             # Cosine distance
             sql = f'''
                 SELECT 
-                    id, original_data, content_text, 
+                    id, original_data, content_text,
                     (1 - (embedding::vector <=> %s::vector))::double precision AS score
                 FROM "{schema}"."{table}"
                 WHERE embedding IS NOT NULL
@@ -151,6 +266,8 @@ def _table_topk(schema: str, table: str, query_text: str, top_k: int) -> List[Di
             return cur.fetchall()
         except Exception as e:
             logger.warning("Cosine query failed on %s.%s: %s. Falling back to Euclidean.", schema, table, e)
+            # Có thể schema bảng đã đổi (vd. dimension) -> nạp lại metadata ở lần sau
+            invalidate_table_meta(schema, table)
             try:
                 conn.rollback()
             except Exception:
@@ -159,7 +276,7 @@ def _table_topk(schema: str, table: str, query_text: str, top_k: int) -> List[Di
             # Euclidean distance (correct operator <->)
             sql = f'''
                 SELECT 
-                    id, original_data, content_text, 
+                    id, original_data, content_text,
                     (1.0 / (1.0 + (embedding::vector <-> %s::vector)))::double precision AS score
                 FROM "{schema}"."{table}"
                 WHERE embedding IS NOT NULL
@@ -169,12 +286,60 @@ def _table_topk(schema: str, table: str, query_text: str, top_k: int) -> List[Di
             cur.execute(sql, (param_vec, param_vec, top_k))
             return cur.fetchall()
 
-def similarity_search_table(schema: str, table: str, query_text: str, top_k: int, min_score: float) -> List[Dict[str, Any]]:
-    rows = _table_topk(schema, table, query_text, top_k)
+def similarity_search_table(schema: str, table: str, query_text: str, top_k: int, min_score: float,
+                            query_vec: Optional[List[float]] = None) -> List[Dict[str, Any]]:
+    rows = _table_topk(schema, table, query_text, top_k, query_vec=query_vec)
     out: List[Dict[str, Any]] = []
     for r in rows:
         r_out = dict(r)
         r_out["table"] = f"{schema}.{table}"
+        r_out["row_fp"] = row_fingerprint(r_out.get("content_text"), r_out.get("original_data"))
         out.append(r_out)
     out.sort(key=lambda x: x.get("score", 0.0), reverse=True)
-    return [r for r in out if (r.get("score") or 0.0) >= min_score]
\ No newline at end of file
+    return [r for r in out if (r.get("score") or 0.0) >= min_score]
+
+def similarity_search_tables(
+    tables: Sequence[Tuple[str, str, float]],
+    query_text: str,
+    top_k: int,
+    min_score: float,
+    query_vec: Optional[List[float]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Truy vấn k-NN song song trên nhiều bảng [(schema, table, table_score)] với cùng 1 query embedding,
+    rồi gộp top-k chung.
+
+    Điểm xếp hạng (rank_score) = score của dòng * table_score / table_score lớn nhất, để bảng được
+    router đánh giá thấp hơn không lấn át bảng chính. Bảng lỗi được bỏ qua (log warning).
+    """
+    if not tables:
+        return []
+    if query_vec is None:
+        query_vec = embedding_service.embed(query_text)
+    if len(tables) == 1:
+        schema, table, _ = tables[0]
+        hits = similarity_search_table(schema, table, query_text, top_k, min_score, query_vec=query_vec)
+        for h in hits:
+            h["rank_score"] = float(h.get("score") or 0.0)
+        return hits
+
+    futures = {
+        (schema, table, table_score): _search_executor.submit(
+            similarity_search_table, schema, table, query_text, top_k, min_score, query_vec
+        )
+        for schema, table, table_score in tables
+    }
+    best_table_score = max((t[2] for t in tables), default=0.0) or 1.0
+    merged: List[Dict[str, Any]] = []
+    for (schema, table, table_score), fut in futures.items():
+        try:
+            hits = fut.result()
+        except Exception as e:
+            logger.warning("Similarity search failed on %s.%s: %s", schema, table, e)
+            continue
+        weight = max(0.0, float(table_score)) / best_table_score
+        for h in hits:
+            h["rank_score"] = float(h.get("score") or 0.0) * weight
+            merged.append(h)
+    merged.sort(key=lambda x: x["rank_score"], reverse=True)
+    return merged[:top_k]
@@ -1,3 +1,4 @@
+import math
 import requests
 from typing import List
 from app.config import settings
@@ -28,6 +29,9 @@ class EmbeddingService:
         emb = data.get("embedding")
         if emb is None or not isinstance(emb, list):
             raise RuntimeError(f"Unexpected Ollama response: {data}")
-        return emb
+        # /api/embeddings trả vector chưa chuẩn hoá; vector build (/api/embed) đã chuẩn hoá L2,
+        # chuẩn hoá query để khoảng cách Euclid (fallback) cùng thang đo với dữ liệu
+        norm = math.sqrt(sum(x * x for x in emb))
+        return [x / norm for x in emb] if norm > 0 else emb
 
 embedding_service = EmbeddingService()
\ No newline at end of file
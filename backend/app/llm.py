@@ -1,37 +1,83 @@
-from typing import List, Optional
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
 import google.generativeai as genai
 from PIL.Image import Image as PILImage
 from app.config import settings
+from app.rate_limiter import call_with_limiter, gemini_limiter
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
 
 # Configure once
 if settings.GOOGLE_API_KEY:
     genai.configure(api_key=settings.GOOGLE_API_KEY)
 
+# Model đã resolve + client GenerativeModel dùng lại giữa các request
+_resolved_model: Dict[str, object] = {"name": None, "resolved_at": 0.0}
+_models: Dict[str, genai.GenerativeModel] = {}
+_health: Dict[str, object] = {"ok": False, "checked_at": 0.0}
+_lock = threading.Lock()
+
+def get_supported_model(force_refresh: bool = False) -> Optional[str]:
+    """Model hỗ trợ generateContent, resolve lại sau mỗi APP_GEMINI_MODEL_REFRESH_SECONDS."""
+    now = time.monotonic()
+    with _lock:
+        name = _resolved_model["name"]
+        fresh = now - float(_resolved_model["resolved_at"]) < settings.APP_GEMINI_MODEL_REFRESH_SECONDS
+        if name and fresh and not force_refresh:
+            return name
+    name = _resolve_supported_model()
+    with _lock:
+        if name:
+            if name != _resolved_model["name"]:
+                logger.info("Resolved Gemini model: %s", name)
+            _resolved_model["name"] = name
+            _resolved_model["resolved_at"] = now
+        elif _resolved_model["name"]:
+            # Lỗi tạm thời khi list models: giữ model cũ
+            name = _resolved_model["name"]
+    return name
+
+def get_generative_model(name: str) -> genai.GenerativeModel:
+    with _lock:
+        model = _models.get(name)
+        if model is None:
+            model = genai.GenerativeModel(name)
+            _models[name] = model
+        return model
+
 def health_check_gemini() -> bool:
+    """Probe nhẹ (đọc metadata model, không generate), cache APP_GEMINI_HEALTH_TTL_SECONDS giây."""
+    now = time.monotonic()
+    with _lock:
+        if now - float(_health["checked_at"]) < settings.APP_GEMINI_HEALTH_TTL_SECONDS:
+            return bool(_health["ok"])
     try:
-        m = _resolve_supported_model()
-        if not m:
-            return False
-        model = genai.GenerativeModel(m)
-        _ = model.generate_content("ping", generation_config={"max_output_tokens": 1})
-        return True
-    except Exception:
-        return False
+        m = get_supported_model()
+        ok = bool(m) and genai.get_model(m if m.startswith("models/") else f"models/{m}") is not None
+    except Exception as e:
+        logger.warning("Gemini health check failed: %s", e)
+        ok = False
+    with _lock:
+        _health["ok"] = ok
+        _health["checked_at"] = now
+    return ok
+
+def warm_up_gemini():
+    """Gọi lúc startup: resolve model và tạo sẵn client."""
+    if not settings.GOOGLE_API_KEY:
+        return
+    m = get_supported_model(force_refresh=True)
+    if m:
+        get_generative_model(m)
 
 SYSTEM_PROMPT = (
     "Bạn là trợ lý AI cho hệ thống RAG. Trả lời ngắn gọn, đúng trọng tâm, bằng tiếng Việt khi có thể. "
     "Chỉ dựa vào CONTEXT cung cấp; nếu thiếu thông tin thì nói rõ là không chắc chắn."
 )
 
-def generate_answer(
-    user_query: str,
-    contexts: List[str],
-    images: Optional[List[PILImage]] = None,
-) -> str:
-    """
-    Gọi Gemini để sinh câu trả lời, truyền cả ảnh (nếu có).
-    """
-    print(f"Generating answer with Gemini: ")
+def _build_parts(user_query: str, contexts: List[str], images: Optional[List[PILImage]] = None) -> List:
     parts: List = [SYSTEM_PROMPT]
     if contexts:
         ctx_joined = "\n\n---- CONTEXT ----\n" + "\n\n".join(contexts) + "\n-----------------\n"
@@ -41,14 +87,26 @@ def generate_answer(
     if images:
         # Append images to multimodal prompt
         parts.extend(images)
+    return parts
+
+def generate_answer(
+    user_query: str,
+    contexts: List[str],
+    images: Optional[List[PILImage]] = None,
+) -> str:
+    """
+    Gọi Gemini để sinh câu trả lời, truyền cả ảnh (nếu có).
+    """
+    print(f"Generating answer with Gemini: ")
+    parts = _build_parts(user_query, contexts, images)
 
     # Resolve a model that supports generateContent for the current API
-    m = _resolve_supported_model()
+    m = get_supported_model()
     if not m:
         return "Xin lỗi, không tìm thấy model Gemini hỗ trợ generateContent trong API hiện tại. Vui lòng kiểm tra API key và quyền truy cập."
     try:
-        model = genai.GenerativeModel(m)
-        resp = model.generate_content(parts, safety_settings=None)
+        model = get_generative_model(m)
+        resp = call_with_limiter(gemini_limiter, lambda: model.generate_content(parts, safety_settings=None))
         text = (getattr(resp, "text", None) or "").strip()
         print(f"Gemini response text (model={m}): {text}")
         if text:
@@ -57,11 +115,52 @@ def generate_answer(
         return "Xin lỗi, lỗi gọi Gemini generateContent với model '" + m + "': " + str(e)
     return "Xin lỗi, tôi chưa thể trả lời câu hỏi này."
 
+def stream_answer(
+    user_query: str,
+    contexts: List[str],
+    images: Optional[List[PILImage]] = None,
+) -> Iterator[str]:
+    """
+    Như generate_answer nhưng yield từng phần text theo stream của Gemini.
+    Lỗi trước khi có text được trả về dưới dạng 1 đoạn "Xin lỗi, ..." giống generate_answer;
+    lỗi giữa chừng được raise lại.
+    """
+    parts = _build_parts(user_query, contexts, images)
+    m = get_supported_model()
+    if not m:
+        yield "Xin lỗi, không tìm thấy model Gemini hỗ trợ generateContent trong API hiện tại. Vui lòng kiểm tra API key và quyền truy cập."
+        return
+    produced = False
+    try:
+        model = get_generative_model(m)
+        # Rate limiter chỉ áp dụng cho lần mở stream
+        resp = call_with_limiter(
+            gemini_limiter, lambda: model.generate_content(parts, safety_settings=None, stream=True)
+        )
+        for chunk in resp:
+            try:
+                text = chunk.text
+            except Exception:
+                # chunk không có text (vd. bị chặn bởi safety)
+                continue
+            if text:
+                produced = True
+                yield text
+    except Exception as e:
+        logger.warning("Gemini streaming failed (model=%s): %s", m, e)
+        if produced:
+            # Đã gửi một phần câu trả lời: để caller báo lỗi thay vì nối thêm text lỗi
+            raise
+        yield "Xin lỗi, lỗi gọi Gemini generateContent với model '" + m + "': " + str(e)
+        return
+    if not produced:
+        yield "Xin lỗi, tôi chưa thể trả lời câu hỏi này."
+
 def _resolve_supported_model() -> Optional[str]:
     """Pick a model that supports generateContent from the account's available models.
     Preference order: env-configured model, then any 'flash' model, then any 'pro' model.
     """
-    print(f"Resolving supported model: ")
+    logger.info("Resolving supported Gemini model via list_models")
     try:
         # List models available to the API key
         ms = genai.list_models()
@@ -78,6 +78,25 @@ except Exception as e:
     # Fail fast so the stack trace is printed clearly
     raise
 
+@app.on_event("startup")
+def warm_up_caches():
+    # Resolve Gemini model một lần lúc khởi động thay vì mỗi request
+    try:
+        from app.llm import warm_up_gemini
+        warm_up_gemini()
+    except Exception as e:
+        logger.warning("Gemini warm-up failed: %s", e)
+    try:
+        from app.db import warm_table_meta_cache
+        warm_table_meta_cache()
+    except Exception as e:
+        logger.warning("Table metadata warm-up failed: %s", e)
+    try:
+        from app.table_selector_llm import selector
+        selector.warm_up()
+    except Exception as e:
+        logger.warning("Table router warm-up failed: %s", e)
+
 if __name__ == "__main__":
     uvicorn.run(
         "app.main:app",
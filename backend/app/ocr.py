@@ -1,24 +1,116 @@
-from typing import List
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
 from PIL import Image
 import pytesseract
 from io import BytesIO
 
+from app.config import settings
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+OCR_LANG = "eng+vie"
+
+# Cache kết quả OCR theo hash ảnh (LRU)
+_cache: "OrderedDict[str, str]" = OrderedDict()
+_cache_lock = threading.Lock()
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def _init_worker():
+    # Mỗi process chạy 1 ảnh; tránh tesseract tự mở thêm thread OpenMP
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+def _ocr_one(img: Image.Image) -> str:
+    try:
+        return (pytesseract.image_to_string(img, lang=OCR_LANG) or "").strip()
+    except Exception:
+        # skip bad image
+        return ""
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = settings.APP_OCR_WORKERS or min(4, os.cpu_count() or 1)
+            _executor = ProcessPoolExecutor(max_workers=max(1, workers), initializer=_init_worker)
+        return _executor
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+def image_cache_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def _cache_get(key: str) -> Optional[str]:
+    with _cache_lock:
+        text = _cache.get(key)
+        if text is not None:
+            _cache.move_to_end(key)
+        return text
+
+def _cache_put(key: str, text: str):
+    if settings.APP_OCR_CACHE_SIZE <= 0:
+        return
+    with _cache_lock:
+        _cache[key] = text
+        _cache.move_to_end(key)
+        while len(_cache) > settings.APP_OCR_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def ocr_images(images: List[Image.Image], cache_keys: Optional[List[str]] = None) -> List[str]:
+    """
+    OCR nhiều ảnh PIL song song (process pool), dùng cache theo hash ảnh.
+    cache_keys: hash của dữ liệu ảnh gốc (nếu đã có), mặc định hash pixel của ảnh.
+    Trả về text theo đúng thứ tự ảnh ("" nếu ảnh lỗi / không có chữ).
+    """
+    keys = cache_keys or [
+        image_cache_key(img.mode.encode() + str(img.size).encode() + img.tobytes()) for img in images
+    ]
+    results: List[Optional[str]] = [_cache_get(k) for k in keys]
+    pending = [i for i, r in enumerate(results) if r is None]
+    if not pending:
+        return [r or "" for r in results]
+
+    if len(pending) == 1:
+        texts = [_ocr_one(images[pending[0]])]
+    else:
+        try:
+            texts = list(_get_executor().map(_ocr_one, [images[i] for i in pending]))
+        except BrokenProcessPool:
+            logger.warning("OCR process pool broken, recreating and running inline for this request")
+            _reset_executor()
+            texts = [_ocr_one(images[i]) for i in pending]
+
+    for i, text in zip(pending, texts):
+        results[i] = text
+        _cache_put(keys[i], text)
+    return [r or "" for r in results]
+
 def ocr_images_to_text(images_bytes: List[bytes]) -> str:
-    texts: List[str] = []
+    images: List[Image.Image] = []
+    keys: List[str] = []
     for b in images_bytes:
         try:
-            img = Image.open(BytesIO(b)).convert("RGB")
-            txt = pytesseract.image_to_string(img, lang="eng+vie")
-            if txt:
-                texts.append(txt.strip())
+            images.append(Image.open(BytesIO(b)).convert("RGB"))
+            keys.append(image_cache_key(b))
         except Exception:
             # skip bad image
             continue
-    return "\n\n".join([t for t in texts if t])
+    return "\n\n".join([t for t in ocr_images(images, keys) if t])
 
 def health_check_ocr() -> bool:
     try:
         _ = pytesseract.get_tesseract_version()
         return True
     except Exception:
-        return False
\ No newline at end of file
+        return False
@@ -0,0 +1,136 @@
+import threading
+import time
+from typing import Callable, Dict, Optional, TypeVar
+
+from app.config import settings
+from .logger import setup_logger
+
+logger = setup_logger(__name__)
+
+T = TypeVar("T")
+
+# ================================================================================================
+# ADAPTIVE RATE LIMITER (token bucket + AIMD)
+# ================================================================================================
+# backend/app, service-chatbot-main/chatapi and service-convert-data-main are deployed separately,
+# so each ships its own copy of this class. Keep the three class bodies identical (checked by
+# tests/test_shared_modules.py); everything after the class is service specific.
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket whose refill rate adapts to observed quota responses:
+    - every successful call raises the rate additively (up to max_rate)
+    - every 429 / quota response cuts the rate multiplicatively (down to min_rate)
+      and pauses all callers for the Retry-After period
+    Thread-safe, shared by every caller of the same API.
+    """
+
+    def __init__(self, name: str, initial_rate: float, min_rate: float, max_rate: float,
+                 burst: int = 1, increase_step: float = 0.05, decrease_factor: float = 0.5):
+        self.name = name
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = max(1, burst)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        self._stats = {
+            "requests": 0,
+            "successes": 0,
+            "throttled": 0,
+            "errors": 0,
+            "total_wait_seconds": 0.0,
+            "last_throttled_at": None,
+        }
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+    def acquire(self) -> float:
+        """Block until a call is allowed. Returns seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    self._stats["requests"] += 1
+                    self._stats["total_wait_seconds"] += waited
+                    return waited
+                else:
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def on_success(self):
+        with self._lock:
+            self._stats["successes"] += 1
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        """Called when the API answered 429 / quota exceeded"""
+        with self._lock:
+            self._stats["throttled"] += 1
+            self._stats["last_throttled_at"] = time.time()
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self._tokens = 0.0
+            pause = retry_after if retry_after else 1.0 / self.rate
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def on_error(self):
+        with self._lock:
+            self._stats["errors"] += 1
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "current_rate_per_sec": round(self.rate, 4),
+                "min_rate_per_sec": self.min_rate,
+                "max_rate_per_sec": self.max_rate,
+                "burst": self.burst,
+                "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 2),
+                **self._stats,
+                "total_wait_seconds": round(self._stats["total_wait_seconds"], 2),
+            }
+
+def is_quota_error(e: Exception) -> bool:
+    """google.api_core ResourceExhausted / HTTP 429 / quota messages"""
+    text = str(e)
+    return type(e).__name__ == "ResourceExhausted" or "429" in text or "quota" in text.lower()
+
+def call_with_limiter(limiter: AdaptiveRateLimiter, fn: Callable[[], T], max_retries: int = 3) -> T:
+    """Run fn() under the limiter, retrying quota errors (the limiter decides the wait)."""
+    for attempt in range(max_retries):
+        limiter.acquire()
+        try:
+            result = fn()
+        except Exception as e:
+            if is_quota_error(e) and attempt < max_retries - 1:
+                limiter.on_throttle()
+                logger.warning("Gemini quota exceeded (attempt %d), rate -> %.2f req/s", attempt + 1, limiter.rate)
+                continue
+            limiter.on_error()
+            raise
+        limiter.on_success()
+        return result
+
+# Shared by answer generation and table selection
+gemini_limiter = AdaptiveRateLimiter(
+    name="gemini",
+    initial_rate=settings.APP_GEMINI_RATE_INITIAL,
+    min_rate=settings.APP_GEMINI_RATE_MIN,
+    max_rate=settings.APP_GEMINI_RATE_MAX,
+    burst=settings.APP_GEMINI_RATE_BURST,
+)
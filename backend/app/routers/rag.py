@@ -1,12 +1,18 @@
-from typing import List, Optional
+import json
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from fastapi import APIRouter, HTTPException
 from fastapi import status
+from fastapi.responses import StreamingResponse
 from app.schemas import QueryRequest, QueryResponse, HealthStatusResponse, DocumentCountResponse, ContextDocument
-from app.ocr import ocr_images_to_text, health_check_ocr
-from app.db import health_check_db, similarity_search_table, count_documents_per_table, get_embedding_dimension
-from app.llm import generate_answer, health_check_gemini
+from app.ocr import ocr_images, image_cache_key, health_check_ocr
+from app.db import health_check_db, similarity_search_tables, count_documents_per_table, get_embedding_dimension, warm_table_meta_cache
+from app.llm import generate_answer, stream_answer, health_check_gemini
 from app.config import settings
 from app.table_selector_llm import selector
+from app.rate_limiter import gemini_limiter
+from app.embedding_service import embedding_service
+from app.context_builder import context_builder
+from app.answer_cache import answer_cache
 from PIL import Image
 from io import BytesIO
 import base64
@@ -15,6 +21,117 @@ rag_router = APIRouter()
 from app.logger import setup_logger
 logger = setup_logger(__name__)
 
+def _decode_images(images_b64: Optional[List[str]]) -> Tuple[List[Image.Image], List[str]]:
+    pil_images: List[Image.Image] = []
+    image_keys: List[str] = []
+    for img_base64 in images_b64 or []:
+        try:
+            # Loại bỏ phần header nếu có (data:image/png;base64,...)
+            if ',' in img_base64:
+                img_base64 = img_base64.split(',')[1]
+            
+            img_data = base64.b64decode(img_base64)
+            pil_images.append(Image.open(BytesIO(img_data)).convert("RGB"))
+            image_keys.append(image_cache_key(img_data))
+        except Exception as e:
+            logger.warning(f"Failed to decode base64 image: {e}")
+            # Tiếp tục xử lý các ảnh khác nếu có lỗi
+    return pil_images, image_keys
+
+def _retrieve(request: QueryRequest) -> Dict[str, Any]:
+    """
+    OCR + chọn bảng + truy vấn similarity + dựng context, dùng chung cho /api/query và /api/query/stream.
+    Nếu có câu trả lời trong cache thì trả về ngay với key "cached".
+    """
+    pil_images, image_keys = _decode_images(request.images)
+    
+    # OCR trực tiếp trên ảnh đã decode (song song, cache theo hash ảnh)
+    ocr_text = ""
+    if pil_images:
+        ocr_text = "\n\n".join(t for t in ocr_images(pil_images, image_keys) if t)
+    
+    # Kết hợp text từ input và OCR
+    user_text = (request.text or "").strip()
+    merged_text = " ".join([t for t in [user_text, ocr_text] if t]).strip()
+    
+    if not merged_text:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, 
+            detail="Thiếu input: cần cung cấp text hoặc ít nhất một ảnh chứa chữ."
+        )
+
+    result: Dict[str, Any] = {
+        "ocr_text": ocr_text,
+        "user_text": user_text,
+        "merged_text": merged_text,
+        "pil_images": pil_images,
+        "cached": None,
+    }
+
+    # Câu hỏi kèm ảnh không dùng cache (câu trả lời phụ thuộc ảnh)
+    use_cache = settings.APP_ANSWER_CACHE_ENABLED and not pil_images
+    result["use_cache"] = use_cache
+    if use_cache:
+        result["cached"] = answer_cache.get_exact(merged_text, request.top_k, request.min_score)
+        if result["cached"]:
+            logger.info("Answer cache exact hit")
+            return result
+
+    # Embed câu hỏi 1 lần, dùng cho cả chọn bảng và truy vấn similarity
+    query_vec = embedding_service.embed(merged_text)
+    result["query_vec"] = query_vec
+
+    # Chọn các bảng phù hợp (router embedding, Gemini khi mơ hồ)
+    selected = selector.select_tables(
+        merged_text, query_vec=query_vec, max_tables=settings.APP_RETRIEVAL_MAX_TABLES
+    )
+    if not selected:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, 
+            detail="Không tìm thấy bảng phù hợp theo schema mô tả."
+        )
+    logger.info("Selected tables: %s", ", ".join(f"{s}.{t} ({score:.3f})" for s, t, score in selected))
+    result["selected"] = selected
+
+    if use_cache:
+        result["cached"] = answer_cache.get_similar(query_vec, selected, request.top_k, request.min_score)
+        if result["cached"]:
+            return result
+
+    # Truy vấn similarity song song trên các bảng, gộp top-k
+    hits = similarity_search_tables(
+        selected,
+        merged_text,
+        top_k=request.top_k,
+        min_score=request.min_score,
+        query_vec=query_vec,
+    )
+
+    # Dựng context: bỏ hit trùng, giữ field liên quan, giới hạn theo token budget
+    context_strings, used_hits = context_builder.build(hits, merged_text)
+    used_contexts: List[ContextDocument] = []
+    
+    for h in used_hits:
+        used_contexts.append(ContextDocument(
+            table=h["table"],
+            id=h["id"],
+            score=float(h["score"] or 0.0),
+            original_data=h.get("original_data"),
+            content_text=h.get("content_text"),
+        ))
+
+    if not context_strings:
+        table_names = ", ".join(f"{s}.{t}" for s, t, _ in selected)
+        context_strings = [f"Không tìm thấy tài liệu phù hợp trong bảng {table_names} cho câu hỏi này."]
+
+    result.update(hits=hits, context_strings=context_strings, used_contexts=used_contexts)
+    return result
+
+def _store_answer(request: QueryRequest, r: Dict[str, Any], answer: str):
+    if r["use_cache"] and r["hits"] and answer and not answer.startswith("Xin lỗi"):
+        answer_cache.put(r["merged_text"], r["query_vec"], r["selected"], request.top_k, request.min_score,
+                         answer, r["hits"], r["used_contexts"])
+
 @rag_router.post("/api/query", response_model=QueryResponse, summary="Query the RAG system with a text query")
 async def query_rag(
     request: QueryRequest
@@ -30,93 +147,23 @@ async def query_rag(
                 request.text, request.top_k, request.min_score)
     
     try:
-        pil_images: List[Image.Image] = []
-        
-        # Xử lý images nếu có
-        if request.images:
-            for img_base64 in request.images:
-                try:
-                    # Loại bỏ phần header nếu có (data:image/png;base64,...)
-                    if ',' in img_base64:
-                        img_base64 = img_base64.split(',')[1]
-                    
-                    img_data = base64.b64decode(img_base64)
-                    pil_images.append(Image.open(BytesIO(img_data)).convert("RGB"))
-                except Exception as e:
-                    logger.warning(f"Failed to decode base64 image: {e}")
-                    # Tiếp tục xử lý các ảnh khác nếu có lỗi
-        
-        # Xử lý OCR từ ảnh
-        ocr_text = ""
-        if pil_images:
-            # Chuyển đổi PIL Image sang bytes để sử dụng OCR
-            image_bytes_list = []
-            for img in pil_images:
-                img_byte_arr = BytesIO()
-                img.save(img_byte_arr, format='PNG')
-                image_bytes_list.append(img_byte_arr.getvalue())
-            
-            if image_bytes_list:
-                ocr_text = ocr_images_to_text(image_bytes_list)
-        
-        # Kết hợp text từ input và OCR
-        user_text = (request.text or "").strip()
-        merged_text = " ".join([t for t in [user_text, ocr_text] if t]).strip()
-        
-        if not merged_text:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST, 
-                detail="Thiếu input: cần cung cấp text hoặc ít nhất một ảnh chứa chữ."
-            )
-
-        # Chọn bảng phù hợp
-        selected = selector.select_best_table(merged_text)
-        if not selected:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND, 
-                detail="Không tìm thấy bảng phù hợp theo schema mô tả."
-            )
-        
-        schema, table, table_score = selected
-        logger.info("Selected table: %s.%s (score=%.3f)", schema, table, table_score)
-
-        # Truy vấn similarity
-        hits = similarity_search_table(
-            schema, 
-            table, 
-            merged_text, 
-            top_k=request.top_k, 
-            min_score=request.min_score
-        )
-
-        context_strings: List[str] = []
-        used_contexts: List[ContextDocument] = []
-        
-        for h in hits:
-            ctx_line = f"[{h['table']}#{h['id']} score={h['score']:.3f}]\noriginal_data: {h.get('original_data')}\ncontent_text: {h.get('content_text')}"
-            context_strings.append(ctx_line)
-            used_contexts.append(ContextDocument(
-                table=h["table"],
-                id=h["id"],
-                score=float(h["score"] or 0.0),
-                original_data=h.get("original_data"),
-                content_text=h.get("content_text"),
-            ))
-
-        if not context_strings:
-            context_strings = [f"Không tìm thấy tài liệu phù hợp trong bảng {schema}.{table} cho câu hỏi này."]
+        r = _retrieve(request)
+        if r["cached"]:
+            return QueryResponse(answer=r["cached"]["answer"], ocr_text=r["ocr_text"],
+                                 used_contexts=r["cached"]["used_contexts"])
 
         # Tạo câu trả lời
         answer = generate_answer(
-            user_text or merged_text, 
-            context_strings, 
-            images=pil_images if pil_images else None
+            r["user_text"] or r["merged_text"], 
+            r["context_strings"], 
+            images=r["pil_images"] or None
         )
+        _store_answer(request, r, answer)
 
         return QueryResponse(
             answer=answer, 
-            ocr_text=ocr_text, 
-            used_contexts=used_contexts
+            ocr_text=r["ocr_text"], 
+            used_contexts=r["used_contexts"]
         )
 
     except HTTPException:
@@ -126,4 +173,87 @@ async def query_rag(
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
             detail=f"Lỗi nội bộ khi xử lý truy vấn: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@rag_router.post("/api/query/stream", summary="Query the RAG system and stream the answer (SSE)")
+async def query_rag_stream(
+    request: QueryRequest
+):
+    """
+    Như /api/query nhưng trả về Server-Sent Events:
+    - event `contexts`: {"ocr_text", "used_contexts"} gửi ngay khi truy vấn xong
+    - event `token`: {"text"} từng phần câu trả lời theo stream của Gemini
+    - event `done`: {"answer"} câu trả lời đầy đủ; lỗi giữa chừng gửi event `error`
+    """
+    logger.info("Received /api/query/stream request: text=%s, top_k=%d, min_score=%.3f", 
+                request.text, request.top_k, request.min_score)
+    try:
+        r = _retrieve(request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Unhandled error in /query/stream: %s", e)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
+            detail=f"Lỗi nội bộ khi xử lý truy vấn: {str(e)}"
+        )
+
+    def events() -> Iterator[str]:
+        cached = r["cached"]
+        used_contexts = cached["used_contexts"] if cached else r["used_contexts"]
+        yield _sse("contexts", {
+            "ocr_text": r["ocr_text"],
+            "used_contexts": [c.model_dump() for c in used_contexts],
+        })
+        if cached:
+            yield _sse("token", {"text": cached["answer"]})
+            yield _sse("done", {"answer": cached["answer"], "cached": True})
+            return
+
+        parts: List[str] = []
+        try:
+            for chunk in stream_answer(
+                r["user_text"] or r["merged_text"],
+                r["context_strings"],
+                images=r["pil_images"] or None,
+            ):
+                parts.append(chunk)
+                yield _sse("token", {"text": chunk})
+        except Exception as e:
+            logger.exception("Streaming answer failed: %s", e)
+            yield _sse("error", {"detail": f"Lỗi khi sinh câu trả lời: {str(e)}"})
+            return
+        answer = "".join(parts).strip()
+        _store_answer(request, r, answer)
+        yield _sse("done", {"answer": answer, "cached": False})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@rag_router.get("/api/router/metrics", summary="Table router and decision cache metrics")
+async def table_router_metrics():
+    return selector.router_metrics()
+
+@rag_router.get("/api/cache/answers", summary="Answer cache metrics")
+async def answer_cache_metrics():
+    return answer_cache.metrics()
+
+@rag_router.post("/api/cache/answers/invalidate", summary="Invalidate cached answers")
+async def invalidate_answer_cache(table: Optional[str] = None):
+    """Xoá câu trả lời đã cache của bảng `table` ("schema.table"), hoặc toàn bộ nếu không truyền."""
+    return {"invalidated": answer_cache.invalidate(table)}
+
+@rag_router.get("/api/gemini/rate-limit", summary="Adaptive Gemini rate limiter metrics")
+async def gemini_rate_limit():
+    return gemini_limiter.metrics()
+
+@rag_router.post("/api/tables/metadata/refresh", summary="Reload cached embedding table metadata")
+async def refresh_table_metadata():
+    """Nạp lại cache dimension / số dòng / index sau khi schema bảng embedding thay đổi."""
+    return warm_table_meta_cache()
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# ================================================================================================
+# SEMANTIC CACHE (nearest cached query embedding above a cosine threshold)
+# ================================================================================================
+
+def normalize_vector(vec: Sequence[float]) -> Optional[np.ndarray]:
+    arr = np.asarray(vec, dtype=np.float32)
+    norm = float(np.linalg.norm(arr))
+    if arr.ndim != 1 or norm == 0.0:
+        return None
+    return arr / norm
+
+def cosine_scores(query: Sequence[float], matrix: np.ndarray) -> np.ndarray:
+    """Cosine giữa query và từng dòng của matrix (các dòng đã chuẩn hoá)"""
+    q = normalize_vector(query)
+    if q is None or matrix.size == 0 or matrix.shape[1] != q.shape[0]:
+        return np.zeros(len(matrix), dtype=np.float32)
+    return matrix @ q
+
+class SemanticCache:
+    """
+    In-memory cache keyed by query embedding.
+    - get() returns the value of the most similar entry with cosine >= threshold
+      (optionally restricted by a `match(meta)` predicate)
+    - LRU eviction beyond max_entries, entries expire after ttl_seconds
+    - invalidate(predicate) drops entries whose meta matches
+    Thread-safe.
+    """
+
+    def __init__(self, name: str, threshold: float, max_entries: int = 512, ttl_seconds: float = 0):
+        self.name = name
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[int, Tuple[np.ndarray, Any, Dict[str, Any], float]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created_at > self.ttl_seconds
+
+    def get(self, vec: Sequence[float], match: Optional[Callable[[Dict[str, Any]], bool]] = None) -> Optional[Tuple[Any, float]]:
+        """(value, similarity) của entry gần nhất, hoặc None"""
+        q = normalize_vector(vec)
+        if q is None:
+            return None
+        now = time.time()
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if self._expired(e[3], now)]:
+                self._entries.pop(key)
+            candidates = [
+                (key, e) for key, e in self._entries.items()
+                if e[0].shape == q.shape and (match is None or match(e[2]))
+            ]
+            if not candidates:
+                self.stats["misses"] += 1
+                return None
+            scores = np.stack([e[0] for _, e in candidates]) @ q
+            best = int(np.argmax(scores))
+            score = float(scores[best])
+            if score < self.threshold:
+                self.stats["misses"] += 1
+                return None
+            key, entry = candidates[best]
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1], score
+
+    def put(self, vec: Sequence[float], value: Any, meta: Optional[Dict[str, Any]] = None):
+        q = normalize_vector(vec)
+        if q is None:
+            return
+        with self._lock:
+            self._entries[self._next_id] = (q, value, meta or {}, time.time())
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.stats["stored"] += 1
+
+    def invalidate(self, predicate: Optional[Callable[[Dict[str, Any]], bool]] = None) -> int:
+        """Xoá entry có meta thoả predicate (None = xoá hết); trả về số entry đã xoá"""
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if predicate is None or predicate(e[2])]
+            for k in keys:
+                self._entries.pop(k)
+            self.stats["invalidated"] += len(keys)
+            return len(keys)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"name": self.name, "entries": len(self._entries), **self.stats}
+
+def top_matches(query: Sequence[float], labels: List[Any], matrix: np.ndarray) -> List[Tuple[Any, float]]:
+    """[(label, cosine)] sắp xếp giảm dần"""
+    scores = cosine_scores(query, matrix)
+    order = np.argsort(-scores)
+    return [(labels[i], float(scores[i])) for i in order]
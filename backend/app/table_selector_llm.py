@@ -1,29 +1,59 @@
 from typing import List, Optional, Tuple, Dict, Any
 import json
+import threading
+import numpy as np
 import google.generativeai as genai
 from dataclasses import dataclass
 from app.config import settings
+from app.embedding_service import embedding_service
 
 from .logger import setup_logger
+from .rate_limiter import call_with_limiter, gemini_limiter
+from .llm import get_generative_model
+from .semantic_cache import SemanticCache, normalize_vector, top_matches
 
 logger = setup_logger(__name__)
 
+# reason của các kết quả fallback trong select_tables_with_llm (không phải quyết định của LLM)
+_FALLBACK_REASONS = ("No LLM available", "JSON parse error", "Error:")
+
 @dataclass
 class TableSchemaDesc:
     schema: str
     table: str
     description: str
     columns: Optional[str] = None  # Mô tả các cột quan trọng
+    keywords: Optional[str] = None
+
+    def routing_text(self) -> str:
+        """Text dùng để embed cho router"""
+        parts = [f"{self.schema}.{self.table}", self.description]
+        if self.columns:
+            parts.append(f"Cột: {self.columns}")
+        if self.keywords:
+            parts.append(f"Từ khoá: {self.keywords}")
+        return "\n".join(parts)
 
 class TableSelectorLLM:
     """
-    Sử dụng Gemini LLM để phân tích câu hỏi và chọn bảng phù hợp nhất
-    thay vì dùng embedding similarity
+    Chọn bảng phù hợp nhất cho câu hỏi:
+    - router nhanh: cosine giữa embedding câu hỏi và embedding mô tả bảng (embed 1 lần)
+    - khi top bảng sát nhau (mơ hồ) mới hỏi Gemini; quyết định của Gemini được cache
+      theo embedding câu hỏi để câu hỏi tương tự không phải hỏi lại
     """
     
     def __init__(self):
         self.tables: List[TableSchemaDesc] = []
         self._load_schemas()
+        self._table_matrix: Optional[np.ndarray] = None
+        self._table_labels: List[TableSchemaDesc] = []
+        self._router_lock = threading.Lock()
+        self.decision_cache = SemanticCache(
+            "table_router",
+            threshold=settings.APP_TABLE_ROUTER_CACHE_SIMILARITY,
+            max_entries=settings.APP_TABLE_ROUTER_CACHE_SIZE,
+        )
+        self.stats = {"embedding_routes": 0, "cached_llm_routes": 0, "llm_routes": 0}
         
         if settings.GOOGLE_API_KEY:
             genai.configure(api_key=settings.GOOGLE_API_KEY)
@@ -41,7 +71,8 @@ class TableSelectorLLM:
                         schema=item.get("schema", "public"),
                         table=item["table"],
                         description=item["description"],
-                        columns=item.get("columns", None)
+                        columns=item.get("columns", None),
+                        keywords=item.get("keywords", None),
                     ))
                 logger.info(f"Loaded {len(self.tables)} table schemas from config")
                 return
@@ -143,14 +174,14 @@ class TableSelectorLLM:
             prompt = self._build_selection_prompt(query_text)
             
             # Gọi Gemini
-            model = genai.GenerativeModel(settings.APP_GEMINI_MODEL)
-            response = model.generate_content(
+            model = get_generative_model(settings.APP_GEMINI_MODEL)
+            response = call_with_limiter(gemini_limiter, lambda: model.generate_content(
                 prompt,
                 generation_config={
                     "temperature": 0.1,  # Thấp để output ổn định hơn
                     "max_output_tokens": 1000,
                 }
-            )
+            ))
             
             response_text = response.text.strip()
             logger.info(f"LLM response: {response_text[:200]}...")
@@ -199,9 +230,107 @@ class TableSelectorLLM:
                 return [(self.tables[0].schema, self.tables[0].table, 0.4, f"Error: {str(e)}")]
             return []
     
+    def _ensure_table_vectors(self) -> bool:
+        """Embed mô tả các bảng (lần lượt từng bảng, chỉ 1 lần; kết quả giữ trong bộ nhớ)"""
+        if self._table_matrix is not None:
+            return True
+        with self._router_lock:
+            if self._table_matrix is not None:
+                return True
+            labels, rows = [], []
+            try:
+                for t in self.tables:
+                    vec = normalize_vector(embedding_service.embed(t.routing_text()))
+                    if vec is not None:
+                        labels.append(t)
+                        rows.append(vec)
+            except Exception as e:
+                logger.warning(f"Failed to embed table descriptions for routing: {e}")
+                return False
+            if not rows or len({r.shape for r in rows}) != 1:
+                return False
+            self._table_labels = labels
+            self._table_matrix = np.stack(rows)
+            logger.info(f"Embedded {len(labels)} table descriptions for routing")
+            return True
+
+    def warm_up(self):
+        self._ensure_table_vectors()
+
+    def rank_tables_by_embedding(self, query_vec: List[float]) -> List[Tuple[str, str, float]]:
+        """[(schema, table, cosine)] giảm dần; rỗng nếu chưa embed được mô tả bảng"""
+        if not query_vec or not self._ensure_table_vectors():
+            return []
+        return [(t.schema, t.table, score) for t, score in top_matches(query_vec, self._table_labels, self._table_matrix)]
+
+    def _is_ambiguous(self, ranked: List[Tuple[str, str, float]]) -> bool:
+        if not ranked:
+            return True
+        if ranked[0][2] < settings.APP_TABLE_ROUTER_MIN_SIMILARITY:
+            return True
+        return len(ranked) > 1 and ranked[0][2] - ranked[1][2] < settings.APP_TABLE_ROUTER_MARGIN
+
+    @staticmethod
+    def _close_to_top(ranked: List[Tuple[str, str, float]], max_tables: int) -> List[Tuple[str, str, float]]:
+        """Bảng top và các bảng có điểm cách top không quá APP_RETRIEVAL_TABLE_MARGIN"""
+        if not ranked:
+            return []
+        floor = ranked[0][2] - settings.APP_RETRIEVAL_TABLE_MARGIN
+        return [r for r in ranked[:max_tables] if r[2] >= floor]
+
+    def select_tables(
+        self,
+        query_text: str,
+        query_vec: Optional[List[float]] = None,
+        max_tables: int = 1,
+    ) -> List[Tuple[str, str, float]]:
+        """
+        Chọn tối đa max_tables bảng: router embedding trước, Gemini khi mơ hồ.
+
+        Returns:
+            List of (schema, table, score)
+        """
+        if query_vec is None:
+            try:
+                query_vec = embedding_service.embed(query_text)
+            except Exception as e:
+                logger.warning(f"Query embedding failed, routing with LLM only: {e}")
+
+        ranked = self.rank_tables_by_embedding(query_vec) if query_vec else []
+        if ranked and not self._is_ambiguous(ranked):
+            self.stats["embedding_routes"] += 1
+            logger.info(f"Embedding router picked {ranked[0][1]} (score={ranked[0][2]:.3f})")
+            return self._close_to_top(ranked, max_tables)
+
+        if query_vec:
+            cached = self.decision_cache.get(query_vec)
+            if cached:
+                self.stats["cached_llm_routes"] += 1
+                logger.info(f"Reusing cached table decision (similarity={cached[1]:.3f})")
+                return cached[0][:max_tables]
+
+        if ranked and not settings.GOOGLE_API_KEY:
+            return self._close_to_top(ranked, max_tables)
+
+        self.stats["llm_routes"] += 1
+        llm_results = self.select_tables_with_llm(query_text, max_tables=3)
+        if not llm_results:
+            return self._close_to_top(ranked, max_tables)
+        # Gemini lỗi: kết quả fallback (bảng đầu tiên) kém hơn xếp hạng embedding đã có
+        if llm_results[0][3].startswith(_FALLBACK_REASONS):
+            if ranked:
+                return self._close_to_top(ranked, max_tables)
+            return [(s, t, c) for s, t, c, _ in llm_results][:max_tables]
+        results = [(s, t, c) for s, t, c, _ in llm_results]
+        # Chỉ cache quyết định thật của LLM (fallback khi lỗi đã trả về ở trên)
+        if query_vec:
+            self.decision_cache.put(query_vec, results)
+        return results[:max_tables]
+
     def select_best_table(
         self, 
-        query_text: str
+        query_text: str,
+        query_vec: Optional[List[float]] = None,
     ) -> Optional[Tuple[str, str, float]]:
         """
         Wrapper để tương thích với code cũ.
@@ -210,11 +339,13 @@ class TableSelectorLLM:
         Returns:
             (schema, table, confidence) hoặc None
         """
-        results = self.select_tables_with_llm(query_text, max_tables=1)
+        results = self.select_tables(query_text, query_vec=query_vec, max_tables=1)
         if results:
-            schema, table, confidence, _ = results[0]
-            return (schema, table, confidence)
+            return results[0]
         return None
+
+    def router_metrics(self) -> Dict[str, Any]:
+        return {**self.stats, "decision_cache": self.decision_cache.metrics()}
     
     def get_tables_info_for_context(self) -> str:
         """
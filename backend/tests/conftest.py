@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# app.config đọc các biến này khi import (trong container do docker-compose cung cấp)
+os.environ.setdefault("LOG_DIR", tempfile.mkdtemp(prefix="backend-logs-"))
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+os.environ.setdefault("OLLAMA_URL", "http://ollama.test:11434")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,58 @@
+from app.context_builder import ContextBuilder, count_tokens
+
+def hit(row_id, score, content_text, table="materials", original_data=None):
+    return {
+        "table": table,
+        "id": row_id,
+        "score": score,
+        "content_text": content_text,
+        "original_data": original_data or {},
+    }
+
+def test_duplicate_hits_are_dropped():
+    builder = ContextBuilder(token_budget=1000, row_tokens=200)
+    hits = [
+        hit(1, 0.9, "material_name: Gỗ sồi\nunit: m3"),
+        hit(1, 0.8, "material_name: Gỗ sồi\nunit: m3"),  # cùng bảng#id
+        hit(2, 0.7, "unit: m3\nmaterial_name: Gỗ sồi"),  # cùng nội dung, khác id
+        hit(3, 0.6, "material_name: Đá granite"),
+    ]
+    contexts, used = builder.build(hits, "gỗ sồi")
+    assert [h["id"] for h in used] == [1, 3]
+    assert len(contexts) == 2
+
+def test_total_context_stays_within_budget_and_prefers_high_scores():
+    builder = ContextBuilder(token_budget=60, row_tokens=40)
+    hits = [hit(i, 0.1 * i, "\n".join(f"field_{i}_{j}: value {j}" for j in range(6))) for i in range(1, 9)]
+    contexts, used = builder.build(hits, "value")
+    assert sum(count_tokens(c) for c in contexts) <= 60
+    scores = [h["score"] for h in used]
+    assert scores == sorted(scores, reverse=True)
+    assert scores[0] == max(h["score"] for h in hits)
+    assert len(used) < len(hits)
+
+def test_row_trimming_keeps_fields_matching_the_query():
+    builder = ContextBuilder(token_budget=1000, row_tokens=20)
+    text = "\n".join([
+        "description: " + " ".join(["lorem"] * 30),
+        "material_group: Kim loại",
+        "price: 120000",
+    ])
+    contexts, _ = builder.build([hit(1, 0.9, text)], "nhóm kim loại là gì")
+    assert "material_group: Kim loại" in contexts[0]
+    assert "lorem" not in contexts[0]
+
+def test_original_data_fields_are_merged_without_repeating_content_lines():
+    builder = ContextBuilder(token_budget=1000, row_tokens=200)
+    h = hit(1, 0.9, "material_name: Gỗ sồi\nnote: hàng nhập", original_data={"material_name": "Gỗ sồi", "unit": "m3"})
+    contexts, _ = builder.build([h], "gỗ")
+    body = contexts[0].split("\n")[1:]
+    assert body.count("material_name: Gỗ sồi") == 1
+    assert "unit: m3" in body and "note: hàng nhập" in body
+
+def test_cached_fields_are_refreshed_when_content_changes():
+    builder = ContextBuilder(token_budget=1000, row_tokens=200)
+    builder.build([hit(1, 0.9, "material_name: Gỗ sồi")], "gỗ")
+    contexts, _ = builder.build([hit(1, 0.9, "material_name: Gỗ thông")], "gỗ")
+    assert "Gỗ thông" in contexts[0]
+    assert "Gỗ sồi" not in contexts[0]
@@ -0,0 +1,106 @@
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+# ================================================================================================
+# CONCURRENT BATCH CLASSIFIER
+# ================================================================================================
+# service-chatbot-main/chatapi and service-convert-data-main are deployed separately, so each
+# ships this module; keep both copies byte-identical (checked by tests/test_shared_modules.py).
+
+class ConcurrentBatchClassifier:
+    """
+    Keep several Gemini classification batches in flight at once.
+
+    - classify_fn(batch) must return {key: result} for the items it could classify;
+      results are matched by key (id_sap), never by position
+    - items missing from a reply (or from a failed batch) go back to the end of the
+      queue and are retried in a later batch, up to max_attempts per item
+    - batch size grows while replies are fast and complete, shrinks on
+      slow replies, errors or missing items
+    Pacing against the Gemini quota is done by the shared rate limiter inside classify_fn.
+    """
+
+    def __init__(self, classify_fn: Callable[[List[Dict]], Dict[str, Dict]], key: str = "id_sap",
+                 max_in_flight: int = 4, initial_batch_size: int = 10, min_batch_size: int = 4,
+                 max_batch_size: int = 50, target_latency: float = 15.0, max_attempts: int = 3):
+        self.classify_fn = classify_fn
+        self.key = key
+        self.max_in_flight = max(1, max_in_flight)
+        self.batch_size = initial_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.max_attempts = max_attempts
+        self.stats = {"batches": 0, "failed_batches": 0, "requeued": 0, "classified": 0, "unclassified": 0}
+
+    def _adapt(self, latency: float, missing_ratio: float, failed: bool):
+        if failed or missing_ratio > 0.2 or latency > self.target_latency * 1.5:
+            self.batch_size = max(self.min_batch_size, int(self.batch_size * 0.7))
+        elif latency < self.target_latency and missing_ratio == 0:
+            self.batch_size = min(self.max_batch_size, self.batch_size + 2)
+
+    def _timed_call(self, batch: List[Dict]):
+        start = time.monotonic()
+        try:
+            return self.classify_fn(batch), time.monotonic() - start, None
+        except Exception as e:
+            return {}, time.monotonic() - start, e
+
+    def run(self, items: List[Dict], on_results: Optional[Callable[[Dict[str, Dict]], None]] = None) -> Dict:
+        """
+        Classify all items. on_results({key: result}) is called from the calling
+        thread after every batch, so DB writes can happen incrementally.
+        Returns {"results": {key: result}, "unclassified": [item, ...]}.
+        """
+        # Classify each distinct key once
+        unique = {}
+        for item in items:
+            unique.setdefault(str(item[self.key]), item)
+        pending = deque((item, 0) for item in unique.values())
+
+        all_results: Dict[str, Dict] = {}
+        unclassified: List[Dict] = []
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            while pending or in_flight:
+                while pending and len(in_flight) < self.max_in_flight:
+                    batch = [pending.popleft() for _ in range(min(self.batch_size, len(pending)))]
+                    future = executor.submit(self._timed_call, [item for item, _ in batch])
+                    in_flight[future] = batch
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = in_flight.pop(future)
+                    results, latency, error = future.result()
+                    self.stats["batches"] += 1
+                    if error is not None:
+                        self.stats["failed_batches"] += 1
+                        print(f"ERROR: Classification batch failed ({len(batch)} items): {error}")
+
+                    found = {}
+                    missing = 0
+                    for item, attempts in batch:
+                        item_key = str(item[self.key])
+                        if item_key in results:
+                            found[item_key] = results[item_key]
+                        elif attempts + 1 < self.max_attempts:
+                            pending.append((item, attempts + 1))
+                            self.stats["requeued"] += 1
+                            missing += 1
+                        else:
+                            unclassified.append(item)
+                            missing += 1
+
+                    self._adapt(latency, missing / len(batch), error is not None)
+                    if found:
+                        all_results.update(found)
+                        if on_results:
+                            on_results(found)
+
+        self.stats["classified"] = len(all_results)
+        self.stats["unclassified"] = len(unclassified)
+        print(f"INFO: Classifier finished: {self.stats}, final batch size {self.batch_size}")
+        return {"results": all_results, "unclassified": unclassified}
@@ -1,7 +1,6 @@
 
 import json
 import os
-import time
 import uuid
 from typing import Dict, List
 
@@ -14,6 +13,9 @@ from psycopg2.extras import RealDictCursor
 from .textfunc import call_gemini_with_retry,format_suggested_prompts
 from .textapi_qwen import generate_suggested_prompts, search_products
 from config import settings
+from .classify_runner import ConcurrentBatchClassifier
+from .classification_cache import ClassificationCache
+from .embeddingapi import generate_embedding_qwen
 
 from chatapi.connect_db import get_db
 
@@ -22,10 +24,43 @@ router = APIRouter()
 # FUNCTION DEFINITIONS
 # ================================================================================================
     
-def batch_classify_materials(materials_batch: List[Dict]) -> List[Dict]:
-    if not materials_batch:
-        return []
+def parse_batch_classification(response_text: str, batch: List[Dict], fields: List[str]) -> Dict[str, Dict]:
+    """
+    Parse a Gemini JSON array reply and match items by id_sap (not by position).
+    Only items of `batch` having every field in `fields` are returned.
+    """
+    if not response_text:
+        return {}
     
+    try:
+        clean = response_text.strip()
+        # Clean markdown JSON
+        if "```json" in clean:
+            clean = clean.split("```json")[1].split("```")[0].strip()
+        elif "```" in clean:
+            clean = clean.split("```")[1].split("```")[0].strip()
+        
+        results = json.loads(clean)
+    except Exception as e:
+        print(f"ERROR: Batch classification parse error: {e}")
+        return {}
+    
+    expected_ids = {str(item['id_sap']) for item in batch}
+    matched = {}
+    for r in results if isinstance(results, list) else []:
+        if not isinstance(r, dict):
+            continue
+        id_sap = str(r.get('id_sap', '')).strip()
+        if id_sap in expected_ids and all(r.get(f) for f in fields):
+            matched[id_sap] = {'id_sap': id_sap, **{f: r[f] for f in fields}}
+    
+    if len(matched) != len(expected_ids):
+        print(f"WARNING: Batch mismatch: expected {len(expected_ids)}, matched {len(matched)}")
+    return matched
+
+def classify_materials_by_id(materials_batch: List[Dict]) -> Dict[str, Dict]:
+    if not materials_batch:
+        return {}
     
     materials_text = ""
     for i, mat in enumerate(materials_batch, 1):
@@ -37,7 +72,7 @@ def batch_classify_materials(materials_batch: List[Dict]) -> List[Dict]:
                 Xác định:
                 1. material_group: Gỗ, Da, Vải, Đá, Kim loại, Kính, Nhựa, Sơn, Keo, Phụ kiện, Khác
                 2. material_subgroup: Nhóm con cụ thể (VD: "Gỗ tự nhiên", "Da thật", "Vải cao cấp")
-                OUTPUT JSON ARRAY ONLY:
+                OUTPUT JSON ARRAY ONLY (giữ nguyên id_sap của từng dòng):
                 [
                     {{"id_sap": "M001", "material_group": "...", "material_subgroup": "..."}},
                     {{"id_sap": "M002", "material_group": "...", "material_subgroup": "..."}}
@@ -46,42 +81,11 @@ def batch_classify_materials(materials_batch: List[Dict]) -> List[Dict]:
     
     # Call Gemini with retry
     response_text = call_gemini_with_retry( prompt, max_retries=3)
-    
-    # Create default results (Fallback) to return if AI fails
-    default_results = [{
-        'id_sap': m['id_sap'],
-        'material_group': 'Not classified',
-        'material_subgroup': 'Not classified'
-    } for m in materials_batch]
-
-    if not response_text:
-        return default_results
-    
-    try:
-        clean = response_text.strip()
-        # Clean markdown JSON
-        if "```json" in clean:
-            clean = clean.split("```json")[1].split("```")[0].strip()
-        elif "```" in clean:
-            clean = clean.split("```")[1].split("```")[0].strip()
-        
-        results = json.loads(clean)
-        
-        # Check if number of results matches input
-        if len(results) != len(materials_batch):
-            print(f"WARNING: Batch materials mismatch: expected {len(materials_batch)}, got {len(results)}")
-            return default_results
-        
-        return results
-        
-    except Exception as e:
-        print(f"ERROR: Batch materials classification error: {e}")
-        return default_results
+    return parse_batch_classification(response_text, materials_batch, ['material_group', 'material_subgroup'])
 
-def batch_classify_products(products_batch: List[Dict]) -> List[Dict]:
+def classify_products_by_id(products_batch: List[Dict]) -> Dict[str, Dict]:
     if not products_batch:
-        return []
-
+        return {}
     
     # Create product list in prompt
     products_text = ""
@@ -96,7 +100,7 @@ def batch_classify_products(products_batch: List[Dict]) -> List[Dict]:
             1. category: Bàn, Ghế, Sofa, Tủ, Giường, Đèn, Kệ, Bàn làm việc, Khác
             2. sub_category: Danh mục phụ cụ thể (VD: "Bàn ăn", "Ghế bar", "Sofa góc"...)
             3. material_primary: Gỗ, Da, Vải, Kim loại, Đá, Kính, Nhựa, Mây tre, Hỗn hợp
-            OUTPUT JSON ARRAY ONLY (no markdown, no backticks):
+            OUTPUT JSON ARRAY ONLY (no markdown, no backticks, keep each id_sap):
             [
                 {{"id_sap": "SP001", "category": "...", "sub_category": "...", "material_primary": "..."}},
                 {{"id_sap": "SP002", "category": "...", "sub_category": "...", "material_primary": "..."}}
@@ -105,38 +109,193 @@ def batch_classify_products(products_batch: List[Dict]) -> List[Dict]:
     
     # Call AI with retry logic
     response_text = call_gemini_with_retry( prompt, max_retries=3)
+    return parse_batch_classification(response_text, products_batch, ['category', 'sub_category', 'material_primary'])
+
+# Memo store shared with service-convert-data-main (table: classification_cache)
+product_classification_cache = ClassificationCache(
+    get_db, "product",
+    embed_fn=generate_embedding_qwen,
+    similarity_threshold=settings.CLASSIFY_CACHE_SIMILARITY_THRESHOLD,
+)
+material_classification_cache = ClassificationCache(
+    get_db, "material",
+    embed_fn=generate_embedding_qwen,
+    similarity_threshold=settings.CLASSIFY_CACHE_SIMILARITY_THRESHOLD,
+)
+
+def _new_classifier(classify_fn) -> ConcurrentBatchClassifier:
+    return ConcurrentBatchClassifier(
+        classify_fn,
+        max_in_flight=settings.CLASSIFY_MAX_IN_FLIGHT,
+        initial_batch_size=settings.CLASSIFY_BATCH_SIZE,
+        min_batch_size=settings.CLASSIFY_MIN_BATCH_SIZE,
+        max_batch_size=settings.CLASSIFY_MAX_BATCH_SIZE,
+    )
+
+PENDING_PRODUCTS_FILTER = """
+    (category = 'Chưa phân loại'
+        OR sub_category = 'Chưa phân loại'
+        OR material_primary = 'Chưa xác định')
+"""
+
+PENDING_MATERIALS_FILTER = "material_subgroup = 'Chưa phân loại'"
+
+def count_pending_products() -> int:
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM products_qwen WHERE {PENDING_PRODUCTS_FILTER}")
+    remaining = cur.fetchone()[0]
+    conn.close()
+    return remaining
+
+def count_pending_materials() -> int:
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM {settings.MATERIALS_TABLE} WHERE {PENDING_MATERIALS_FILTER}")
+    remaining = cur.fetchone()[0]
+    conn.close()
+    return remaining
+
+def classify_products_page(after_key: str = None, limit: int = 100) -> Dict:
+    """
+    Classify one page of pending products, ordered by headcode.
+    `after_key` is the last headcode of the previous page (keyset checkpoint).
+    Returns {"processed", "classified", "errors", "last_key"}.
+    """
+    conn = get_db()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    cur.execute(f"""
+        SELECT headcode, id_sap, product_name 
+        FROM products_qwen 
+        WHERE {PENDING_PRODUCTS_FILTER}
+            AND (%s::text IS NULL OR headcode > %s)
+        ORDER BY headcode
+        LIMIT %s
+    """, (after_key, after_key, limit))
+    
+    pending_products = cur.fetchall()
+    classified = 0
+    errors = []
+    
+    # Sản phẩm chưa có id_sap vẫn được phân loại, dùng headcode làm khoá tạm
+    def product_key(p) -> str:
+        return str(p['id_sap']) if p['id_sap'] else f"headcode:{p['headcode']}"
+    
+    headcodes_by_id = {}
+    for p in pending_products:
+        headcodes_by_id.setdefault(product_key(p), []).append(p['headcode'])
+    
+    def save_results(results: Dict[str, Dict]):
+        nonlocal classified
+        for id_sap, result in results.items():
+            for headcode in headcodes_by_id.get(id_sap, []):
+                try:
+                    cur.execute("""
+                        UPDATE products_qwen 
+                        SET category = %s,
+                            sub_category = %s,
+                            material_primary = %s,
+                            updated_at = NOW()
+                        WHERE headcode = %s
+                    """, (
+                        result['category'],
+                        result['sub_category'],
+                        result['material_primary'],
+                        headcode
+                    ))
+                    classified += 1
+                except Exception as e:
+                    errors.append(f"{headcode}: {str(e)[:50]}")
+        conn.commit()
+    
+    batch_input = [{
+        'id_sap': product_key(p),
+        'name': p['product_name']
+    } for p in pending_products]
+    
+    print(f"INFO: Classifying {len(batch_input)} products concurrently...")
+    outcome = product_classification_cache.run_cached(
+        batch_input,
+        _new_classifier(classify_products_by_id).run,
+        save_results,
+        result_fields=['category', 'sub_category', 'material_primary'],
+    )
+    for item in outcome["unclassified"]:
+        errors.append(f"{item['id_sap']}: not classified")
     
-    # Default fallback if AI completely fails
-    default_results = [{
-        'id_sap': p['id_sap'],
-        'category': 'Chưa phân loại',
-        'sub_category': 'Chưa phân loại',
-        'material_primary': 'Chưa xác định'
-    } for p in products_batch]
+    conn.close()
+    
+    return {
+        "processed": len(pending_products),
+        "classified": classified,
+        "errors": errors,
+        "last_key": pending_products[-1]['headcode'] if pending_products else after_key
+    }
 
-    if not response_text:
-        return default_results
+def classify_materials_page(after_key: str = None, limit: int = 100) -> Dict:
+    """
+    Classify one page of pending materials, ordered by id_sap.
+    `after_key` is the last id_sap of the previous page (keyset checkpoint).
+    Returns {"processed", "classified", "errors", "last_key"}.
+    """
+    conn = get_db()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
     
-    try:
-        clean = response_text.strip()
-        # Handle case when Gemini returns markdown code block
-        if "```json" in clean:
-            clean = clean.split("```json")[1].split("```")[0].strip()
-        elif "```" in clean:
-            clean = clean.split("```")[1].split("```")[0].strip()
-        
-        results = json.loads(clean)
-        
-        # Ensure result count matches input
-        if len(results) != len(products_batch):
-            print(f"WARNING: Batch size mismatch: expected {len(products_batch)}, got {len(results)}")
-            return default_results
-        
-        return results
-        
-    except Exception as e:
-        print(f"ERROR: Batch classification parse error: {e}")
-        return default_results
+    cur.execute(f"""
+        SELECT id_sap, material_name, material_group
+        FROM {settings.MATERIALS_TABLE} 
+        WHERE {PENDING_MATERIALS_FILTER}
+            AND (%s::text IS NULL OR id_sap > %s)
+        ORDER BY id_sap
+        LIMIT %s
+    """, (after_key, after_key, limit))
+    
+    pending_materials = cur.fetchall()
+    classified = 0
+    errors = []
+    
+    def save_results(results: Dict[str, Dict]):
+        nonlocal classified
+        for id_sap, result in results.items():
+            try:
+                cur.execute(f"""
+                    UPDATE {settings.MATERIALS_TABLE} 
+                    SET material_subgroup = %s,
+                        updated_at = NOW()
+                    WHERE id_sap = %s
+                """, (
+                    result['material_subgroup'],
+                    id_sap
+                ))
+                classified += 1
+            except Exception as e:
+                errors.append(f"{id_sap}: {str(e)[:50]}")
+        conn.commit()
+    
+    batch_input = [{
+        'id_sap': m['id_sap'],
+        'name': m['material_name']
+    } for m in pending_materials]
+    
+    print(f"BOT: Classifying {len(batch_input)} materials concurrently...")
+    outcome = material_classification_cache.run_cached(
+        batch_input,
+        _new_classifier(classify_materials_by_id).run,
+        save_results,
+        result_fields=['material_group', 'material_subgroup'],
+    )
+    for item in outcome["unclassified"]:
+        errors.append(f"{item['id_sap']}: not classified")
+    
+    conn.close()
+    
+    return {
+        "processed": len(pending_materials),
+        "classified": classified,
+        "errors": errors,
+        "last_key": pending_materials[-1]['id_sap'] if pending_materials else after_key
+    }
 
 # ================================================================================================
 # API ENDPOINTS
@@ -404,23 +563,9 @@ async def search_by_image(
 @router.post("/classify-products", tags=["Classifyapi"])
 def classify_pending_products():
     try:
-        conn = get_db()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        # Get unclassified products
-        cur.execute("""
-            SELECT headcode, id_sap, product_name 
-            FROM products_qwen 
-            WHERE category = 'Chưa phân loại' 
-                OR sub_category = 'Chưa phân loại'
-                OR material_primary = 'Chưa xác định'
-            LIMIT 100
-        """)
+        page = classify_products_page()
         
-        pending_products = cur.fetchall()
-        
-        if not pending_products:
-            conn.close()
+        if page["processed"] == 0:
             return {
                 "message": "✅ Tất cả sản phẩm đã được phân loại!",
                 "classified": 0,
@@ -428,77 +573,14 @@ def classify_pending_products():
                 "remaining": 0
             }
         
-        total_pending = len(pending_products)
-        classified = 0
-        errors = []
-        
-        BATCH_SIZE = 8  # Gemini handles well with 5-10 items
-        
-        for i in range(0, len(pending_products), BATCH_SIZE):
-            batch = pending_products[i:i+BATCH_SIZE]
-            
-            # Prepare input for batch classification
-            batch_input = [{
-                'id_sap': p['id_sap'],
-                'name': p['product_name']
-            } for p in batch]
-            
-            print(f"INFO: Classifying batch {i//BATCH_SIZE + 1} ({len(batch)} products)...")
-            
-            try:
-                # CALL BATCH CLASSIFICATION
-                results = batch_classify_products(batch_input)
-                
-                # Update to DB
-                for j, result in enumerate(results):
-                    try:
-                        cur.execute("""
-                            UPDATE products_qwen 
-                            SET category = %s,
-                                sub_category = %s,
-                                material_primary = %s,
-                                updated_at = NOW()
-                            WHERE headcode = %s
-                        """, (
-                            result['category'],
-                            result['sub_category'],
-                            result['material_primary'],
-                            batch[j]['headcode']
-                        ))
-                        classified += 1
-                    except Exception as e:
-                        errors.append(f"{batch[j]['headcode']}: {str(e)[:50]}")
-                conn.commit()
-                # Delay between batches to avoid rate limit
-                if i + BATCH_SIZE < len(pending_products):
-                    time.sleep(4)
-                
-            except Exception as e:
-                print(f"ERROR: Batch {i//BATCH_SIZE + 1} failed: {e}")
-                errors.append(f"Batch {i//BATCH_SIZE + 1}: {str(e)[:100]}")
-                # Continue with next batch
-                continue
-        
-        conn.close()
-        
-        # Check how many remain unclassified
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT COUNT(*) FROM products_qwen 
-            WHERE category = 'Chưa phân loại' 
-            OR sub_category = 'Chưa phân loại'
-            OR material_primary = 'Chưa xác định'
-        """)
-        remaining = cur.fetchone()[0]
-        conn.close()
+        remaining = count_pending_products()
         
         return {
-            "message": f"✅ Đã phân loại {classified}/{total_pending} sản phẩm",
-            "classified": classified,
-            "total": total_pending,
+            "message": f"✅ Đã phân loại {page['classified']}/{page['processed']} sản phẩm",
+            "classified": page["classified"],
+            "total": page["processed"],
             "remaining": remaining,
-            "errors": errors[:10] if errors else []
+            "errors": page["errors"][:10] if page["errors"] else []
         }
         
     except Exception as e:
@@ -515,20 +597,9 @@ def classify_pending_materials():
     🤖 Phân loại HÀNG LOẠT các vật liệu chưa phân loại
     """
     try:
-        conn = get_db()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute(f"""
-            SELECT id_sap, material_name, material_group
-            FROM {settings.MATERIALS_TABLE} 
-            WHERE material_subgroup = 'Chưa phân loại'
-            LIMIT 100
-        """)
-        
-        pending_materials = cur.fetchall()
+        page = classify_materials_page()
         
-        if not pending_materials:
-            conn.close()
+        if page["processed"] == 0:
             return {
                 "message": "✅ Tất cả vật liệu đã được phân loại!",
                 "classified": 0,
@@ -536,67 +607,14 @@ def classify_pending_materials():
                 "remaining": 0
             }
         
-        total_pending = len(pending_materials)
-        classified = 0
-        errors = []
-        
-        BATCH_SIZE = 10
-        
-        for i in range(0, len(pending_materials), BATCH_SIZE):
-            batch = pending_materials[i:i+BATCH_SIZE]
-            
-            batch_input = [{
-                'id_sap': m['id_sap'],
-                'name': m['material_name']
-            } for m in batch]
-            
-            print(f"BOT: Classifying materials batch {i//BATCH_SIZE + 1} ({len(batch)} items)...")
-            
-            try:
-                results = batch_classify_materials(batch_input)
-                
-                for j, result in enumerate(results):
-                    try:
-                        cur.execute("""
-                            UPDATE materials 
-                            SET material_subgroup = %s,
-                                updated_at = NOW()
-                            WHERE id_sap = %s
-                        """, (
-                            result['material_subgroup'],
-                            batch[j]['id_sap']
-                        ))
-                        classified += 1
-                    except Exception as e:
-                        errors.append(f"{batch[j]['id_sap']}: {str(e)[:50]}")
-                
-                conn.commit()
-                
-                if i + BATCH_SIZE < len(pending_materials):
-                    time.sleep(4)
-                
-            except Exception as e:
-                print(f"ERROR: Materials batch {i//BATCH_SIZE + 1} failed: {e}")
-                errors.append(f"Batch {i//BATCH_SIZE + 1}: {str(e)[:100]}")
-                continue
-        
-        conn.close()
-        
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(f"""
-            SELECT COUNT(*) FROM {settings.MATERIALS_TABLE} 
-            WHERE material_subgroup = 'Chưa phân loại'
-        """)
-        remaining = cur.fetchone()[0]
-        conn.close()
+        remaining = count_pending_materials()
         
         return {
-            "message": f"✅ Đã phân loại {classified}/{total_pending} vật liệu",
-            "classified": classified,
-            "total": total_pending,
+            "message": f"✅ Đã phân loại {page['classified']}/{page['processed']} vật liệu",
+            "classified": page["classified"],
+            "total": page["processed"],
             "remaining": remaining,
-            "errors": errors[:10] if errors else []
+            "errors": page["errors"][:10] if page["errors"] else []
         }
         
     except Exception as e:
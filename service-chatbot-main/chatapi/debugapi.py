@@ -9,6 +9,7 @@ import psycopg2
 from config import settings
 
 from chatapi.connect_db import get_db
+from chatapi.rate_limiter import gemini_limiter
 
 router = APIRouter()
 # ================================================================================================
@@ -318,3 +319,8 @@ def debug_chat_history():
         "recent_chats": [dict(h) for h in history]
     }
 
+
+@router.get("/debug/gemini-rate-limit", tags=["Debugapi"])
+def debug_gemini_rate_limit():
+    """Current adaptive rate and quota counters of the shared Gemini limiter"""
+    return gemini_limiter.metrics()
@@ -8,6 +8,7 @@ import psycopg2
 import requests
 from config import settings
 import os
+from typing import Dict
 
 from chatapi.connect_db import get_db
 
@@ -41,13 +42,39 @@ def generate_embedding_qwen(text: str):
         return emb
     except Exception as e:
         print(f"⚠️ ERROR Qwen embedding: {e}")
-        
-# ================================================================================================
-# API ENDPOINTS
-# ================================================================================================
 
-@router.post("/generate-embeddings-qwen", tags=["Embeddingapi"])
-def generate_product_embeddings_qwen():
+def count_products_missing_embeddings() -> int:
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT COUNT(*)
+        FROM {settings.PRODUCTS_TABLE} p
+        LEFT JOIN qwen q ON q.table_name = '{settings.PRODUCTS_TABLE}' AND q.record_id = p.headcode
+        WHERE q.record_id IS NULL
+    """)
+    total = cur.fetchone()[0]
+    conn.close()
+    return total
+
+def count_materials_missing_embeddings() -> int:
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT COUNT(*)
+        FROM {settings.MATERIALS_TABLE} m
+        LEFT JOIN qwen q ON q.table_name = '{settings.MATERIALS_TABLE}' AND q.record_id = m.id_sap
+        WHERE q.record_id IS NULL
+    """)
+    total = cur.fetchone()[0]
+    conn.close()
+    return total
+
+def embed_products_page(after_key: str = None, limit: int = 100) -> Dict:
+    """
+    Generate Qwen embeddings for one page of products missing from the qwen table,
+    ordered by headcode. `after_key` is the last headcode of the previous page.
+    Returns {"processed", "success", "errors", "last_key"}.
+    """
     conn = get_db()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
@@ -57,15 +84,12 @@ def generate_product_embeddings_qwen():
         FROM {settings.PRODUCTS_TABLE} p
         LEFT JOIN qwen q ON q.table_name = '{settings.PRODUCTS_TABLE}' AND q.record_id = p.headcode
         WHERE q.record_id IS NULL
-        LIMIT 100
-    """)
+            AND (%s::text IS NULL OR p.headcode > %s)
+        ORDER BY p.headcode
+        LIMIT %s
+    """, (after_key, after_key, limit))
     
     products = cur.fetchall()
-    
-    if not products:
-        conn.close()
-        return {"message": "✅ All products_qwen already have embeddings in qwen table"}
-    
     success = 0
     errors = []
     
@@ -99,14 +123,18 @@ def generate_product_embeddings_qwen():
     conn.close()
     
     return {
-        "message": f"✅ Đã tạo embeddings cho {success}/{len(products)} products (Qwen3)",
+        "processed": len(products),
         "success": success,
-        "total": len(products),
-        "errors": errors[:5] if errors else []
+        "errors": errors,
+        "last_key": products[-1]['headcode'] if products else after_key
     }
 
-@router.post("/generate-material-embeddings-qwen", tags=["Embeddingapi"])
-def generate_material_embeddings_qwen():
+def embed_materials_page(after_key: str = None, limit: int = 100) -> Dict:
+    """
+    Generate Qwen embeddings for one page of materials missing from the qwen table,
+    ordered by id_sap. `after_key` is the last id_sap of the previous page.
+    Returns {"processed", "success", "errors", "last_key"}.
+    """
     conn = get_db()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
@@ -116,15 +144,12 @@ def generate_material_embeddings_qwen():
         FROM {settings.MATERIALS_TABLE} m
         LEFT JOIN qwen q ON q.table_name = '{settings.MATERIALS_TABLE}' AND q.record_id = m.id_sap
         WHERE q.record_id IS NULL
-        LIMIT 100
-    """)
+            AND (%s::text IS NULL OR m.id_sap > %s)
+        ORDER BY m.id_sap
+        LIMIT %s
+    """, (after_key, after_key, limit))
     
     materials = cur.fetchall()
-    
-    if not materials:
-        conn.close()
-        return {"message": "✅ Tất cả materials đã có embeddings trong bảng qwen"}
-    
     success = 0
     errors = []
     
@@ -158,8 +183,40 @@ def generate_material_embeddings_qwen():
     conn.close()
     
     return {
-        "message": f"✅ Đã tạo embeddings cho {success}/{len(materials)} materials (Qwen3)",
+        "processed": len(materials),
         "success": success,
-        "total": len(materials),
-        "errors": errors[:5] if errors else []
+        "errors": errors,
+        "last_key": materials[-1]['id_sap'] if materials else after_key
+    }
+
+# ================================================================================================
+# API ENDPOINTS
+# ================================================================================================
+
+@router.post("/generate-embeddings-qwen", tags=["Embeddingapi"])
+def generate_product_embeddings_qwen():
+    page = embed_products_page()
+    
+    if page["processed"] == 0:
+        return {"message": "✅ All products_qwen already have embeddings in qwen table"}
+    
+    return {
+        "message": f"✅ Đã tạo embeddings cho {page['success']}/{page['processed']} products (Qwen3)",
+        "success": page["success"],
+        "total": page["processed"],
+        "errors": page["errors"][:5] if page["errors"] else []
+    }
+
+@router.post("/generate-material-embeddings-qwen", tags=["Embeddingapi"])
+def generate_material_embeddings_qwen():
+    page = embed_materials_page()
+    
+    if page["processed"] == 0:
+        return {"message": "✅ Tất cả materials đã có embeddings trong bảng qwen"}
+    
+    return {
+        "message": f"✅ Đã tạo embeddings cho {page['success']}/{page['processed']} materials (Qwen3)",
+        "success": page["success"],
+        "total": page["processed"],
+        "errors": page["errors"][:5] if page["errors"] else []
     }
@@ -1,9 +1,7 @@
 import json
-import time
 import requests
 from io import BytesIO
 from typing import Dict, List
-import signal
 
 import numpy as np
 import psycopg2
@@ -15,8 +13,9 @@ from config import settings
 
 from .embeddingapi import generate_embedding_qwen
 from .connect_db import get_db_origin, get_db
+from .rate_limiter import gemini_limiter
 
-def fetch_google_content_api(api_endpoint: str, model_id: str, action: str, api_key: str, payload: Dict) -> Dict:
+def fetch_google_content_api(api_endpoint: str, model_id: str, action: str, api_key: str, payload: Dict, timeout: float = None) -> Dict:
     
     url = f"{api_endpoint}/v1/publishers/google/models/{model_id}:{action}?key={api_key}"
     
@@ -25,7 +24,7 @@ def fetch_google_content_api(api_endpoint: str, model_id: str, action: str, api_
     }
     
     try:
-        response = requests.post(url, headers=headers, json=payload)
+        response = requests.post(url, headers=headers, json=payload, timeout=timeout)
         response.raise_for_status()
         
         # Trả về kết quả rút gọn nếu có thể
@@ -36,14 +35,25 @@ def fetch_google_content_api(api_endpoint: str, model_id: str, action: str, api_
         except (KeyError, IndexError, TypeError):
             return data
             
+    except requests.exceptions.Timeout as e:
+        print(f"Error calling Google API: {e}")
+        return {"error": str(e), "timeout": True}
     except requests.exceptions.RequestException as e:
         print(f"Error calling Google API: {e}")
+        # Keep HTTP status / Retry-After so callers can react to quota errors (429)
+        http_info = {}
+        if e.response is not None:
+            http_info["status_code"] = e.response.status_code
+            http_info["retry_after"] = e.response.headers.get("Retry-After")
         try:
-            return response.json()
+            data = response.json()
+            if isinstance(data, dict):
+                data.update(http_info)
+            return data
         except:
-            return {"error": str(e), "details": response.text if 'response' in locals() else "No response"}
+            return {"error": str(e), "details": response.text if 'response' in locals() else "No response", **http_info}
 
-def generate_text_rest(prompt: str) -> Dict:
+def generate_text_rest(prompt: str, timeout: float = None) -> Dict:
     payload = {
         "contents": [{
             "role": "user",
@@ -59,62 +69,70 @@ def generate_text_rest(prompt: str) -> Dict:
         model_id=settings.MODEL_ID, 
         action=settings.GENERATE_CONTENT_API, 
         api_key=settings.GOOGLE_API_KEY, 
-        payload=payload
+        payload=payload,
+        timeout=timeout
     )
 
+def _is_quota_error(response: Dict) -> bool:
+    """429 / RESOURCE_EXHAUSTED from the Gemini REST API"""
+    if response.get("status_code") == 429:
+        return True
+    error = response.get("error")
+    if isinstance(error, dict):
+        return error.get("code") == 429 or error.get("status") == "RESOURCE_EXHAUSTED"
+    return "429" in str(error) or "quota" in str(error).lower() if error else False
+
+def _parse_retry_after(response: Dict):
+    try:
+        return float(response.get("retry_after"))
+    except (TypeError, ValueError):
+        return None
+
 def call_gemini_with_retry(prompt, max_retries=3, timeout=20):
-    
-    def timeout_handler(signum, frame):
-        raise TimeoutError("Gemini API timeout")
-    
+    """
+    Call Gemini through the shared adaptive rate limiter.
+    Quota responses (429) lower the shared rate and are retried; the limiter
+    decides how long to wait instead of a fixed backoff.
+    """
     for attempt in range(max_retries):
+        gemini_limiter.acquire()
         try:
-            # Set timeout for this attempt (only on Unix systems)
-            if hasattr(signal, 'SIGALRM'):
-                signal.signal(signal.SIGALRM, timeout_handler)
-                signal.alarm(timeout)
-            
             # response = model.generate_content(prompt, request_options={"timeout": timeout})
-            response = generate_text_rest(prompt)
-            
-            # Cancel alarm
-            if hasattr(signal, 'SIGALRM'):
-                signal.alarm(0)
-
-            # Handle dict response (from generate_text_rest)
-            if isinstance(response, dict):
-                if "text" in response:
-                    return response["text"]
-                # Fallback for raw JSON if text extraction failed in fetch_google_content_api
-                try:
-                    return response['candidates'][0]['content']['parts'][0]['text']
-                except (KeyError, IndexError, TypeError):
-                    print(f"WARNING: Could not extract text from dict response: {response}")
-                    return None
-
-            # Handle GenerateContentResponse object (if using model.generate_content)
-            if hasattr(response, 'text'):
-                return response.text
-                
-            return str(response)
-
-        except TimeoutError:
-            print(f"WARNING: Gemini timeout after {timeout}s on attempt {attempt + 1}")
-            if attempt == max_retries - 1:
-                return None
-            continue
+            response = generate_text_rest(prompt, timeout=timeout)
         except Exception as e:
-            # Cancel alarm on error
-            if hasattr(signal, 'SIGALRM'):
-                signal.alarm(0)
-            
-            if "429" in str(e) or "quota" in str(e).lower():
-                wait_time = 5 * (2 ** attempt)
-                print(f"INFO: Quota exceeded. Đợi {wait_time}s...")
-                time.sleep(wait_time)
-                continue
+            gemini_limiter.on_error()
             print(f"ERROR Gemini: {e}")
             return None
+
+        # Handle dict response (from generate_text_rest)
+        if isinstance(response, dict):
+            if "text" in response:
+                gemini_limiter.on_success()
+                return response["text"]
+            if _is_quota_error(response):
+                gemini_limiter.on_throttle(_parse_retry_after(response))
+                print(f"INFO: Quota exceeded (attempt {attempt + 1}). Rate giảm còn {gemini_limiter.rate:.2f} req/s")
+                continue
+            if response.get("timeout"):
+                gemini_limiter.on_error()
+                print(f"WARNING: Gemini timeout after {timeout}s on attempt {attempt + 1}")
+                continue
+            # Fallback for raw JSON if text extraction failed in fetch_google_content_api
+            try:
+                text = response['candidates'][0]['content']['parts'][0]['text']
+                gemini_limiter.on_success()
+                return text
+            except (KeyError, IndexError, TypeError):
+                gemini_limiter.on_error()
+                print(f"WARNING: Could not extract text from dict response: {response}")
+                return None
+
+        # Handle GenerateContentResponse object (if using model.generate_content)
+        gemini_limiter.on_success()
+        if hasattr(response, 'text'):
+            return response.text
+            
+        return str(response)
     return None
 
 def format_suggested_prompts(prompts: list[str]) -> str:
@@ -8,6 +8,7 @@ from chatapi.debugapi import router as debug_router
 from chatapi.embeddingapi import router as embeddings_router
 from chatapi.importapi import router as importapi_router
 from chatapi.textapi_qwen import router as textapi_router
+from jobsapi.jobs import router as jobs_router, start_workers, stop_workers
 from config import settings
 
 def get_db():
@@ -46,6 +47,7 @@ def root():
             "classify_materials": "POST /classify-materials 🆕",
             "generate_embeddings": "POST /generate-embeddings",
             "generate_material_embeddings": "POST /generate-material-embeddings",
+            "background_jobs": "POST /jobs/{job_type}, GET /jobs/{job_id}, POST /jobs/{job_id}/cancel 🆕",
             "chat_histories": "GET /chat_histories/{email}/{session_id} 🆕",
             "user_sessions": "GET /chat_histories/{email} 🆕",
             "debug": "GET /debug/products, /debug/materials, /debug/chat-history"
@@ -59,6 +61,15 @@ app.include_router(debug_router)
 app.include_router(embeddings_router)
 app.include_router(importapi_router)    
 app.include_router(textapi_router)
+app.include_router(jobs_router)
+
+@app.on_event("startup")
+def startup_job_workers():
+    start_workers()
+
+@app.on_event("shutdown")
+def shutdown_job_workers():
+    stop_workers()
 
 if __name__ == "__main__":
     import uvicorn
@@ -239,6 +239,33 @@ def add_message(role: str, content: str, data=None):
         msg["data"] = data
     st.session_state.messages.append(msg)
 
+def run_background_job(job_type: str, status_box, progress_bar=None):
+    """Tạo job chạy nền và theo dõi tiến độ (không chặn API worker)"""
+    response = requests.post(f"{API_URL}/jobs/{job_type}", timeout=10)
+    if response.status_code != 200:
+        status_box.error("Lỗi khi tạo job")
+        return
+    job_id = response.json()["job_id"]
+    
+    while True:
+        job = requests.get(f"{API_URL}/jobs/{job_id}", timeout=5).json()
+        status = job.get("status")
+        processed = job.get("processed", 0)
+        total = job.get("total") or 0
+        
+        if progress_bar is not None and job.get("progress") is not None:
+            progress_bar.progress(job["progress"])
+        
+        if status == "completed":
+            status_box.success(f"✅ Hoàn tất! Đã xử lý {processed} dòng ({job.get('succeeded', 0)} thành công)")
+            break
+        if status in ("failed", "cancelled"):
+            status_box.error(f"❌ Job {status} tại checkpoint {job.get('checkpoint')}. Có thể resume: POST /jobs/{job_id}/resume")
+            break
+        
+        status_box.info(f"⏳ Đang xử lý... {processed}/{total} (job {job_id[:8]})")
+        time.sleep(2)
+
 def process_user_input(user_input: str):
     """Xử lý input từ user"""
     add_message("user", user_input)
@@ -321,34 +348,7 @@ with st.sidebar:
             progress_bar = st.progress(0)
             
             try:
-                # Vòng lặp chạy cho đến khi hết sản phẩm chưa phân loại
-                while True:
-                    response = requests.post(f"{API_URL}/classify-products", timeout=60)
-                    if response.status_code != 200:
-                        st.error("Lỗi khi gọi API phân loại")
-                        break
-                        
-                    res = response.json()
-                    classified = res.get('classified', 0)
-                    remaining = res.get('remaining', 0)
-                    total = res.get('total', 0)
-                    
-                    if classified == 0 and remaining == 0:
-                        status_box.success("✅ Đã phân loại xong toàn bộ!")
-                        progress_bar.progress(100)
-                        break
-                    
-                    if classified == 0: # Không còn gì để làm hoặc lỗi
-                        status_box.info(res.get("message", "Hoàn tất."))
-                        break
-
-                    # Cập nhật trạng thái
-                    status_box.info(f"⏳ Đang xử lý... Còn lại: {remaining}")
-                    
-                    # Tính % tiến độ (ước lượng)
-                    if total > 0:
-                        percent = min(1.0, (total - remaining) / total)
-                        progress_bar.progress(percent)
+                run_background_job("classify_products", status_box, progress_bar)
                     
             except Exception as e:
                 st.error(f"Lỗi: {e}")
@@ -388,24 +388,7 @@ with st.sidebar:
             status_box_mat = st.empty()
             
             try:
-                while True:
-                    response = requests.post(f"{API_URL}/classify-materials", timeout=60)
-                    if response.status_code != 200:
-                        break
-                    
-                    res = response.json()
-                    classified = res.get('classified', 0)
-                    remaining = res.get('remaining', 0)
-                    
-                    if classified == 0 and remaining == 0:
-                        status_box_mat.success("✅ Đã phân loại xong!")
-                        break
-                    
-                    if classified == 0:
-                        status_box_mat.info(res.get("message"))
-                        break
-                        
-                    status_box_mat.info(f"⏳ Đang xử lý... Còn lại: {remaining}")
+                run_background_job("classify_materials", status_box_mat)
                     
             except Exception as e:
                 st.error(f"Lỗi: {e}")
@@ -459,22 +442,20 @@ with st.sidebar:
     with col1:
         st.caption("**Sản phẩm**")
         if st.button("⚡ Products", use_container_width=True, type="secondary"):
+            status_box_emb = st.empty()
             with st.spinner("Embedding Products..."):
                 try:
-                    response = requests.post(f"{API_URL}/generate-embeddings", timeout=300)
-                    if response.status_code == 200:
-                        st.success(response.json()['message'])
+                    run_background_job("embed_products", status_box_emb)
                 except Exception as e:
                     st.error(f"Lỗi: {e}")
     
     with col2:
         st.caption("**Vật liệu**")
         if st.button("⚡ Materials", use_container_width=True, type="secondary"):
+            status_box_emb_mat = st.empty()
             with st.spinner("Embedding Materials..."):
                 try:
-                    response = requests.post(f"{API_URL}/generate-material-embeddings", timeout=300)
-                    if response.status_code == 200:
-                        st.success(response.json()['message'])
+                    run_background_job("embed_materials", status_box_emb_mat)
                 except Exception as e:
                     st.error(f"Lỗi: {e}")
     
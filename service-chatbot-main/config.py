@@ -46,6 +46,20 @@ class Settings(BaseSettings):
     MODEL_ID: str = os.getenv("MODEL_ID", "gemini-2.5-flash")
     GENERATE_CONTENT_API: str = os.getenv("GENERATE_CONTENT_API", "generateContent")
     
+    # Gemini adaptive rate limit (requests/second, shared by all Gemini callers)
+    GEMINI_RATE_INITIAL: float = float(os.getenv("GEMINI_RATE_INITIAL", "1.0"))
+    GEMINI_RATE_MIN: float = float(os.getenv("GEMINI_RATE_MIN", "0.1"))
+    GEMINI_RATE_MAX: float = float(os.getenv("GEMINI_RATE_MAX", "10.0"))
+    GEMINI_RATE_BURST: int = int(os.getenv("GEMINI_RATE_BURST", "3"))
+    
+    # Concurrent batch classification (batch size adapts between MIN and MAX)
+    CLASSIFY_MAX_IN_FLIGHT: int = int(os.getenv("CLASSIFY_MAX_IN_FLIGHT", "4"))
+    CLASSIFY_BATCH_SIZE: int = int(os.getenv("CLASSIFY_BATCH_SIZE", "10"))
+    CLASSIFY_MIN_BATCH_SIZE: int = int(os.getenv("CLASSIFY_MIN_BATCH_SIZE", "4"))
+    CLASSIFY_MAX_BATCH_SIZE: int = int(os.getenv("CLASSIFY_MAX_BATCH_SIZE", "40"))
+    # Reuse a cached classification for near-duplicate names (cosine similarity, 0 = exact name only)
+    CLASSIFY_CACHE_SIMILARITY_THRESHOLD: float = float(os.getenv("CLASSIFY_CACHE_SIMILARITY_THRESHOLD", "0"))
+    
     # Table names
     # MATERIALS_TABLE: str = "materials_qwen"
     MATERIALS_TABLE: str = "material_merge"
@@ -69,6 +83,12 @@ class Settings(BaseSettings):
     SIMILARITY_THRESHOLD_HIGH: float = 0.7  # For feedback matching
     SIMILARITY_THRESHOLD_VERY_HIGH: float = 0.85  # For strict matching
     
+    # Background job queue settings (table: background_jobs)
+    JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", "1"))  # 0 = no in-process workers (run python -m jobsapi.jobs instead)
+    JOB_PAGE_SIZE: int = int(os.getenv("JOB_PAGE_SIZE", "100"))
+    JOB_POLL_INTERVAL: float = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+    JOB_STALE_SECONDS: int = int(os.getenv("JOB_STALE_SECONDS", "600"))  # running job without heartbeat -> requeued
+    
     MAIN_DB_HOST: str = os.getenv("MAIN_DB_HOST", "localhost")
     MAIN_DB_PORT: str = os.getenv("MAIN_DB_PORT", "5432")
     MAIN_DB_USER: str = os.getenv("MAIN_DB_USER", "postgres")
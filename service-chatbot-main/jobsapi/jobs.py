@@ -0,0 +1,355 @@
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException
+from psycopg2.extras import RealDictCursor
+
+from config import settings
+from chatapi.classifyapi import (classify_materials_page, classify_products_page,
+                                 count_pending_materials, count_pending_products)
+from chatapi.connect_db import get_db
+from chatapi.embeddingapi import (count_materials_missing_embeddings,
+                                  count_products_missing_embeddings,
+                                  embed_materials_page, embed_products_page)
+
+router = APIRouter()
+
+# Each job type processes its table page by page (keyset on headcode / id_sap).
+# run_page(after_key, limit) -> {"processed", <success_field>, "errors", "last_key"}
+JOB_HANDLERS = {
+    "classify_products": {
+        "run_page": classify_products_page,
+        "count": count_pending_products,
+        "success_field": "classified",
+    },
+    "classify_materials": {
+        "run_page": classify_materials_page,
+        "count": count_pending_materials,
+        "success_field": "classified",
+    },
+    "embed_products": {
+        "run_page": embed_products_page,
+        "count": count_products_missing_embeddings,
+        "success_field": "success",
+    },
+    "embed_materials": {
+        "run_page": embed_materials_page,
+        "count": count_materials_missing_embeddings,
+        "success_field": "success",
+    },
+}
+
+MAX_STORED_ERRORS = 50
+
+_worker_threads: List[threading.Thread] = []
+_stop_event = threading.Event()
+
+# ================================================================================================
+# FUNCTION DEFINITIONS
+# ================================================================================================
+
+def enqueue_job(job_type: str, params: Dict = None) -> str:
+    """Insert a queued job and return its id"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO background_jobs (job_type, status, params)
+        VALUES (%s, 'queued', %s)
+        RETURNING id
+    """, (job_type, json.dumps(params or {})))
+    job_id = str(cur.fetchone()[0])
+    conn.commit()
+    conn.close()
+    return job_id
+
+def get_job(job_id: str) -> Optional[Dict]:
+    conn = get_db()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT * FROM background_jobs WHERE id = %s", (job_id,))
+    job = cur.fetchone()
+    conn.close()
+    return job
+
+def claim_next_job(worker_id: str) -> Optional[Dict]:
+    """Atomically move the oldest queued job to 'running' (safe across processes)"""
+    conn = get_db()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        UPDATE background_jobs
+        SET status = 'running',
+            worker_id = %s,
+            started_at = COALESCE(started_at, NOW()),
+            heartbeat_at = NOW(),
+            updated_at = NOW()
+        WHERE id = (
+            SELECT id FROM background_jobs
+            WHERE status = 'queued'
+            ORDER BY created_at
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING *
+    """, (worker_id,))
+    job = cur.fetchone()
+    conn.commit()
+    conn.close()
+    return job
+
+def requeue_stale_jobs(stale_seconds: int = None) -> int:
+    """Requeue running jobs whose worker stopped sending heartbeats (crash / restart)"""
+    stale_seconds = stale_seconds or settings.JOB_STALE_SECONDS
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE background_jobs
+        SET status = 'queued', worker_id = NULL, updated_at = NOW()
+        WHERE status = 'running'
+            AND heartbeat_at < NOW() - (%s * INTERVAL '1 second')
+    """, (stale_seconds,))
+    requeued = cur.rowcount
+    cur.execute("""
+        UPDATE background_jobs
+        SET status = 'cancelled', finished_at = NOW(), updated_at = NOW()
+        WHERE status = 'cancelling'
+            AND heartbeat_at < NOW() - (%s * INTERVAL '1 second')
+    """, (stale_seconds,))
+    conn.commit()
+    conn.close()
+    if requeued:
+        print(f"INFO: Requeued {requeued} stale background jobs")
+    return requeued
+
+def _record_progress(job_id: str, page: Dict, success_field: str):
+    """Save page counters + checkpoint, return current job status (for cancellation)"""
+    errors = page["errors"][:MAX_STORED_ERRORS]
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE background_jobs
+        SET processed = processed + %s,
+            succeeded = succeeded + %s,
+            failed = failed + %s,
+            checkpoint = %s,
+            errors = CASE WHEN jsonb_array_length(errors) < %s
+                          THEN errors || %s::jsonb ELSE errors END,
+            heartbeat_at = NOW(),
+            updated_at = NOW()
+        WHERE id = %s
+        RETURNING status
+    """, (
+        page["processed"],
+        page[success_field],
+        page["processed"] - page[success_field],
+        page["last_key"],
+        MAX_STORED_ERRORS,
+        json.dumps(errors),
+        job_id
+    ))
+    status = cur.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return status
+
+def _finish_job(job_id: str, status: str, error: str = None):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE background_jobs
+        SET status = %s,
+            finished_at = NOW(),
+            errors = CASE WHEN %s::text IS NULL THEN errors ELSE errors || jsonb_build_array(%s::text) END,
+            updated_at = NOW()
+        WHERE id = %s
+    """, (status, error, error, job_id))
+    conn.commit()
+    conn.close()
+
+def run_job(job: Dict):
+    """Process a claimed job page by page until done, cancelled or failed"""
+    job_id = str(job["id"])
+    handler = JOB_HANDLERS.get(job["job_type"])
+    if handler is None:
+        _finish_job(job_id, "failed", f"Unknown job type: {job['job_type']}")
+        return
+
+    params = job.get("params") or {}
+    page_size = int(params.get("page_size") or settings.JOB_PAGE_SIZE)
+    checkpoint = job.get("checkpoint")
+
+    try:
+        if job.get("total") is None:
+            conn = get_db()
+            cur = conn.cursor()
+            cur.execute("UPDATE background_jobs SET total = %s WHERE id = %s",
+                        (handler["count"](), job_id))
+            conn.commit()
+            conn.close()
+
+        while not _stop_event.is_set():
+            page = handler["run_page"](after_key=checkpoint, limit=page_size)
+            if page["processed"] == 0:
+                _finish_job(job_id, "completed")
+                print(f"INFO: Job {job_id} ({job['job_type']}) completed")
+                return
+
+            checkpoint = page["last_key"]
+            status = _record_progress(job_id, page, handler["success_field"])
+            if status == "cancelling":
+                _finish_job(job_id, "cancelled")
+                print(f"INFO: Job {job_id} cancelled at checkpoint {checkpoint}")
+                return
+
+        # Worker shutting down: leave the job resumable from its checkpoint
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE background_jobs SET status = 'queued', worker_id = NULL, updated_at = NOW()
+            WHERE id = %s AND status = 'running'
+        """, (job_id,))
+        conn.commit()
+        conn.close()
+
+    except Exception as e:
+        print(f"ERROR: Job {job_id} failed: {e}")
+        _finish_job(job_id, "failed", str(e)[:200])
+
+def worker_loop(worker_id: str, poll_interval: float = None):
+    poll_interval = poll_interval or settings.JOB_POLL_INTERVAL
+    print(f"INFO: Background job worker {worker_id} started")
+    while not _stop_event.is_set():
+        try:
+            job = claim_next_job(worker_id)
+            if job is None:
+                _stop_event.wait(poll_interval)
+                continue
+            print(f"INFO: Worker {worker_id} picked job {job['id']} ({job['job_type']})")
+            run_job(job)
+        except Exception as e:
+            print(f"ERROR: Worker {worker_id} loop error: {e}")
+            _stop_event.wait(poll_interval)
+
+def start_workers(count: int = None):
+    """Start in-process worker threads (called on API startup)"""
+    count = settings.JOB_WORKERS if count is None else count
+    if count <= 0 or _worker_threads:
+        return
+    _stop_event.clear()
+    try:
+        requeue_stale_jobs()
+    except Exception as e:
+        print(f"WARNING: Could not requeue stale jobs: {e}")
+    for i in range(count):
+        worker_id = f"{socket.gethostname()}-{os.getpid()}-{i}"
+        t = threading.Thread(target=worker_loop, args=(worker_id,), daemon=True)
+        t.start()
+        _worker_threads.append(t)
+
+def stop_workers():
+    _stop_event.set()
+    for t in _worker_threads:
+        t.join(timeout=5)
+    _worker_threads.clear()
+
+# ================================================================================================
+# API ENDPOINTS
+# ================================================================================================
+
+@router.post("/jobs/{job_type}", tags=["Jobsapi"])
+def create_job(job_type: str, page_size: Optional[int] = None):
+    """
+    🆕 Tạo job chạy nền (classify_products, classify_materials, embed_products, embed_materials)
+    """
+    if job_type not in JOB_HANDLERS:
+        raise HTTPException(status_code=400, detail=f"Unknown job type. Available: {', '.join(JOB_HANDLERS)}")
+    params = {"page_size": page_size} if page_size else {}
+    job_id = enqueue_job(job_type, params)
+    return {"message": f"✅ Đã tạo job {job_type}", "job_id": job_id, "status": "queued"}
+
+@router.get("/jobs", tags=["Jobsapi"])
+def list_jobs(status: Optional[str] = None, limit: int = 20):
+    conn = get_db()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""
+        SELECT id, job_type, status, total, processed, succeeded, failed, checkpoint,
+               created_at, started_at, finished_at
+        FROM background_jobs
+        WHERE (%s::text IS NULL OR status = %s)
+        ORDER BY created_at DESC
+        LIMIT %s
+    """, (status, status, limit))
+    jobs = cur.fetchall()
+    conn.close()
+    return {"jobs": jobs}
+
+@router.get("/jobs/{job_id}", tags=["Jobsapi"])
+def get_job_status(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    total = job.get("total") or 0
+    job["progress"] = round(min(1.0, job["processed"] / total), 4) if total else None
+    return job
+
+@router.post("/jobs/{job_id}/cancel", tags=["Jobsapi"])
+def cancel_job(job_id: str):
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE background_jobs
+        SET status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE 'cancelling' END,
+            finished_at = CASE WHEN status = 'queued' THEN NOW() ELSE finished_at END,
+            updated_at = NOW()
+        WHERE id = %s AND status IN ('queued', 'running')
+        RETURNING status
+    """, (job_id,))
+    row = cur.fetchone()
+    conn.commit()
+    conn.close()
+    if not row:
+        raise HTTPException(status_code=409, detail="Job is not queued or running")
+    return {"job_id": job_id, "status": row[0]}
+
+@router.post("/jobs/{job_id}/resume", tags=["Jobsapi"])
+def resume_job(job_id: str):
+    """Requeue a cancelled/failed job; it continues from its saved checkpoint"""
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE background_jobs
+        SET status = 'queued', worker_id = NULL, finished_at = NULL, updated_at = NOW()
+        WHERE id = %s AND status IN ('cancelled', 'failed')
+        RETURNING checkpoint
+    """, (job_id,))
+    row = cur.fetchone()
+    conn.commit()
+    conn.close()
+    if not row:
+        raise HTTPException(status_code=409, detail="Only cancelled or failed jobs can be resumed")
+    return {"job_id": job_id, "status": "queued", "checkpoint": row[0]}
+
+if __name__ == "__main__":
+    # Standalone worker process: python -m jobsapi.jobs --workers 2
+    parser = argparse.ArgumentParser(description="Background job worker")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    requeue_stale_jobs()
+    threads = []
+    for i in range(args.workers):
+        worker_id = f"{socket.gethostname()}-{os.getpid()}-{i}"
+        t = threading.Thread(target=worker_loop, args=(worker_id,), daemon=True)
+        t.start()
+        threads.append(t)
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("INFO: Stopping workers, running jobs will be requeued from their checkpoint...")
+        _stop_event.set()
+        for t in threads:
+            t.join()
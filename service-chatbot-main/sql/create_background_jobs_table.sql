@@ -0,0 +1,31 @@
+-- Migration script to create background_jobs table
+-- Run this in your PostgreSQL database (vector DB)
+
+CREATE TABLE IF NOT EXISTS background_jobs (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    
+    job_type TEXT NOT NULL,               -- 'classify_products', 'classify_materials', 'embed_products', 'embed_materials'
+    status TEXT NOT NULL DEFAULT 'queued', -- 'queued', 'running', 'cancelling', 'cancelled', 'completed', 'failed'
+    params JSONB NOT NULL DEFAULT '{}',
+    
+    total INTEGER,                        -- số dòng cần xử lý lúc bắt đầu
+    processed INTEGER NOT NULL DEFAULT 0,
+    succeeded INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    checkpoint TEXT,                      -- key cuối cùng đã xử lý (headcode / id_sap)
+    errors JSONB NOT NULL DEFAULT '[]',
+    
+    worker_id TEXT,
+    created_at TIMESTAMP DEFAULT NOW(),
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    heartbeat_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Index for claiming queued jobs
+CREATE INDEX IF NOT EXISTS idx_background_jobs_status_created 
+ON background_jobs(status, created_at);
+
+CREATE INDEX IF NOT EXISTS idx_background_jobs_type 
+ON background_jobs(job_type);
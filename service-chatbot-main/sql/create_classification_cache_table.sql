@@ -0,0 +1,16 @@
+-- Migration script to create classification_cache table
+-- Run this in your PostgreSQL database (vector DB)
+-- Kết quả phân loại Gemini theo tên đã chuẩn hoá, dùng chung cho mọi bảng / mọi lần chạy
+
+CREATE TABLE IF NOT EXISTS classification_cache (
+    kind TEXT NOT NULL,                   -- 'product' | 'material'
+    name_key TEXT NOT NULL,               -- tên đã chuẩn hoá (lowercase, bỏ dấu câu, gộp khoảng trắng)
+    result JSONB NOT NULL,                -- {"material_group": "...", "material_subgroup": "..."} / {"category": ...}
+    name_embedding VECTOR,                -- chỉ có khi bật CLASSIFY_CACHE_SIMILARITY_THRESHOLD
+    hits INTEGER DEFAULT 0,
+    
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    
+    PRIMARY KEY (kind, name_key)
+);
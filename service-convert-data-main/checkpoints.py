@@ -0,0 +1,96 @@
+from typing import Dict, Optional
+
+# ================================================================================================
+# JOB CHECKPOINTS (table: job_checkpoints, in VECTOR_DB)
+# ================================================================================================
+# Mỗi job (sync / embedding / classify) lưu 1 dòng: giá trị tiến độ cuối cùng
+# (watermark updatedAt hoặc khoá cuối đã xử lý), số dòng đã xử lý và trạng thái.
+# Giá trị được lưu dạng TEXT; câu query so sánh để Postgres tự cast theo kiểu cột.
+
+def ensure_checkpoint_table(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS job_checkpoints (
+                job_name TEXT PRIMARY KEY,
+                last_value TEXT,
+                rows_done BIGINT DEFAULT 0,
+                status TEXT,
+                started_at TIMESTAMPTZ,
+                updated_at TIMESTAMPTZ DEFAULT NOW()
+            )
+        """)
+    conn.commit()
+
+def get_checkpoint(conn, job_name: str) -> Optional[Dict]:
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT last_value, rows_done, status, started_at, updated_at FROM job_checkpoints WHERE job_name = %s",
+            (job_name,)
+        )
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        "last_value": row[0],
+        "rows_done": row[1] or 0,
+        "status": row[2],
+        "started_at": row[3],
+        "updated_at": row[4],
+    }
+
+def save_checkpoint(conn, job_name: str, last_value=None, rows_done: Optional[int] = None,
+                    status: Optional[str] = None, commit: bool = True):
+    """
+    Upsert checkpoint; tham số None giữ nguyên giá trị cũ.
+    commit=False để ghi chung transaction với batch dữ liệu (checkpoint và dữ liệu cùng commit).
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO job_checkpoints (job_name, last_value, rows_done, status, started_at, updated_at)
+            VALUES (%s, %s, COALESCE(%s, 0), %s, CASE WHEN %s = 'running' THEN NOW() END, NOW())
+            ON CONFLICT (job_name) DO UPDATE SET
+                last_value = COALESCE(EXCLUDED.last_value, job_checkpoints.last_value),
+                rows_done = COALESCE(%s, job_checkpoints.rows_done),
+                status = COALESCE(EXCLUDED.status, job_checkpoints.status),
+                started_at = CASE WHEN %s = 'running' AND job_checkpoints.status IS DISTINCT FROM 'running'
+                                  THEN NOW() ELSE job_checkpoints.started_at END,
+                updated_at = NOW()
+        """, (
+            job_name,
+            None if last_value is None else str(last_value),
+            rows_done,
+            status,
+            status,
+            rows_done,
+            status,
+        ))
+    if commit:
+        conn.commit()
+
+def reset_checkpoint(conn, job_name: str):
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM job_checkpoints WHERE job_name = %s", (job_name,))
+    conn.commit()
+
+def get_resume_value(conn, job_name: str, resume: bool = True):
+    """Giá trị để chạy tiếp: last_value của lần chạy chưa completed, ngược lại None (chạy từ đầu)"""
+    if not resume:
+        return None
+    checkpoint = get_checkpoint(conn, job_name)
+    if not checkpoint or checkpoint["status"] == "completed":
+        return None
+    return checkpoint["last_value"]
+
+def ensure_keyset_index(conn, table_name: str, key_column: str, where_sql: str = "", suffix: str = "keyset"):
+    """
+    Index trên cột khoá cho keyset pagination (WHERE key > last ORDER BY key LIMIT n).
+    where_sql: điều kiện partial index (vd. các dòng chưa có embedding) để mỗi trang chỉ seek
+    qua các dòng còn cần xử lý, không phải lọc lại những dòng đã xong.
+    """
+    index_name = f"{table_name}_{key_column}_{suffix}_idx".lower()[:63]
+    with conn.cursor() as cur:
+        cur.execute(
+            f'CREATE INDEX IF NOT EXISTS "{index_name}" ON public."{table_name}" ("{key_column}")'
+            + (f" WHERE {where_sql}" if where_sql else "")
+        )
+    conn.commit()
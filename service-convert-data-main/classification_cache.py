@@ -0,0 +1,281 @@
+import json
+import re
+import threading
+import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from psycopg2.extras import execute_values
+
+# ================================================================================================
+# CLASSIFICATION MEMO STORE (table: classification_cache)
+# ================================================================================================
+# service-chatbot-main/chatapi and service-convert-data-main are deployed separately, so each
+# ships this module; keep both copies byte-identical (checked by tests/test_shared_modules.py).
+
+def normalize_name(name: str) -> str:
+    """Lowercase, NFC, punctuation -> space, collapse spaces ("Gỗ  Sồi, 20mm" == "gỗ sồi 20mm")"""
+    text = unicodedata.normalize("NFC", str(name or "")).lower()
+    text = re.sub(r"[^\w%]+", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+class ClassificationCache:
+    """
+    Classification results keyed by (kind, normalized name), shared by every
+    table and every run. Optionally falls back to the nearest cached name by
+    embedding similarity for near duplicates.
+    """
+
+    def __init__(self, get_conn: Callable, kind: str,
+                 embed_fn: Optional[Callable[[str], List[float]]] = None,
+                 similarity_threshold: float = 0.0, embed_workers: int = 4):
+        self.get_conn = get_conn
+        self.kind = kind
+        self.embed_fn = embed_fn if similarity_threshold > 0 else None
+        self.similarity_threshold = similarity_threshold
+        self.embed_workers = max(1, embed_workers)
+        self._memory: Dict[str, Dict] = {}
+        # Embedding tính lúc tra gần đúng, dùng lại khi put_many lưu kết quả
+        self._vectors: Dict[str, List[float]] = {}
+        # Số lần hit chưa ghi xuống DB, flush_hits() ghi 1 lần sau mỗi run
+        self._pending_hits: Counter = Counter()
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stored": 0}
+
+    def ensure_table(self):
+        conn = self.get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS classification_cache (
+                        kind TEXT NOT NULL,
+                        name_key TEXT NOT NULL,
+                        result JSONB NOT NULL,
+                        name_embedding VECTOR,
+                        hits INTEGER DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT NOW(),
+                        updated_at TIMESTAMP DEFAULT NOW(),
+                        PRIMARY KEY (kind, name_key)
+                    )
+                """)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_many(self, name_keys: List[str]) -> Dict[str, Dict]:
+        """Exact lookup of many normalized names in one read-only query (hits are counted in memory)"""
+        found = {}
+        with self._lock:
+            missing = [k for k in name_keys if k not in self._memory]
+            found.update({k: self._memory[k] for k in name_keys if k in self._memory})
+        if missing:
+            conn = self.get_conn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT name_key, result
+                        FROM classification_cache
+                        WHERE kind = %s AND name_key = ANY(%s)
+                    """, (self.kind, missing))
+                    rows = cur.fetchall()
+            finally:
+                conn.close()
+            with self._lock:
+                for name_key, result in rows:
+                    self._memory[name_key] = result
+                    found[name_key] = result
+        with self._lock:
+            self._pending_hits.update(found.keys())
+        return found
+
+    def flush_hits(self):
+        """Ghi số hit tích luỹ bằng 1 câu UPDATE; lỗi chỉ log (hits là thống kê)"""
+        with self._lock:
+            pending, self._pending_hits = self._pending_hits, Counter()
+        if not pending:
+            return
+        conn = self.get_conn()
+        try:
+            with conn.cursor() as cur:
+                execute_values(cur, """
+                    UPDATE classification_cache AS c
+                    SET hits = c.hits + v.n
+                    FROM (VALUES %s) AS v(kind, name_key, n)
+                    WHERE c.kind = v.kind AND c.name_key = v.name_key
+                """, [(self.kind, k, n) for k, n in pending.items()], template="(%s, %s, %s::int)")
+            conn.commit()
+        except Exception as e:
+            print(f"WARNING: Could not update classification cache hits: {e}")
+            conn.rollback()
+        finally:
+            conn.close()
+
+    def _embed_many(self, name_keys: List[str]) -> Dict[str, List[float]]:
+        """Embed các tên song song (embed_fn nhận 1 text), bỏ qua tên embed lỗi"""
+        with self._lock:
+            vectors = {k: self._vectors[k] for k in name_keys if k in self._vectors}
+        todo = [k for k in name_keys if k not in vectors]
+        if todo:
+            def _embed(name_key):
+                try:
+                    return self.embed_fn(name_key)
+                except Exception as e:
+                    print(f"WARNING: Could not embed {name_key!r}: {e}")
+                    return None
+
+            with ThreadPoolExecutor(max_workers=min(self.embed_workers, len(todo))) as executor:
+                for name_key, vector in zip(todo, executor.map(_embed, todo)):
+                    if vector:
+                        vectors[name_key] = list(vector)
+            with self._lock:
+                self._vectors.update({k: vectors[k] for k in todo if k in vectors})
+        return vectors
+
+    def _forget_vectors(self, name_keys):
+        with self._lock:
+            for name_key in name_keys:
+                self._vectors.pop(name_key, None)
+
+    def find_similar_many(self, name_keys: List[str]) -> Dict[str, Dict]:
+        """
+        Nearest cached name by embedding for every name in one query (only when
+        similarity lookup is enabled). Returns {name_key: result} above the threshold.
+        """
+        if not self.embed_fn or not name_keys:
+            return {}
+        vectors = self._embed_many(name_keys)
+        if not vectors:
+            return {}
+        conn = self.get_conn()
+        try:
+            with conn.cursor() as cur:
+                rows = execute_values(cur, """
+                    SELECT q.name_key, nearest.result, 1 - (nearest.name_embedding <=> q.embedding) AS similarity
+                    FROM (VALUES %s) AS q(kind, name_key, embedding)
+                    CROSS JOIN LATERAL (
+                        SELECT result, name_embedding
+                        FROM classification_cache
+                        WHERE kind = q.kind AND name_embedding IS NOT NULL
+                        ORDER BY name_embedding <=> q.embedding
+                        LIMIT 1
+                    ) AS nearest
+                """, [(self.kind, k, str(v)) for k, v in vectors.items()],
+                    template="(%s, %s, %s::vector)", fetch=True)
+        except Exception as e:
+            print(f"WARNING: Classification cache similarity lookup failed: {e}")
+            conn.rollback()
+            rows = []
+        finally:
+            conn.close()
+        return {
+            name_key: result
+            for name_key, result, similarity in rows
+            if similarity is not None and similarity >= self.similarity_threshold
+        }
+
+    def put_many(self, results: Dict[str, Dict]):
+        """Upsert {name_key: result}"""
+        if not results:
+            return
+        vectors = self._embed_many(list(results)) if self.embed_fn else {}
+        rows = []
+        for name_key, result in results.items():
+            vector = vectors.get(name_key)
+            rows.append((self.kind, name_key, json.dumps(result, ensure_ascii=False),
+                         str(vector) if vector else None))
+        conn = self.get_conn()
+        try:
+            with conn.cursor() as cur:
+                execute_values(cur, """
+                    INSERT INTO classification_cache (kind, name_key, result, name_embedding)
+                    VALUES %s
+                    ON CONFLICT (kind, name_key) DO UPDATE SET
+                        result = EXCLUDED.result,
+                        name_embedding = COALESCE(EXCLUDED.name_embedding, classification_cache.name_embedding),
+                        updated_at = NOW()
+                """, rows, template="(%s, %s, %s::jsonb, %s::vector)")
+            conn.commit()
+        finally:
+            conn.close()
+        self._forget_vectors(results)
+        with self._lock:
+            self._memory.update(results)
+            self.stats["stored"] += len(results)
+
+    def run_cached(self, items: List[Dict], classifier_run: Callable, on_results: Callable,
+                   key: str = "id_sap", name_field: str = "name", result_fields: List[str] = None) -> Dict:
+        """
+        Classify `items` reusing cached results.
+        - items whose normalized name is cached are answered without Gemini
+        - remaining items are grouped by normalized name; one representative per
+          name goes to classifier_run(items, on_results=...) (ConcurrentBatchClassifier.run)
+        - each result is stored and fanned out to every item sharing the name
+        on_results({key: result}) receives results for all items.
+        Returns {"results": {key: result}, "unclassified": [item, ...]}.
+        """
+        groups: Dict[str, List[Dict]] = {}
+        for item in items:
+            # Items without a usable name are classified on their own and never cached
+            name_key = normalize_name(item[name_field]) or f"\0{item[key]}"
+            groups.setdefault(name_key, []).append(item)
+
+        def _fan_out(name_key: str, result: Dict) -> Dict[str, Dict]:
+            fields = result_fields or [f for f in result if f != key]
+            return {
+                str(item[key]): {key: str(item[key]), **{f: result.get(f) for f in fields}}
+                for item in groups.get(name_key, [])
+            }
+
+        all_results: Dict[str, Dict] = {}
+        cacheable = [k for k in groups if not k.startswith("\0")]
+        cached = self.get_many(cacheable)
+        exact_hits = len(cached)
+        similar = self.find_similar_many([k for k in cacheable if k not in cached])
+        cached.update(similar)
+        self._forget_vectors(similar)
+        self.stats["similar_hits"] += len(similar)
+        self.stats["exact_hits"] += exact_hits
+        self.flush_hits()
+
+        hit_results = {}
+        for name_key, result in cached.items():
+            hit_results.update(_fan_out(name_key, result))
+        if hit_results:
+            all_results.update(hit_results)
+            on_results(hit_results)
+
+        representatives = {}
+        for name_key, group in groups.items():
+            if name_key not in cached:
+                representatives[str(group[0][key])] = name_key
+        self.stats["misses"] += len(representatives)
+        if not representatives:
+            return {"results": all_results, "unclassified": []}
+
+        def _store_and_fan_out(results: Dict[str, Dict]):
+            to_store = {}
+            expanded = {}
+            for rep_key, result in results.items():
+                name_key = representatives.get(rep_key)
+                if name_key is None:
+                    continue
+                if not name_key.startswith("\0"):
+                    to_store[name_key] = {f: v for f, v in result.items() if f not in (key, "idx")}
+                expanded.update(_fan_out(name_key, result))
+            try:
+                self.put_many(to_store)
+            except Exception as e:
+                print(f"WARNING: Could not store classification cache: {e}")
+            all_results.update(expanded)
+            on_results(expanded)
+
+        rep_items = [groups[name_key][0] for name_key in representatives.values()]
+        outcome = classifier_run(rep_items, on_results=_store_and_fan_out)
+        self._forget_vectors(representatives.values())
+
+        unclassified = []
+        for item in outcome["unclassified"]:
+            unclassified.extend(groups.get(representatives.get(str(item[key]), ""), [item]))
+        print(f"INFO: Classification cache ({self.kind}): {self.stats}")
+        return {"results": all_results, "unclassified": unclassified}
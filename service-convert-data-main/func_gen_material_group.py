@@ -2,7 +2,6 @@
 import json
 import logging
 import os
-import time
 import uuid
 from typing import Dict, List
 
@@ -10,6 +9,8 @@ import google.generativeai as genai
 import psycopg2
 from fastapi import APIRouter
 
+from rate_limiter import gemini_limiter
+
 router = APIRouter()
 # ================================================================================================
 # FUNCTION DEFINITIONS
@@ -22,10 +23,11 @@ genai.configure(
 )
 
 # =================================================
-def batch_classify_materials(materials_batch: List[Dict]) -> List[Dict]:
+def classify_materials_by_id(materials_batch: List[Dict]) -> Dict[str, Dict]:
+    """Phân loại 1 batch, trả về {id_sap: kết quả} chỉ cho các dòng Gemini trả về hợp lệ."""
 
     if not materials_batch:
-        return []
+        return {}
 
     model = genai.GenerativeModel("gemini-2.5-flash-lite")
 
@@ -49,6 +51,7 @@ def batch_classify_materials(materials_batch: List[Dict]) -> List[Dict]:
             Rules:
             - material_group ∈ [Gỗ, Da, Vải, Đá, Kim loại, Kính, Nhựa, Sơn, Keo, Phụ kiện, Khác]
             - material_subgroup: short Vietnamese noun phrase
+            - keep the exact id_sap of every input line
 
             JSON format:
             [
@@ -62,99 +65,91 @@ def batch_classify_materials(materials_batch: List[Dict]) -> List[Dict]:
 
     response_text = call_gemini_with_retry(model, prompt)
 
-    # ================= FALLBACK =================
-    fallback = {
-        m["id_sap"]: {
-            "id_sap": m["id_sap"],
-            "material_group": "Not classified",
-            "material_subgroup": "Not classified",
-            "idx": m.get("idx", 0),
-        }
-        for m in materials_batch
-    }
-
     if not response_text or not response_text.strip():
         print("WARNING: Gemini returned empty response")
-        
-        return list(fallback.values())
+        return {}
+
+    idx_by_id = {str(m["id_sap"]): m.get("idx", 0) for m in materials_batch}
 
     try:
         clean = response_text.strip()
 
         if "```" in clean:
             clean = clean.split("```")[1].strip()
+            if clean.startswith("json"):
+                clean = clean[4:].strip()
 
         results = json.loads(clean)
-
-        for r in results:
-            try:
-                id_sap_val = r.get("id_sap")
-                if not id_sap_val:
-                    logging.warning("Bỏ qua kết quả Gemini không có id_sap: %s", r)
-                    continue
-
-                group_val = r.get("material_group") or fallback[id_sap_val]["material_group"]
-                subgroup_val = r.get("material_subgroup") or fallback[id_sap_val]["material_subgroup"]
-                idx_val = r.get("idx", fallback[id_sap_val].get("idx", 0))
-
-                fallback[id_sap_val] = {
-                    "id_sap": id_sap_val,
-                    "material_group": group_val,
-                    "material_subgroup": subgroup_val,
-                    "idx": idx_val,
-                }
-            except Exception as item_e:
-                # Chỉ loại trừ phần tử lỗi, giữ các phần tử còn lại
-                logging.error(
-                    "Lỗi xử lý một phần tử kết quả Gemini, bỏ qua phần tử này. raw=%s, error=%s",
-                    r,
-                    item_e,
-                )
-                continue
-
-        return list(fallback.values())
-
     except Exception as e:
         # Không để lỗi parse JSON làm dừng pipeline, chỉ log lại batch bị lỗi
         logging.error(
-            "Gemini trả về JSON không hợp lệ, dùng fallback. Batch size=%s, id_sap=%s, error=%s",
+            "Gemini trả về JSON không hợp lệ. Batch size=%s, id_sap=%s, error=%s",
             len(materials_batch),
-            [m.get("id_sap") for m in materials_batch],
+            list(idx_by_id),
             e,
         )
-        return list(fallback.values())
+        return {}
+
+    matched = {}
+    for r in results if isinstance(results, list) else []:
+        if not isinstance(r, dict):
+            continue
+        id_sap_val = str(r.get("id_sap") or "").strip()
+        if id_sap_val not in idx_by_id:
+            logging.warning("Bỏ qua kết quả Gemini có id_sap không thuộc batch: %s", r)
+            continue
+        if not r.get("material_group") or not r.get("material_subgroup"):
+            continue
+
+        matched[id_sap_val] = {
+            "id_sap": id_sap_val,
+            "material_group": r["material_group"],
+            "material_subgroup": r["material_subgroup"],
+            "idx": idx_by_id[id_sap_val],
+        }
+
+    return matched
 
 # =================================================
-def call_gemini_with_retry(model, prompt, max_retries=3, timeout=20):
-    import signal
+def batch_classify_materials(materials_batch: List[Dict]) -> List[Dict]:
+    """Giữ tương thích: trả về đủ mọi dòng, dòng thiếu dùng fallback "Not classified"."""
+    results = classify_materials_by_id(materials_batch)
 
-    def timeout_handler(signum, frame):
-        raise TimeoutError("Gemini API timeout")
+    return [
+        results.get(str(m["id_sap"])) or {
+            "id_sap": m["id_sap"],
+            "material_group": "Not classified",
+            "material_subgroup": "Not classified",
+            "idx": m.get("idx", 0),
+        }
+        for m in materials_batch
+    ]
 
+# =================================================
+def call_gemini_with_retry(model, prompt, max_retries=3, timeout=20):
+    """Gọi Gemini qua rate limiter dùng chung (thay cho sleep cố định)."""
     for attempt in range(max_retries):
+        gemini_limiter.acquire()
         try:
-            if hasattr(signal, "SIGALRM"):
-                signal.signal(signal.SIGALRM, timeout_handler)
-                signal.alarm(timeout)
-
             response = model.generate_content(
                 prompt,
                 request_options={"timeout": timeout}
             )
 
-            if hasattr(signal, "SIGALRM"):
-                signal.alarm(0)
-
             if response and response.text and response.text.strip():
+                gemini_limiter.on_success()
                 return response.text
 
+            gemini_limiter.on_error()
             print("WARNING: Gemini empty response, retrying...")
-            time.sleep(2)
 
-        except TimeoutError:
-            print(f"WARNING: Gemini timeout on attempt {attempt + 1}")
         except Exception as e:
+            text = str(e)
+            if type(e).__name__ == "ResourceExhausted" or "429" in text or "quota" in text.lower():
+                gemini_limiter.on_throttle()
+                print(f"INFO: Quota exceeded (attempt {attempt + 1}). Rate giảm còn {gemini_limiter.rate:.2f} req/s")
+                continue
+            gemini_limiter.on_error()
             print(f"ERROR Gemini: {e}")
-            time.sleep(2)
 
-    return None
\ No newline at end of file
+    return None
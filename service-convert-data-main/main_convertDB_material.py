@@ -1,5 +1,6 @@
 import logging
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 from connectDB import (
     get_main_db_connection,
     get_vector_db_connection,
@@ -7,6 +8,14 @@ from connectDB import (
 )
 
 from logServer import setup_logging
+from checkpoints import (
+    ensure_checkpoint_table,
+    ensure_keyset_index,
+    get_checkpoint,
+    get_resume_value,
+    reset_checkpoint,
+    save_checkpoint,
+)
 from func_gen_material_group import batch_classify_materials
 
 _MAIN_DB_TUNNEL = None
@@ -201,24 +210,44 @@ def copy_data_to_vector_db_new(
 
 def classify_and_update_material_subgroup(
     table_name="MD_Material_SAP",
-    batch_size=50
+    batch_size=50,
+    resume=True,
 ):
+    """
+    Phân loại Material_Subgroup cho các dòng chưa có, đọc theo keyset
+    ("ID_Material_SAP" > khoá cuối ORDER BY "ID_Material_SAP" LIMIT batch_size)
+    trên partial index của các dòng chưa phân loại. Khoá cuối mỗi batch được lưu vào
+    job_checkpoints cùng transaction; resume=True thì tiếp tục sau khoá đó.
+    """
     conn = get_vector_db_connection()
+    job_name = f"classify_subgroup:{table_name}"
+    pending_sql = "Material_Subgroup IS NULL OR Material_Subgroup = ''"
 
     try:
-        with conn.cursor() as cur:
-            cur.execute(f'''
-                SELECT "ID_Material_SAP", "Des_Material_Sap"
-                FROM "{table_name}"
-                WHERE Material_Subgroup IS NULL
-                    OR Material_Subgroup = ''
-            ''')
-            rows = cur.fetchall()
-
-        logging.info(f"Tổng material cần classify: {len(rows)}")
-
-        for i in range(0, len(rows), batch_size):
-            batch = rows[i:i + batch_size]
+        ensure_checkpoint_table(conn)
+        ensure_keyset_index(conn, table_name, "ID_Material_SAP", pending_sql, suffix="pending_subgroup")
+        last_key = get_resume_value(conn, job_name, resume)
+        if last_key is None:
+            reset_checkpoint(conn, job_name)
+        else:
+            logging.info(f"Tiếp tục classify sau ID_Material_SAP={last_key}")
+        save_checkpoint(conn, job_name, status="running")
+
+        processed = 0
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(f'''
+                    SELECT "ID_Material_SAP", "Des_Material_Sap"
+                    FROM "{table_name}"
+                    WHERE ({pending_sql})
+                        {'AND "ID_Material_SAP" > %s' if last_key is not None else ""}
+                    ORDER BY "ID_Material_SAP"
+                    LIMIT %s
+                ''', (last_key, batch_size) if last_key is not None else (batch_size,))
+                batch = cur.fetchall()
+
+            if not batch:
+                break
 
             materials_batch = [
                 {
@@ -245,12 +274,22 @@ def classify_and_update_material_subgroup(
                             r["ID_Material_SAP"]
                         )
                     )
+                processed += len(batch)
+                last_key = batch[-1][0]
+                save_checkpoint(conn, job_name, last_value=last_key, rows_done=processed, commit=False)
                 conn.commit()
 
             logging.info(
-                f"Đã xử lý {min(i + batch_size, len(rows))}/{len(rows)}"
+                f"Đã xử lý {processed} material (đến ID_Material_SAP={last_key})"
             )
 
+        save_checkpoint(conn, job_name, status="completed")
+
+    except Exception:
+        conn.rollback()
+        save_checkpoint(conn, job_name, status="failed")
+        raise
+
     finally:
         conn.close()
 
@@ -284,95 +323,199 @@ def sync_table_columns_generic(
     target_schema="public",
 
     batch_size=1000,
+    watermark_col=None,
+    job_name=None,
+    full_refresh=False,
 ):
+    """
+    Đồng bộ các cột từ MAIN_DB sang VECTOR_DB theo khoá.
+
+    - watermark_col (vd. "updatedAt"): chỉ lấy dòng có watermark >= checkpoint lần trước;
+      full_refresh=True bỏ qua checkpoint
+    - dòng có watermark NULL chỉ được đồng bộ ở lần chạy full (không checkpoint hoặc full_refresh):
+      nếu lấy chúng ở mọi lần incremental thì bảng có nhiều dòng thiếu updatedAt sẽ thành full sync
+      mỗi ngày. Đánh đổi: thay đổi trên các dòng này chỉ được cập nhật khi chạy full_refresh;
+      lần incremental log số dòng NULL bị bỏ qua để biết khi nào cần chạy full
+    - mỗi batch được ghi vào bảng staging tạm rồi UPDATE ... FROM + INSERT ... WHERE NOT EXISTS
+      (2 câu lệnh cho cả batch thay vì 1-2 câu cho mỗi dòng)
+    - checkpoint (bảng job_checkpoints) được ghi cùng transaction với mỗi batch,
+      nên chạy lại sau lỗi sẽ tiếp tục từ batch cuối đã commit
+    """
     if len(source_columns) != len(target_columns):
         raise ValueError(
             "source_columns và target_columns phải có cùng độ dài"
         )
+    if key_target_col not in target_columns:
+        raise ValueError("key_target_col phải nằm trong target_columns")
+
+    job_name = job_name or f"sync:{source_schema}.{source_table}->{target_schema}.{target_table}"
 
     main_conn = get_main_db_connection()
     vector_conn = get_vector_db_connection()
+    main_cur = None
+    vector_cur = None
 
     try:
+        ensure_checkpoint_table(vector_conn)
+        checkpoint = None if full_refresh else get_checkpoint(vector_conn, job_name)
+        since = checkpoint["last_value"] if (checkpoint and watermark_col) else None
+        save_checkpoint(vector_conn, job_name, status="running")
+
         main_cur = main_conn.cursor(name="sync_cursor")
+        main_cur.itersize = batch_size
         vector_cur = vector_conn.cursor()
 
-        # SELECT source
+        # SELECT source (+ watermark, theo thứ tự watermark để checkpoint tăng dần)
+        select_fields = [sql.Identifier(c) for c in source_columns]
+        where = [sql.SQL("{} IS NOT NULL").format(sql.Identifier(key_source_col))]
+        params = []
+        order = sql.SQL("")
+        if watermark_col:
+            select_fields.append(sql.Identifier(watermark_col))
+            order = sql.SQL("ORDER BY {} NULLS LAST").format(sql.Identifier(watermark_col))
+            if since is not None:
+                where.append(sql.SQL("{} >= %s").format(sql.Identifier(watermark_col)))
+                params.append(since)
+                with main_conn.cursor() as count_cur:
+                    count_cur.execute(
+                        sql.SQL("SELECT count(*) FROM {schema}.{table} WHERE {key} IS NOT NULL AND {wm} IS NULL").format(
+                            schema=sql.Identifier(source_schema),
+                            table=sql.Identifier(source_table),
+                            key=sql.Identifier(key_source_col),
+                            wm=sql.Identifier(watermark_col),
+                        )
+                    )
+                    null_rows = count_cur.fetchone()[0]
+                if null_rows:
+                    logging.warning(
+                        f"Sync {job_name}: bỏ qua {null_rows} dòng {watermark_col} IS NULL "
+                        f"(chỉ đồng bộ khi full_refresh=True)"
+                    )
+
         select_sql = sql.SQL("""
             SELECT {fields}
             FROM {schema}.{table}
-            WHERE {key} IS NOT NULL
+            WHERE {where}
+            {order}
         """).format(
-            fields=sql.SQL(", ").join(map(sql.Identifier, source_columns)),
+            fields=sql.SQL(", ").join(select_fields),
             schema=sql.Identifier(source_schema),
             table=sql.Identifier(source_table),
-            key=sql.Identifier(key_source_col),
+            where=sql.SQL(" AND ").join(where),
+            order=order,
         )
 
-        main_cur.execute(select_sql)
+        logging.info(
+            f"Sync {job_name}: "
+            + (f"incremental từ {watermark_col} >= {since}" if since is not None else "full")
+        )
+        main_cur.execute(select_sql, params)
+
+        # Staging tạm có cùng kiểu cột với bảng đích, tự xoá dữ liệu sau mỗi commit
+        target_fields = sql.SQL(", ").join(map(sql.Identifier, target_columns))
+        vector_cur.execute(sql.SQL("""
+            CREATE TEMP TABLE IF NOT EXISTS _sync_stage ON COMMIT DELETE ROWS AS
+            SELECT {fields} FROM {schema}.{table} WITH NO DATA
+        """).format(
+            fields=target_fields,
+            schema=sql.Identifier(target_schema),
+            table=sql.Identifier(target_table),
+        ))
 
-        # UPDATE SQL
         update_cols = [
             col for col in target_columns
             if col != key_target_col
         ]
 
+        # Dòng trùng khoá trong 1 batch: giữ dòng sau cùng (watermark mới nhất)
+        dedup_sql = sql.SQL("""
+            DELETE FROM _sync_stage s
+            USING _sync_stage d
+            WHERE s.{key} = d.{key} AND s.ctid < d.ctid
+        """).format(key=sql.Identifier(key_target_col))
+
         update_sql = sql.SQL("""
-            UPDATE {schema}.{table}
+            UPDATE {schema}.{table} t
             SET {updates}
-            WHERE {key} = %s
+            FROM _sync_stage s
+            WHERE t.{key} = s.{key}
         """).format(
             schema=sql.Identifier(target_schema),
             table=sql.Identifier(target_table),
             key=sql.Identifier(key_target_col),
             updates=sql.SQL(", ").join(
-                sql.SQL("{} = %s").format(sql.Identifier(col))
+                sql.SQL("{col} = s.{col}").format(col=sql.Identifier(col))
                 for col in update_cols
             ),
         )
 
-        # INSERT SQL
         insert_sql = sql.SQL("""
-            INSERT INTO {schema}.{table}
-                ({fields})
-            VALUES ({placeholders})
+            INSERT INTO {schema}.{table} ({fields})
+            SELECT {s_fields}
+            FROM _sync_stage s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {schema}.{table} t WHERE t.{key} = s.{key}
+            )
         """).format(
             schema=sql.Identifier(target_schema),
             table=sql.Identifier(target_table),
-            fields=sql.SQL(", ").join(map(sql.Identifier, target_columns)),
-            placeholders=sql.SQL(", ").join(
-                sql.Placeholder() * len(target_columns)
+            fields=target_fields,
+            s_fields=sql.SQL(", ").join(
+                sql.SQL("s.{}").format(sql.Identifier(col)) for col in target_columns
             ),
+            key=sql.Identifier(key_target_col),
         )
 
+        stage_insert = sql.SQL("INSERT INTO _sync_stage ({fields}) VALUES %s").format(
+            fields=target_fields
+        ).as_string(vector_conn)
+
         total = 0
+        updated = 0
+        inserted = 0
+        last_wm = since
 
         while True:
             rows = main_cur.fetchmany(batch_size)
             if not rows:
                 break
 
-            for row in rows:
-                data_map = dict(zip(target_columns, row))
-                key_value = data_map[key_target_col]
+            if watermark_col:
+                batch_wm = [r[-1] for r in rows if r[-1] is not None]
+                if batch_wm:
+                    last_wm = max(batch_wm)
+                rows = [r[:-1] for r in rows]
 
-                update_values = [
-                    data_map[col] for col in update_cols
-                ] + [key_value]
+            execute_values(vector_cur, stage_insert, rows, page_size=batch_size)
+            vector_cur.execute(dedup_sql)
+            if update_cols:
+                vector_cur.execute(update_sql)
+                updated += vector_cur.rowcount
+            vector_cur.execute(insert_sql)
+            inserted += vector_cur.rowcount
 
-                vector_cur.execute(update_sql, update_values)
+            total += len(rows)
+            save_checkpoint(vector_conn, job_name, last_value=last_wm, rows_done=total, commit=False)
+            vector_conn.commit()
 
-                if vector_cur.rowcount == 0:
-                    vector_cur.execute(insert_sql, row)
+            logging.info(f"Đã sync {total} records (update {updated}, insert {inserted})")
 
-            vector_conn.commit()
-            total += len(rows)
+        save_checkpoint(vector_conn, job_name, last_value=last_wm, rows_done=total, status="completed")
+        logging.info(f"Sync {job_name} hoàn tất: {total} records, watermark={last_wm}")
 
-            logging.info(f"Đã sync {total} records")
+    except Exception:
+        try:
+            vector_conn.rollback()
+            save_checkpoint(vector_conn, job_name, status="failed")
+        except Exception:
+            logging.exception(f"Không ghi được checkpoint lỗi cho {job_name}")
+        raise
 
     finally:
-        main_cur.close()
-        vector_cur.close()
+        if main_cur is not None:
+            main_cur.close()
+        if vector_cur is not None:
+            vector_cur.close()
         main_conn.close()
         vector_conn.close()
 
@@ -434,6 +577,7 @@ def main_sync_data():
         key_target_col="ID_Material_SAP",
         key_source_col="idMaterial",
         batch_size=1000,
+        watermark_col="updatedAt",
     )
 
 # ----------------------------------------------------------------------------------------------------
@@ -1,14 +1,25 @@
 import json
 import logging
 import os
+import re
 import time
-from typing import Any, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
 import requests
 import torch
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from requests.adapters import HTTPAdapter
 from logServer import setup_logging
 from connectDB import get_vector_db_connection
+from checkpoints import (
+    ensure_checkpoint_table,
+    ensure_keyset_index,
+    get_resume_value,
+    reset_checkpoint,
+    save_checkpoint,
+)
 
 try:
     import tiktoken
@@ -22,6 +33,117 @@ QWEN_API_BASE = os.getenv("QWEN_API_BASE", "http://localhost:11434")  # ví dụ
 # Kiểu lưu embedding trong DB: "vector" (pgvector) hoặc "jsonb"
 EMBEDDING_STORAGE_TYPE = os.getenv("EMBEDDING_STORAGE_TYPE", "vector").lower()
 
+# Dump embedding ra file để debug (mặc định tắt); khi bật ghi .npz: ids + ma trận float32
+QWEN_EMBED_DUMP = os.getenv("QWEN_EMBED_DUMP", "false").strip().lower() == "true"
+
+# Số text mỗi request /api/embed và số request chạy song song tới Ollama
+QWEN_EMBED_BATCH_SIZE = int(os.getenv("QWEN_EMBED_BATCH_SIZE", "32"))
+QWEN_EMBED_CONCURRENCY = int(os.getenv("QWEN_EMBED_CONCURRENCY", "4"))
+
+
+# =========================
+# 1. Qwen embedding client (HTTP session dùng chung, batch nhiều input)
+# =========================
+
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=max(4, QWEN_EMBED_CONCURRENCY)))
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(4, QWEN_EMBED_CONCURRENCY)))
+
+
+def _call_qwen_batch(texts: List[str]) -> List[List[float]]:
+    """1 request /api/embed cho nhiều text"""
+    payload = {
+        "model": QWEN_EMBED_MODEL,
+        "input": texts,
+    }
+    resp = _session.post(f"{QWEN_API_BASE}/api/embed", json=payload, timeout=300)
+    resp.raise_for_status()
+    embs = resp.json().get("embeddings")
+    if not isinstance(embs, list) or len(embs) != len(texts):
+        raise ValueError(f"Qwen /api/embed trả về {len(embs or [])} embeddings cho {len(texts)} input")
+    return embs
+
+
+def _embed_chunk(texts: List[str]) -> Dict[str, Optional[List[float]]]:
+    # Gọi lại từng text cũng qua /api/embed: /api/embeddings trả vector chưa chuẩn hoá L2,
+    # trộn 2 endpoint thì cùng 1 cột có vector khác thang đo
+    try:
+        return dict(zip(texts, _call_qwen_batch(texts)))
+    except Exception as e:
+        logging.warning(f"Batch embedding lỗi ({e}), gọi lại từng text")
+    result: Dict[str, Optional[List[float]]] = {}
+    for t in texts:
+        try:
+            result[t] = _call_qwen_batch([t])[0]
+        except Exception as e:
+            logging.warning(f"Embedding lỗi cho text ({len(t)} ký tự): {str(e)[:100]}")
+            result[t] = None
+    return result
+
+
+def embed_texts(
+    texts: List[str],
+    batch_size: int = QWEN_EMBED_BATCH_SIZE,
+    concurrency: int = QWEN_EMBED_CONCURRENCY,
+) -> Dict[str, Optional[List[float]]]:
+    """Embed nhiều text: bỏ trùng, chia batch, tối đa `concurrency` request song song.
+
+    Trả về {text: embedding}; text embed lỗi có giá trị None.
+    """
+    unique = [t for t in dict.fromkeys(texts) if t]
+    chunks = [unique[i:i + batch_size] for i in range(0, len(unique), max(1, batch_size))]
+    result: Dict[str, Optional[List[float]]] = {}
+    if not chunks:
+        return result
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(chunks)))) as pool:
+        for part in pool.map(_embed_chunk, chunks):
+            result.update(part)
+    return result
+
+
+def material_texts(id_sap: Any, name_text: str, description_text: str) -> Tuple[str, str]:
+    """(name_text, description_text) không rỗng: text rỗng lấy text còn lại hoặc id_sap.
+
+    embed_texts bỏ qua text rỗng; vật liệu không có tên vẫn phải có embedding, nếu không sẽ
+    bị báo lỗi và nằm lại trong danh sách chưa embed.
+    """
+    name_text = name_text or description_text or str(id_sap)
+    return name_text, description_text or name_text
+
+
+def _embedding_param(emb: List[float]):
+    """Tham số embedding cho execute_values: list float -> ARRAY (cast sang vector ở SQL) hoặc Json"""
+    if EMBEDDING_STORAGE_TYPE == "vector":
+        return [float(x) for x in emb]
+    return Json(emb)
+
+
+def bulk_update_embeddings(cur, table_name: str, rows: List[Tuple[Any, List[float], List[float]]],
+                           page_size: int = 500, set_updated_at: bool = True):
+    """UPDATE name_embedding, description_embedding cho nhiều id_sap bằng 1 câu lệnh mỗi page"""
+    if not rows:
+        return
+    if EMBEDDING_STORAGE_TYPE == "vector":
+        template = "(%s, %s::real[], %s::real[])"
+        cast = "vector"
+    else:
+        template = "(%s, %s::jsonb, %s::jsonb)"
+        cast = "jsonb"
+    execute_values(
+        cur,
+        f"""
+        UPDATE public."{table_name}" AS t
+        SET name_embedding = v.name_embedding::{cast},
+            description_embedding = v.description_embedding::{cast}
+            {", updated_at = NOW()" if set_updated_at else ""}
+        FROM (VALUES %s) AS v(id_sap, name_embedding, description_embedding)
+        WHERE t.id_sap = v.id_sap
+        """,
+        [(id_sap, _embedding_param(ne), _embedding_param(de)) for id_sap, ne, de in rows],
+        template=template,
+        page_size=page_size,
+    )
+
 
 # =========================
 # 2. Helper: token counting
@@ -175,6 +297,31 @@ def ensure_table_embedding_columns(table_name: str):
     finally:
         conn.close()
 
+def dump_embeddings_npz(table_name: str, output_dir: str,
+                        rows: List[Tuple[Any, List[float], List[float]]]) -> str:
+    """Ghi embedding dạng nhị phân: id_sap, name_embedding, description_embedding (float32).
+    Tên file gồm id_sap đầu/cuối của trang để các trang ghi trong cùng một giây không đè nhau.
+
+    Đọc lại: data = np.load(path); data["id_sap"], data["name_embedding"][i], ...
+    """
+    if not rows:
+        return ""
+    os.makedirs(output_dir, exist_ok=True)
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    key_range = "-".join(re.sub(r"[^\w.-]", "_", str(r[0])) for r in (rows[0], rows[-1]))
+    outfile = os.path.join(
+        output_dir,
+        f"{table_name}_qwen_embeddings_{timestamp}_{key_range}.npz",
+    )
+    np.savez(
+        outfile,
+        id_sap=np.asarray([str(r[0]) for r in rows]),
+        name_embedding=np.asarray([r[1] for r in rows], dtype=np.float32),
+        description_embedding=np.asarray([r[2] for r in rows], dtype=np.float32),
+    )
+    return outfile
+
+
 # =========================
 # 7. Qwen embedding + logging + DB save
 # =========================
@@ -183,130 +330,154 @@ def embed_with_qwen(
     texts: List[str],
     raw_rows: List[Any],
     output_dir: str,
+    dump: Optional[bool] = None,
 ) -> Tuple[List[List[float]], float, int, str]:
-    
-    if True:
-        if not raw_rows:
-            return [], 0.0, 0, ""
-
-        os.makedirs(output_dir, exist_ok=True)
-        timestamp = time.strftime("%Y%m%d_%H%M%S")
-        outfile = os.path.join(
-            output_dir,
-            f"{table_name}_qwen_embeddings_{timestamp}.jsonl",
-        )
+    """Embed name / description của các dòng materials_qwen (batch + song song) và UPDATE 1 lần.
 
-        url = f"{QWEN_API_BASE}/api/embeddings"
-
-        def _call_qwen(text: str) -> List[float]:
-            payload = {
-                "model": QWEN_EMBED_MODEL,
-                "prompt": text,
-            }
-            resp = requests.post(url, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-            emb = data.get("embedding") or data.get("data", [{}])[0].get("embedding")
-            if emb is None:
-                raise ValueError(f"Qwen API response không có 'embedding': {data}")
-            return emb
-
-        start = time.time()
-        description_embeddings: List[List[float]] = []
-        all_texts_for_token_est: List[str] = []
+    Mỗi lần gọi xử lý 1 trang dòng và commit; dùng embed_table_with_qwen để chạy cả bảng
+    theo keyset có checkpoint. dump (mặc định QWEN_EMBED_DUMP) ghi thêm file .npz để debug;
+    outfile trả về rỗng khi không dump.
+    """
+    if not raw_rows:
+        return [], 0.0, 0, ""
 
-        conn = get_vector_db_connection()
-        try:
-            with conn.cursor() as cur, open(outfile, "w", encoding="utf-8") as f:
-                for idx, row in enumerate(raw_rows):
-                    # Lấy các trường cần thiết từ dòng
-                    material_name = (row.get("material_name") or "").strip()
-                    material_subgroup = (row.get("material_subgroup") or "").strip()
-                    material_group = (row.get("material_group") or "").strip()
-                    id_sap = row.get("id_sap")
-
-                    if id_sap is None:
-                        logging.warning(
-                            "materials_qwen row index %s không có id_sap, bỏ qua cập nhật.",
-                            idx,
-                        )
-                        continue
-
-                    name_text = material_name
-                    desc_parts = [p for p in [material_subgroup, material_group, material_name] if p]
-                    description_text = " ".join(desc_parts)
-
-                    # Gọi Qwen cho 2 đoạn text
-                    name_emb = _call_qwen(name_text)
-                    desc_emb = _call_qwen(description_text)
-
-                    description_embeddings.append(desc_emb)
-                    all_texts_for_token_est.append(name_text + " " + description_text)
-
-                    # Ghi log ra JSONL để tiện debug
-                    record = {
-                        "row_index": idx,
-                        "id_sap": id_sap,
-                        "material_name": material_name,
-                        "material_subgroup": material_subgroup,
-                        "material_group": material_group,
-                        "name_embedding": to_jsonable(name_emb),
-                        "description_embedding": to_jsonable(desc_emb),
-                    }
-                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
-
-                    # Cập nhật trực tiếp vào bảng materials_qwen
-                    if EMBEDDING_STORAGE_TYPE == "vector":
-                        name_emb_str = "[" + ",".join(str(float(x)) for x in name_emb) + "]"
-                        desc_emb_str = "[" + ",".join(str(float(x)) for x in desc_emb) + "]"
-                        update_sql = (
-                            "UPDATE public.\"materials_qwen\" "
-                            "SET name_embedding = %s::vector, "
-                            "    description_embedding = %s::vector "
-                            "WHERE id_sap = %s"
-                        )
-                        params = (name_emb_str, desc_emb_str, id_sap)
-                    else:
-                        update_sql = (
-                            "UPDATE public.\"materials_qwen\" "
-                            "SET name_embedding = %s::jsonb, "
-                            "    description_embedding = %s::jsonb "
-                            "WHERE id_sap = %s"
-                        )
-                        params = (
-                            json.dumps(name_emb),
-                            json.dumps(desc_emb),
-                            id_sap,
-                        )
-
-                    cur.execute(update_sql, params)
+    start = time.time()
+    items = []
+    for idx, row in enumerate(raw_rows):
+        # Lấy các trường cần thiết từ dòng
+        material_name = (row.get("material_name") or "").strip()
+        material_subgroup = (row.get("material_subgroup") or "").strip()
+        material_group = (row.get("material_group") or "").strip()
+        id_sap = row.get("id_sap")
+
+        if id_sap is None:
+            logging.warning(
+                "materials_qwen row index %s không có id_sap, bỏ qua cập nhật.",
+                idx,
+            )
+            continue
 
-            conn.commit()
-        finally:
-            conn.close()
+        desc_parts = [p for p in [material_subgroup, material_group, material_name] if p]
+        name_text, description_text = material_texts(id_sap, material_name, " ".join(desc_parts))
+        items.append((idx, id_sap, material_name, material_subgroup, material_group, name_text, description_text))
+
+    # Gọi Qwen cho mọi text của trang (bỏ trùng, batch /api/embed, song song)
+    vectors = embed_texts([t for it in items for t in (it[5], it[6])])
 
-        elapsed = time.time() - start
+    description_embeddings: List[List[float]] = []
+    all_texts_for_token_est: List[str] = []
+    updates = []
+    for idx, id_sap, material_name, material_subgroup, material_group, name_text, description_text in items:
+        name_emb = vectors.get(name_text)
+        desc_emb = vectors.get(description_text)
+        if name_emb is None or desc_emb is None:
+            logging.warning("Không embed được id_sap=%s, bỏ qua cập nhật.", id_sap)
+            continue
+
+        description_embeddings.append(desc_emb)
+        all_texts_for_token_est.append(name_text + " " + description_text)
+        updates.append((id_sap, name_emb, desc_emb))
+
+    if dump is None:
+        dump = QWEN_EMBED_DUMP
+    outfile = ""
+    if dump:
+        outfile = dump_embeddings_npz(table_name, output_dir, updates)
+
+    # Cập nhật trực tiếp vào bảng materials_qwen (1 câu UPDATE ... FROM VALUES mỗi page)
+    conn = get_vector_db_connection()
+    try:
+        with conn.cursor() as cur:
+            bulk_update_embeddings(cur, "materials_qwen", updates, set_updated_at=False)
+        conn.commit()
+    finally:
+        conn.close()
 
-        token_est = estimate_tokens(all_texts_for_token_est)
+    elapsed = time.time() - start
 
-        logging.info(
-            "Qwen embeddings (materials_qwen) done: %d rows, time=%.2fs, tokens≈%d, output=%s",
-            len(description_embeddings),
-            elapsed,
-            token_est,
-            outfile,
-        )
+    token_est = estimate_tokens(all_texts_for_token_est)
 
-        # Trả về list description_embedding để tương thích run_test
-        return description_embeddings, elapsed, token_est, outfile
+    logging.info(
+        "Qwen embeddings (materials_qwen) done: %d rows, time=%.2fs, tokens≈%d, output=%s",
+        len(description_embeddings),
+        elapsed,
+        token_est,
+        outfile or "-",
+    )
+
+    # Trả về list description_embedding để tương thích run_test
+    return description_embeddings, elapsed, token_est, outfile
+
+
+def embed_table_with_qwen(
+    table_name: str = "materials_qwen",
+    page_size: int = 500,
+    output_dir: str = "embeddings_output",
+    resume: bool = True,
+):
+    """Chạy embed_with_qwen cho cả bảng theo keyset (id_sap > khoá cuối ORDER BY id_sap),
+    lưu khoá cuối mỗi trang vào job_checkpoints để chạy lại thì tiếp tục từ trang kế tiếp."""
+    job_name = f"embed_qwen:{table_name}"
+    conn = get_vector_db_connection()
+    try:
+        ensure_checkpoint_table(conn)
+        last_key = get_resume_value(conn, job_name, resume)
+        if last_key is None:
+            reset_checkpoint(conn, job_name)
+        else:
+            logging.info("[embed_qwen] Tiếp tục sau id_sap=%s", last_key)
+        save_checkpoint(conn, job_name, status="running")
+
+        total = 0
+        while True:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f'''
+                    SELECT id_sap, material_name, material_group, material_subgroup
+                    FROM public."{table_name}"
+                    WHERE id_sap IS NOT NULL {"AND id_sap > %s" if last_key is not None else ""}
+                    ORDER BY id_sap
+                    LIMIT %s
+                    ''',
+                    (last_key, page_size) if last_key is not None else (page_size,),
+                )
+                rows = cur.fetchall()
+            conn.rollback()
+            if not rows:
+                break
+
+            embed_with_qwen(table_name, [], rows, output_dir)
+            total += len(rows)
+            last_key = rows[-1]["id_sap"]
+            save_checkpoint(conn, job_name, last_value=last_key, rows_done=total)
+
+        save_checkpoint(conn, job_name, status="completed")
+        logging.info("[embed_qwen] Hoàn tất %s: %d dòng", table_name, total)
+        return total
+    except Exception:
+        conn.rollback()
+        save_checkpoint(conn, job_name, status="failed")
+        raise
+    finally:
+        conn.close()
 
 
-def generate_material_embeddings(table_name: str, limit: int = 1000, batch_size: int = 100):
+def generate_material_embeddings(
+    table_name: str,
+    limit: int = 1000,
+    batch_size: int = 100,
+    embed_batch_size: int = QWEN_EMBED_BATCH_SIZE,
+    concurrency: int = QWEN_EMBED_CONCURRENCY,
+    resume: bool = True,
+):
     """Tạo embeddings name_embedding và description_embedding cho bảng materials-like theo batch.
 
-    - Chỉ xử lý các dòng chưa có name_embedding hoặc description_embedding.
-    - Xử lý theo từng batch_size, commit xong một batch mới đọc batch tiếp theo
-      để tránh nghẽn database và quá tải model Qwen.
+    - Chỉ xử lý các dòng chưa có name_embedding hoặc description_embedding, đọc theo keyset
+      (id_sap > khoá cuối, ORDER BY id_sap) trên partial index của các dòng còn thiếu embedding.
+    - Khoá cuối mỗi batch được lưu vào job_checkpoints cùng transaction; resume=True thì lần chạy
+      sau (nếu lần trước chưa xong) tiếp tục sau khoá đó, dòng lỗi không bị đọc lại trong cùng lần chạy.
+    - Mỗi batch_size dòng: gom mọi text (bỏ trùng), gửi /api/embed theo batch `embed_batch_size`
+      với tối đa `concurrency` request song song, rồi UPDATE cả batch bằng execute_values.
     - Có thể giới hạn tối đa `limit` bản ghi sẽ được xử lý.
     - name_embedding: embedding của material_name.
     - description_embedding: embedding của "material_name material_group material_subgroup".
@@ -314,20 +485,20 @@ def generate_material_embeddings(table_name: str, limit: int = 1000, batch_size:
 
     ensure_table_embedding_columns(table_name)
 
-    url = f"{QWEN_API_BASE}/api/embeddings"
-
-    def _call_qwen(text: str) -> List[float]:
-        payload = {
-            "model": QWEN_EMBED_MODEL,
-            "prompt": text,
-        }
-        resp = requests.post(url, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        emb = data.get("embedding") or data.get("data", [{}])[0].get("embedding")
-        if emb is None:
-            raise ValueError(f"Qwen API response không có 'embedding': {data}")
-        return emb
+    job_name = f"embed:{table_name}"
+    missing_sql = "name_embedding IS NULL OR description_embedding IS NULL"
+    conn = get_vector_db_connection()
+    try:
+        ensure_checkpoint_table(conn)
+        ensure_keyset_index(conn, table_name, "id_sap", missing_sql, suffix="missing_emb")
+        last_key = get_resume_value(conn, job_name, resume)
+        if last_key is None:
+            reset_checkpoint(conn, job_name)
+        else:
+            logging.info("[materials-embed] Tiếp tục sau id_sap=%s", last_key)
+        save_checkpoint(conn, job_name, status="running")
+    finally:
+        conn.close()
 
     total_success = 0
     total_rows = 0
@@ -336,6 +507,7 @@ def generate_material_embeddings(table_name: str, limit: int = 1000, batch_size:
 
     start = time.time()
     batch_index = 0
+    failed = False
 
     while True:
         # Nếu đã đạt tới limit tổng thì dừng
@@ -355,15 +527,17 @@ def generate_material_embeddings(table_name: str, limit: int = 1000, batch_size:
         query = f'''
             SELECT id_sap, material_name, material_group, material_subgroup
             FROM public."{table_name}"
-            WHERE name_embedding IS NULL OR description_embedding IS NULL
+            WHERE ({missing_sql}) {"AND id_sap > %s" if last_key is not None else ""}
             ORDER BY id_sap
             LIMIT %s
         '''
 
-        cur.execute(query, (current_limit,))
+        params = (last_key, current_limit) if last_key is not None else (current_limit,)
+        cur.execute(query, params)
         materials = cur.fetchall()
 
         if not materials:
+            save_checkpoint(conn, job_name, status="completed")
             conn.close()
             break
 
@@ -375,60 +549,59 @@ def generate_material_embeddings(table_name: str, limit: int = 1000, batch_size:
         total_rows += len(materials)
 
         try:
+            items = []
             for mat in materials:
-                try:
-                    material_name = (mat.get("material_name") or "").strip()
-                    material_group = (mat.get("material_group") or "").strip()
-                    material_subgroup = (mat.get("material_subgroup") or "").strip()
-                    id_sap = mat.get("id_sap")
-
-                    if id_sap is None:
-                        errors.append("Bỏ qua một bản ghi không có id_sap")
-                        continue
-
-                    name_text = material_name
-                    desc_text = f"{material_name} {material_group} {material_subgroup}".strip()
-
-                    name_emb = _call_qwen(name_text)
-                    desc_emb = _call_qwen(desc_text)
-
-                    all_texts_for_token_est.append(name_text + " " + desc_text)
-
-                    if EMBEDDING_STORAGE_TYPE == "vector":
-                        name_emb_str = "[" + ",".join(str(float(x)) for x in name_emb) + "]"
-                        desc_emb_str = "[" + ",".join(str(float(x)) for x in desc_emb) + "]"
-                        update_sql = (
-                            f'UPDATE public."{table_name}" '
-                            "SET name_embedding = %s::vector, "
-                            "    description_embedding = %s::vector, "
-                            "    updated_at = NOW() "
-                            "WHERE id_sap = %s"
-                        )
-                        params = (name_emb_str, desc_emb_str, id_sap)
-                    else:
-                        update_sql = (
-                            f'UPDATE public."{table_name}" '
-                            "SET name_embedding = %s::jsonb, "
-                            "    description_embedding = %s::jsonb, "
-                            "    updated_at = NOW() "
-                            "WHERE id_sap = %s"
-                        )
-                        params = (
-                            json.dumps(name_emb),
-                            json.dumps(desc_emb),
-                            id_sap,
-                        )
-
-                    cur.execute(update_sql, params)
-                    total_success += 1
-
-                    # tránh spam API quá nhanh
-                    time.sleep(0.5)
-
-                except Exception as e:  # pragma: no cover - logging lỗi runtime
-                    errors.append(f"{mat.get('id_sap')}: {str(e)[:100]}")
+                material_name = (mat.get("material_name") or "").strip()
+                material_group = (mat.get("material_group") or "").strip()
+                material_subgroup = (mat.get("material_subgroup") or "").strip()
+                id_sap = mat.get("id_sap")
+
+                if id_sap is None:
+                    errors.append("Bỏ qua một bản ghi không có id_sap")
+                    continue
+
+                name_text, desc_text = material_texts(
+                    id_sap, material_name, f"{material_name} {material_group} {material_subgroup}".strip()
+                )
+                items.append((id_sap, name_text, desc_text))
+
+            vectors = embed_texts(
+                [t for _, n, d in items for t in (n, d)],
+                batch_size=embed_batch_size,
+                concurrency=concurrency,
+            )
 
+            updates = []
+            for id_sap, name_text, desc_text in items:
+                name_emb = vectors.get(name_text)
+                desc_emb = vectors.get(desc_text)
+                if name_emb is None or desc_emb is None:
+                    errors.append(f"{id_sap}: embedding lỗi")
+                    continue
+                updates.append((id_sap, name_emb, desc_emb))
+                all_texts_for_token_est.append(name_text + " " + desc_text)
+
+            bulk_update_embeddings(cur, table_name, updates)
+            last_key = materials[-1]["id_sap"]
+            save_checkpoint(
+                conn, job_name, last_value=last_key, rows_done=total_rows, commit=False
+            )
             conn.commit()
+            total_success += len(updates)
+        except Exception as e:  # pragma: no cover - logging lỗi runtime
+            conn.rollback()
+            save_checkpoint(conn, job_name, status="failed")
+            errors.append(f"batch {batch_index}: {str(e)[:100]}")
+            failed = True
+            break
+        finally:
+            conn.close()
+
+    if total_rows >= limit and not failed:
+        # Dừng vì đạt limit: lần chạy sau tiếp tục sau khoá cuối
+        conn = get_vector_db_connection()
+        try:
+            save_checkpoint(conn, job_name, status="paused")
         finally:
             conn.close()
 
@@ -455,7 +628,6 @@ def generate_material_embeddings(table_name: str, limit: int = 1000, batch_size:
     }
 
 
-
 if __name__ == "__main__":
     import argparse
 
@@ -467,12 +639,18 @@ if __name__ == "__main__":
     parser.add_argument("--table", required=True, help="Tên bảng trong Postgres")
     parser.add_argument("--limit", type=int, default=1000, help="Tổng số bản ghi tối đa cần xử lý")
     parser.add_argument("--batch-size", type=int, default=100, help="Số bản ghi xử lý trong mỗi batch")
+    parser.add_argument("--embed-batch-size", type=int, default=QWEN_EMBED_BATCH_SIZE, help="Số text mỗi request /api/embed")
+    parser.add_argument("--concurrency", type=int, default=QWEN_EMBED_CONCURRENCY, help="Số request embedding song song")
+    parser.add_argument("--restart", action="store_true", help="Bỏ qua checkpoint, chạy lại từ đầu")
     args = parser.parse_args()
 
     result = generate_material_embeddings(
         table_name=args.table,
         limit=args.limit,
         batch_size=args.batch_size,
+        embed_batch_size=args.embed_batch_size,
+        concurrency=args.concurrency,
+        resume=not args.restart,
     )
 
     logging.info(result.get("message"))
@@ -1,4 +1,10 @@
 import logging
+import math
+import os
+import queue
+import threading
+import time
+from typing import List, Optional, Tuple
 from psycopg2 import sql
 from connectDB import (
     get_main_db_connection,
@@ -7,11 +13,184 @@ from connectDB import (
 
 from logServer import setup_logging
 
+# Số dòng mỗi lần COPY + commit khi copy theo khoảng khoá (0 = 1 lần COPY cho cả bảng)
+COPY_COMMIT_ROWS = int(os.getenv("COPY_COMMIT_ROWS", "200000"))
+# Số luồng COPY song song (mỗi luồng 1 cặp connection main/vector)
+COPY_PARALLEL = int(os.getenv("COPY_PARALLEL", "1"))
 
-def copy_table_from_main_to_vector(table_name: str):
+
+def _get_primary_key_column(conn, table_name: str) -> Optional[str]:
+    """Cột khoá chính (chỉ khi PK gồm đúng 1 cột)"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT a.attname
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = format('public.%%I', %s)::regclass AND i.indisprimary;
+            """,
+            (table_name,)
+        )
+        rows = cur.fetchall()
+    return rows[0][0] if len(rows) == 1 else None
+
+
+def _estimate_row_count(conn, table_name: str) -> int:
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = format('public.%%I', %s)::regclass;",
+            (table_name,)
+        )
+        row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+
+def _key_range_bounds(conn, table_name: str, key_column: str, partitions: int) -> List:
+    """Giá trị khoá lớn nhất của mỗi phần (ntile theo thứ tự khoá), dùng làm cận trên các khoảng"""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT max(k) FROM (
+                SELECT "{key_column}" AS k, ntile(%s) OVER (ORDER BY "{key_column}") AS part
+                FROM public."{table_name}"
+                WHERE "{key_column}" IS NOT NULL
+            ) t
+            GROUP BY part
+            ORDER BY 1;
+            """,
+            (partitions,)
+        )
+        return [r[0] for r in cur.fetchall()]
+
+
+def _build_key_ranges(bounds: List, key_column: str) -> List[Tuple[str, tuple]]:
+    """[(where_sql, params)]: (-inf, b1] + NULL, (b1, b2], ..., (b_{n-1}, +inf)"""
+    if not bounds:
+        return [("TRUE", ())]
+    ranges = []
+    lower = None
+    for i, upper in enumerate(bounds):
+        last = i == len(bounds) - 1
+        if lower is None and last:
+            ranges.append(("TRUE", ()))
+        elif lower is None:
+            ranges.append((f'("{key_column}" <= %s OR "{key_column}" IS NULL)', (upper,)))
+        elif last:
+            ranges.append((f'"{key_column}" > %s', (lower,)))
+        else:
+            ranges.append((f'"{key_column}" > %s AND "{key_column}" <= %s', (lower, upper)))
+        lower = upper
+    return ranges
+
+
+def _copy_range(main_conn, vector_conn, table_name: str, col_list: str, where_sql: str, params: tuple) -> int:
+    """
+    COPY (SELECT ... WHERE range) TO STDOUT ở MAIN_DB -> pipe -> COPY ... FROM STDIN ở VECTOR_DB,
+    rồi commit. Dữ liệu đi thẳng qua pipe, không parse thành tuple Python.
+    """
+    with main_conn.cursor() as cur:
+        select_sql = cur.mogrify(
+            f'SELECT {col_list} FROM public."{table_name}" WHERE {where_sql}', params
+        ).decode()
+    copy_out_sql = f"COPY ({select_sql}) TO STDOUT"
+    copy_in_sql = f'COPY public."{table_name}" ({col_list}) FROM STDIN'
+
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, "rb")
+    writer = os.fdopen(write_fd, "wb")
+    errors = []
+
+    def produce():
+        try:
+            with main_conn.cursor() as cur:
+                cur.copy_expert(copy_out_sql, writer)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            writer.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        with vector_conn.cursor() as cur:
+            cur.copy_expert(copy_in_sql, reader, size=1 << 20)
+            copied = cur.rowcount
+    except Exception:
+        vector_conn.rollback()
+        raise
+    finally:
+        reader.close()
+        producer.join()
+
+    if errors:
+        vector_conn.rollback()
+        raise errors[0]
+    vector_conn.commit()
+    main_conn.rollback()  # đóng transaction đọc
+    return copied
+
+
+def _copy_ranges(main_conn, vector_conn, table_name: str, col_list: str,
+                 ranges: List[Tuple[str, tuple]], parallel: int) -> int:
+    """Copy từng khoảng; parallel > 1 thì mỗi luồng dùng cặp connection riêng"""
+    if parallel <= 1 or len(ranges) <= 1:
+        total = 0
+        for i, (where_sql, params) in enumerate(ranges, 1):
+            total += _copy_range(main_conn, vector_conn, table_name, col_list, where_sql, params)
+            logging.info(f"COPY '{table_name}': {i}/{len(ranges)} khoảng, {total} dòng")
+        return total
+
+    work: "queue.Queue[Tuple[str, tuple]]" = queue.Queue()
+    for r in ranges:
+        work.put(r)
+    lock = threading.Lock()
+    state = {"total": 0, "done": 0}
+    errors = []
+
+    def worker():
+        m_conn = get_main_db_connection()
+        v_conn = get_vector_db_connection()
+        try:
+            while not errors:
+                try:
+                    where_sql, params = work.get_nowait()
+                except queue.Empty:
+                    return
+                copied = _copy_range(m_conn, v_conn, table_name, col_list, where_sql, params)
+                with lock:
+                    state["total"] += copied
+                    state["done"] += 1
+                    logging.info(f"COPY '{table_name}': {state['done']}/{len(ranges)} khoảng, {state['total']} dòng")
+        except Exception as e:
+            logging.exception(f"COPY '{table_name}' lỗi: {e}")
+            errors.append(e)
+        finally:
+            m_conn.close()
+            v_conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(parallel, len(ranges)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return state["total"]
+
+
+def copy_table_from_main_to_vector(
+    table_name: str,
+    key_column: Optional[str] = None,
+    parallel: int = COPY_PARALLEL,
+    commit_rows: int = COPY_COMMIT_ROWS,
+):
     """
     Copy toàn bộ table + data
     từ MAIN_DB_DATABASE sang VECTOR_DB_DATABASE.
+
+    Dữ liệu được stream bằng COPY TO STDOUT -> COPY FROM STDIN (không insert từng dòng).
+    Nếu có key_column (mặc định: khoá chính 1 cột), bảng được chia theo khoảng khoá
+    ~commit_rows dòng mỗi khoảng; mỗi khoảng commit riêng và có thể chạy `parallel` luồng.
     """
 
     main_conn = get_main_db_connection()
@@ -60,28 +239,32 @@ def copy_table_from_main_to_vector(table_name: str):
             vector_conn.commit()
 
         # -------------------------
-        # 3. Copy data
+        # 3. Copy data bằng COPY (theo khoảng khoá nếu bảng lớn / chạy song song)
         # -------------------------
-        select_sql = f'SELECT {", ".join(col_names)} FROM public."{table_name}";'
-        insert_sql = f'''
-            INSERT INTO public."{table_name}" ({", ".join(col_names)})
-            VALUES ({", ".join(["%s"] * len(col_names))});
-        '''
-
-        with main_conn.cursor() as main_cur, vector_conn.cursor() as vec_cur:
-            main_cur.execute(select_sql)
-
-            batch_size = 1000
-            while True:
-                rows = main_cur.fetchmany(batch_size)
-                if not rows:
-                    break
-                vec_cur.executemany(insert_sql, rows)
+        col_list = ", ".join(col_names)
+        ranges = [("TRUE", ())]
+        if key_column is None:
+            key_column = _get_primary_key_column(main_conn, table_name)
+        estimated = _estimate_row_count(main_conn, table_name)
+        if key_column:
+            partitions = max(parallel, 1)
+            if commit_rows > 0:
+                partitions = max(partitions, math.ceil(estimated / commit_rows))
+            if partitions > 1:
+                bounds = _key_range_bounds(main_conn, table_name, key_column, partitions)
+                ranges = _build_key_ranges(bounds, key_column)
+        main_conn.rollback()
 
-            vector_conn.commit()
+        logging.info(
+            f"COPY '{table_name}': ~{estimated} dòng, {len(ranges)} khoảng"
+            f" (key={key_column or '-'}), {min(parallel, len(ranges))} luồng"
+        )
+        started = time.time()
+        total = _copy_ranges(main_conn, vector_conn, table_name, col_list, ranges, parallel)
 
         logging.info(
-            f"Đã copy table '{table_name}' từ MAIN_DB sang VECTOR_DB thành công"
+            f"Đã copy table '{table_name}' từ MAIN_DB sang VECTOR_DB thành công:"
+            f" {total} dòng trong {time.time() - started:.1f}s"
         )
 
     finally:
@@ -90,7 +273,7 @@ def copy_table_from_main_to_vector(table_name: str):
 
 def main():
     copy_table_from_main_to_vector("ListMaterialsBOQ")
-    copy_table_from_main_to_vector("MD_Material_SAP")
+    copy_table_from_main_to_vector("MD_Material_SAP", key_column="ID_Material_SAP")
     
 # ----------------------------------------------------------------------------------------------------
 if __name__ == "__main__":
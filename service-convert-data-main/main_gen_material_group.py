@@ -1,5 +1,6 @@
 import logging
 from psycopg2 import sql
+
 from connectDB import (
     get_main_db_connection,
     get_vector_db_connection,
@@ -8,7 +9,16 @@ from connectDB import (
 )
 
 from logServer import setup_logging
-from func_gen_material_group import batch_classify_materials
+from func_gen_material_group import classify_materials_by_id
+from main_embedding_material import _call_qwen_batch
+from classify_runner import ConcurrentBatchClassifier
+from classification_cache import ClassificationCache
+from checkpoints import (
+    ensure_checkpoint_table,
+    get_resume_value,
+    reset_checkpoint,
+    save_checkpoint,
+)
 
 _MAIN_DB_TUNNEL = None
 
@@ -49,15 +59,38 @@ def ensure_target_table_exists(target_table: str):
     finally:
         conn.close()
 
+def _embed_name_qwen(text: str):
+    """Embedding tên vật liệu (chỉ dùng khi bật tra cứu gần đúng trong classification_cache).
+
+    Dùng cùng client /api/embed với main_embedding_material để vector cùng thang đo (chuẩn hoá L2).
+    """
+    try:
+        return _call_qwen_batch([text])[0]
+    except Exception as e:
+        logging.warning("Không tạo được embedding cho '%s': %s", text, e)
+        return None
+
 def classify_and_update_material_subgroup(
     source_view="MD_Material_SAP",
     target_table="MD_Material_SAP",
     batch_size=50,
+    max_in_flight=4,
+    cache_similarity_threshold=0.0,
+    page_size=3000,
+    resume=True,
 ):
     """Đọc dữ liệu từ VIEW trong FETCH_DB và cập nhật sang TABLE trong VECTOR_DB.
 
     - source_view: tên VIEW/BẢNG trong DB fetch (kết nối get_fetch_db_connection)
     - target_table: tên TABLE trong DB vector (kết nối get_vector_db_connection)
+    - batch_size: kích thước batch ban đầu (tự điều chỉnh theo độ trễ / tỉ lệ lỗi)
+    - max_in_flight: số batch Gemini chạy đồng thời
+    - cache_similarity_threshold: > 0 để dùng lại kết quả của tên gần giống (cosine, qua embedding Qwen)
+    - page_size: số dòng đọc mỗi trang (keyset theo id_sap)
+    - resume: tiếp tục sau id_sap cuối đã lưu trong job_checkpoints nếu lần chạy trước chưa xong
+
+    Mỗi tên vật liệu (đã chuẩn hoá) chỉ gửi Gemini một lần; kết quả lưu ở bảng
+    classification_cache và dùng lại cho các bảng / lần chạy sau.
     """
 
     fetch_conn = get_fetch_db_connection()
@@ -66,99 +99,154 @@ def classify_and_update_material_subgroup(
     # Đảm bảo bảng đích tồn tại trước khi UPDATE
     ensure_target_table_exists(target_table)
 
+    cache = ClassificationCache(
+        get_vector_db_connection,
+        "material",
+        embed_fn=_embed_name_qwen,
+        similarity_threshold=cache_similarity_threshold,
+    )
+    cache.ensure_table()
+
     try:
-        # Đọc dữ liệu nguồn từ VIEW/BẢNG trong FETCH_DB, bỏ các dòng không có id_sap
-        with fetch_conn.cursor() as cur:
-            cur.execute(
-                f'''
-                SELECT  "id_sap", "material_name", "material_group", "idx"
-                FROM "{source_view}"
-                WHERE "id_sap" IS NOT NULL AND "id_sap" <> ''
-                OFFSET 20396 LIMIT 3000
-                '''
-            )
-            rows = cur.fetchall()
+        job_name = f"classify_group:{source_view}->{target_table}"
+        ensure_checkpoint_table(vector_conn)
+        last_key = get_resume_value(vector_conn, job_name, resume)
+        if last_key is None:
+            reset_checkpoint(vector_conn, job_name)
+        else:
+            logging.info(f"Tiếp tục classify sau id_sap={last_key}")
+        save_checkpoint(vector_conn, job_name, status="running")
+        processed = 0
+
+        while True:
+            # Đọc 1 trang dữ liệu nguồn theo keyset (id_sap > khoá cuối), bỏ các dòng không có id_sap
+            with fetch_conn.cursor() as cur:
+                cur.execute(
+                    f'''
+                    SELECT  "id_sap", "material_name", "material_group", "idx"
+                    FROM "{source_view}"
+                    WHERE "id_sap" IS NOT NULL AND "id_sap" <> ''
+                        {'AND "id_sap" > %s' if last_key is not None else ""}
+                    ORDER BY "id_sap"
+                    LIMIT %s
+                    ''',
+                    (last_key, page_size) if last_key is not None else (page_size,),
+                )
+                rows = cur.fetchall()
+            fetch_conn.rollback()
 
-        logging.info(f"Tổng material cần classify: {len(rows)}")
+            if not rows:
+                break
 
-        # Gọi Gemini theo batch và ghi kết quả sang TABLE ở VECTOR_DB
-        for i in range(0, len(rows), batch_size):
-            batch = rows[i:i + batch_size]
+            logging.info(f"Trang material cần classify: {len(rows)} (sau id_sap={last_key})")
 
-            materials_batch = [
+            materials = [
                 {
                     "id_sap": r[0],
                     "material_name": r[1] or "",
                     "material_group": r[2] or "",
                     "idx": r[3] or 0,
                 }
-                for r in batch
+                for r in rows
             ]
 
             # Map để lấy lại material_name, idx theo id_sap khi ghi sang bảng đích
-            name_by_id = {
-                m["id_sap"]: m["material_name"] for m in materials_batch
-            }
-
-            results = batch_classify_materials(materials_batch)
-
-            with vector_conn.cursor() as cur:
-                current_id_sap = None
-                try:
-                    for r in results:
-                        # Bỏ qua kết quả không có id_sap để tránh chèn NULL vào khóa chính
-                        if not r.get("id_sap"):
-                            logging.warning("Bỏ qua kết quả không có id_sap: %s", r)
-                            continue
-
-                        material_name = name_by_id.get(r["id_sap"], "")
-                        current_id_sap = r["id_sap"]
-
-                        cur.execute(
-                            f'''
-                            INSERT INTO "{target_table}" (
-                                id_sap,
-                                material_name,
-                                material_group,
-                                material_subgroup,
-                                idx
+            name_by_id = {str(m["id_sap"]): m["material_name"] for m in materials}
+            idx_by_id = {str(m["id_sap"]): m["idx"] for m in materials}
+            written = 0
+
+            def save_results(results):
+                """Ghi kết quả của 1 batch ngay khi Gemini trả về (gọi từ thread chính).
+
+                Lỗi ghi DB được raise lại: job dừng ở trạng thái failed và checkpoint vẫn ở
+                khoá của trang trước, nên lần chạy lại xử lý lại cả trang này thay vì bỏ sót dòng.
+                """
+                nonlocal written
+                with vector_conn.cursor() as cur:
+                    current_id_sap = None
+                    try:
+                        for id_sap, r in results.items():
+                            current_id_sap = id_sap
+
+                            cur.execute(
+                                f'''
+                                INSERT INTO "{target_table}" (
+                                    id_sap,
+                                    material_name,
+                                    material_group,
+                                    material_subgroup,
+                                    idx
+                                )
+                                VALUES (%s, %s, %s, %s, %s)
+                                ON CONFLICT (id_sap) DO NOTHING
+                                RETURNING id_sap
+                                ''',
+                                (
+                                    id_sap,
+                                    name_by_id.get(id_sap, ""),
+                                    r["material_group"],
+                                    r["material_subgroup"],
+                                    idx_by_id.get(id_sap, 0)
+                                ),
                             )
-                            VALUES (%s, %s, %s, %s, %s)
-                            ON CONFLICT (id_sap) DO NOTHING
-                            RETURNING id_sap
-                            ''',
-                            (
-                                r["id_sap"],
-                                material_name,
-                                r["material_group"],
-                                r["material_subgroup"],
-                                r.get("idx", 0)
-                            ),
+
+                            inserted_row = cur.fetchone()
+                            if inserted_row is None:
+                                logging.info(
+                                    "CONFLICT: id_sap=%s đã tồn tại trong bảng %s, bỏ qua không chèn mới",
+                                    id_sap,
+                                    target_table,
+                                )
+
+                        # Commit một lần cho mỗi batch
+                        vector_conn.commit()
+                        written += len(results)
+                    except Exception as e:
+                        logging.exception(
+                            "Không thể ghi dữ liệu cho id_sap=%s: %s",
+                            current_id_sap,
+                            e,
                         )
+                        vector_conn.rollback()
+                        raise
 
-                        inserted_row = cur.fetchone()
-                        if inserted_row is None:
-                            logging.info(
-                                "CONFLICT: id_sap=%s đã tồn tại trong bảng %s, bỏ qua không chèn mới",
-                                r["id_sap"],
-                                target_table,
-                            )
+                logging.info(f"Đã xử lý {written}/{len(rows)} (trang hiện tại)")
 
-                    # Sau khi xử lý xong cả batch_size thì mới commit một lần
-                    vector_conn.commit()
-                except Exception as e:
-                    logging.exception(
-                        "Không thể ghi dữ liệu cho id_sap=%s trong batch bắt đầu tại index=%s: %s",
-                        current_id_sap,
-                        i,
-                        e,
-                    )
-                    vector_conn.rollback()
-
-            logging.info(
-                f"Đã xử lý {min(i + batch_size, len(rows))}/{len(rows)}"
+            # Nhiều batch Gemini chạy song song (trong giới hạn rate limiter),
+            # khớp kết quả theo id_sap và chỉ gửi lại các dòng bị thiếu
+            classifier = ConcurrentBatchClassifier(
+                classify_materials_by_id,
+                max_in_flight=max_in_flight,
+                initial_batch_size=batch_size,
+                max_batch_size=max(batch_size, 50),
+            )
+            outcome = cache.run_cached(
+                materials,
+                classifier.run,
+                save_results,
+                name_field="material_name",
+                result_fields=["material_group", "material_subgroup"],
             )
 
+            if outcome["unclassified"]:
+                logging.warning(
+                    "Không phân loại được %s material sau nhiều lần thử: %s",
+                    len(outcome["unclassified"]),
+                    [m["id_sap"] for m in outcome["unclassified"]][:50],
+                )
+
+            processed += len(rows)
+            last_key = rows[-1][0]
+            save_checkpoint(vector_conn, job_name, last_value=last_key, rows_done=processed)
+
+        save_checkpoint(vector_conn, job_name, status="completed")
+        logging.info(f"Classify {job_name} hoàn tất: {processed} material")
+
+    except Exception:
+        vector_conn.rollback()
+        save_checkpoint(vector_conn, job_name, status="failed")
+        raise
+
     finally:
         fetch_conn.close()
         vector_conn.close()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Các script của service import nhau theo tên module phẳng (vd. "from checkpoints import ...")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,69 @@
+from checkpoints import ensure_keyset_index, get_resume_value, save_checkpoint
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append((sql, params))
+
+    def fetchone(self):
+        return self.conn.row
+
+class FakeConn:
+    """Ghi lại các câu SQL; fetchone trả về dòng checkpoint giả lập"""
+
+    def __init__(self, row=None):
+        self.row = row
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+def test_save_checkpoint_upserts_and_keeps_unset_fields():
+    conn = FakeConn()
+    save_checkpoint(conn, "embed_qwen:materials_qwen", status="paused")
+
+    sql, params = conn.executed[0]
+    assert "ON CONFLICT (job_name) DO UPDATE" in sql
+    assert "COALESCE(EXCLUDED.last_value, job_checkpoints.last_value)" in sql
+    # last_value và rows_done None -> giữ giá trị cũ
+    assert params == ("embed_qwen:materials_qwen", None, None, "paused", "paused", None, "paused")
+    assert conn.commits == 1
+
+def test_save_checkpoint_stringifies_last_value_and_respects_commit_flag():
+    conn = FakeConn()
+    save_checkpoint(conn, "sync", last_value=12345, rows_done=500, commit=False)
+
+    _, params = conn.executed[0]
+    assert params[1] == "12345"
+    assert params[2] == 500 and params[5] == 500
+    assert conn.commits == 0
+
+def test_get_resume_value():
+    assert get_resume_value(FakeConn(("M100", 10, "paused", None, None)), "job", resume=False) is None
+    assert get_resume_value(FakeConn(None), "job") is None
+    assert get_resume_value(FakeConn(("M100", 10, "completed", None, None)), "job") is None
+    assert get_resume_value(FakeConn(("M100", 10, "failed", None, None)), "job") == "M100"
+
+def test_keyset_index_name_is_truncated_and_partial():
+    conn = FakeConn()
+    table = "materials_qwen_" + "x" * 60
+    ensure_keyset_index(conn, table, "id_sap", "name_embedding IS NULL", suffix="missing_emb")
+
+    sql, _ = conn.executed[0]
+    index_name = sql.split('"')[1]
+    assert len(index_name) == 63
+    assert index_name == f"{table}_id_sap_missing_emb_idx"[:63]
+    assert sql.endswith(" WHERE name_embedding IS NULL")
+    assert conn.commits == 1
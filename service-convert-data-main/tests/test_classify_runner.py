@@ -0,0 +1,98 @@
+import threading
+
+import pytest
+
+from classify_runner import ConcurrentBatchClassifier
+
+def make_items(n):
+    return [{"id_sap": f"M{i:03d}", "name": f"item {i}"} for i in range(n)]
+
+def test_classifies_every_item_once_and_dedupes_keys():
+    calls = []
+    lock = threading.Lock()
+
+    def classify(batch):
+        with lock:
+            calls.append([item["id_sap"] for item in batch])
+        return {item["id_sap"]: {"group": "A"} for item in batch}
+
+    items = make_items(7) + make_items(3)  # 3 key trùng
+    saved = {}
+    runner = ConcurrentBatchClassifier(classify, max_in_flight=2, initial_batch_size=3, min_batch_size=1)
+    outcome = runner.run(items, on_results=saved.update)
+
+    assert set(outcome["results"]) == {f"M{i:03d}" for i in range(7)}
+    assert outcome["unclassified"] == []
+    assert saved == outcome["results"]
+    sent = [key for batch in calls for key in batch]
+    assert sorted(sent) == sorted(set(sent))
+
+def test_missing_items_are_requeued_until_classified():
+    seen = {}
+    lock = threading.Lock()
+
+    def classify(batch):
+        # Lần đầu bỏ sót các item lẻ, lần sau trả đủ
+        results = {}
+        with lock:
+            for item in batch:
+                key = item["id_sap"]
+                seen[key] = seen.get(key, 0) + 1
+                if int(key[1:]) % 2 == 0 or seen[key] > 1:
+                    results[key] = {"group": "A"}
+        return results
+
+    runner = ConcurrentBatchClassifier(classify, max_in_flight=1, initial_batch_size=4, min_batch_size=1)
+    outcome = runner.run(make_items(6))
+
+    assert len(outcome["results"]) == 6
+    assert outcome["unclassified"] == []
+    assert runner.stats["requeued"] == 3
+    assert seen == {f"M{i:03d}": 1 if i % 2 == 0 else 2 for i in range(6)}
+
+def test_items_give_up_after_max_attempts():
+    attempts = {}
+
+    def classify(batch):
+        for item in batch:
+            attempts[item["id_sap"]] = attempts.get(item["id_sap"], 0) + 1
+        return {item["id_sap"]: {"group": "A"} for item in batch if item["id_sap"] != "M001"}
+
+    runner = ConcurrentBatchClassifier(classify, max_in_flight=1, initial_batch_size=2,
+                                       min_batch_size=1, max_attempts=3)
+    outcome = runner.run(make_items(3))
+
+    assert [item["id_sap"] for item in outcome["unclassified"]] == ["M001"]
+    assert attempts["M001"] == 3
+    assert set(outcome["results"]) == {"M000", "M002"}
+    assert runner.stats["unclassified"] == 1
+
+def test_failed_batch_is_retried_and_shrinks_batch_size():
+    calls = {"n": 0}
+
+    def classify(batch):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise RuntimeError("quota")
+        return {item["id_sap"]: {"group": "A"} for item in batch}
+
+    runner = ConcurrentBatchClassifier(classify, max_in_flight=1, initial_batch_size=10,
+                                       min_batch_size=2, max_batch_size=10)
+    outcome = runner.run(make_items(10))
+
+    assert len(outcome["results"]) == 10
+    assert runner.stats["failed_batches"] == 1
+    assert runner.stats["requeued"] == 10
+    # Batch lỗi làm batch size giảm 10 -> 7, nên 10 item được gửi lại thành 2 batch
+    assert runner.stats["batches"] == 3
+
+def test_on_results_error_propagates_to_caller():
+    def classify(batch):
+        return {item["id_sap"]: {"group": "A"} for item in batch}
+
+    def on_results(found):
+        raise RuntimeError("db write failed")
+
+    runner = ConcurrentBatchClassifier(classify, max_in_flight=2, initial_batch_size=2, min_batch_size=1)
+    with pytest.raises(RuntimeError, match="db write failed"):
+        runner.run(make_items(6), on_results=on_results)
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+import rate_limiter
+from rate_limiter import AdaptiveRateLimiter
+
+class FakeClock:
+    """monotonic() / sleep() không chờ thật: sleep chỉ cộng thời gian"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", fake)
+    return fake
+
+def make_limiter(**kwargs):
+    params = dict(name="test", initial_rate=2.0, min_rate=0.5, max_rate=3.0, burst=2,
+                  increase_step=0.5, decrease_factor=0.5)
+    params.update(kwargs)
+    return AdaptiveRateLimiter(**params)
+
+def test_success_increases_rate_additively_up_to_max(clock):
+    limiter = make_limiter()
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(2.5)
+    for _ in range(5):
+        limiter.on_success()
+    assert limiter.rate == pytest.approx(3.0)
+    assert limiter.metrics()["successes"] == 6
+
+def test_throttle_decreases_rate_multiplicatively_down_to_min(clock):
+    limiter = make_limiter()
+    limiter.on_throttle()
+    assert limiter.rate == pytest.approx(1.0)
+    for _ in range(5):
+        limiter.on_throttle()
+    assert limiter.rate == pytest.approx(0.5)
+    assert limiter.metrics()["throttled"] == 6
+
+def test_burst_is_served_without_waiting_then_refills_at_rate(clock):
+    limiter = make_limiter(burst=2, initial_rate=2.0)
+    assert limiter.acquire() == 0.0
+    assert limiter.acquire() == 0.0
+    # Hết token: chờ 1 token ở 2 req/s = 0.5s
+    assert limiter.acquire() == pytest.approx(0.5)
+    assert limiter.metrics()["requests"] == 3
+
+def test_throttle_pauses_callers_for_retry_after(clock):
+    limiter = make_limiter(burst=5)
+    limiter.on_throttle(retry_after=3.0)
+    assert limiter.metrics()["paused_for_seconds"] == pytest.approx(3.0)
+    waited = limiter.acquire()
+    # Chờ hết khoảng pause rồi chờ token được nạp lại (bucket bị xả về 0 khi throttle)
+    assert waited >= 3.0
+    assert clock.slept[0] == pytest.approx(3.0)
+
+def test_rate_recovers_after_throttle(clock):
+    limiter = make_limiter(initial_rate=2.0, increase_step=0.25)
+    limiter.on_throttle()
+    assert limiter.rate == pytest.approx(1.0)
+    for _ in range(4):
+        limiter.on_success()
+    assert limiter.rate == pytest.approx(2.0)
@@ -1,15 +1,24 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, HTTPException
 from typing import Optional, List, Dict, Any
 from sqlalchemy import text
 
-from .service import process_table, run_all_tables, insert_records, update_records
-from .db import get_origin_tables, get_id_sap_by_material_name
+from .service import process_table, insert_records, update_records
+from .db import get_origin_tables, get_id_sap_by_material_names
+from .db import ensure_build_state_table, list_build_states, estimate_origin_row_count
+from .build_jobs import BuildJobManager
+from .config import settings
 from .db import target_engine as engine  # <-- use target_engine
 
 from .schema import UpsertRequest, UpdateByKeysRequest
 
 app = FastAPI(title="RAG Vector Build API")   
 
+build_jobs = BuildJobManager(
+    process_table,
+    estimate_fn=estimate_origin_row_count,
+    max_concurrent_tables=settings.VECTOR_BUILD_MAX_CONCURRENT_TABLES,
+)
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
@@ -19,20 +28,74 @@ def tables():
     return {"tables": get_origin_tables()}
 
 @app.post("/build/all")
-def build_all(background_tasks: BackgroundTasks):
-    background_tasks.add_task(run_all_tables)
-    return {"message": "Build all started"}
+def build_all(full_refresh: bool = False, embed_workers: Optional[int] = None):
+    try:
+        job = build_jobs.submit(
+            get_origin_tables(), full_refresh=full_refresh, embed_workers=embed_workers
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"message": "Build all started", "job_id": job.id, "tables": job.tables, "full_refresh": full_refresh}
 
 # theo từng page
 @app.post("/build/table/{table_name}")
 def build_table(
     table_name: str,
-    background_tasks: BackgroundTasks,
     limit: Optional[int] = None,
     batch_size: int = 50,
+    full_refresh: bool = False,
+    embed_workers: Optional[int] = None,
 ):
-    background_tasks.add_task(process_table, table_name, limit, batch_size)
-    return {"message": "Build table started", "table": table_name}
+    try:
+        job = build_jobs.submit(
+            [table_name],
+            limit=limit,
+            batch_size=batch_size,
+            full_refresh=full_refresh,
+            embed_workers=embed_workers,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"message": "Build table started", "job_id": job.id, "table": table_name, "full_refresh": full_refresh}
+
+# tiến độ build: rows read/embedded/written/failed, rows/sec, ETA
+@app.get("/build/jobs")
+def list_build_jobs():
+    return {"jobs": [job.progress() for job in build_jobs.list()]}
+
+@app.get("/build/jobs/{job_id}")
+def get_build_job(job_id: str):
+    job = build_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.progress()
+
+@app.post("/build/jobs/{job_id}/cancel")
+def cancel_build_job(job_id: str):
+    try:
+        job = build_jobs.cancel(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Job not found")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"job_id": job.id, "status": job.status}
+
+@app.post("/build/jobs/{job_id}/resume")
+def resume_build_job(job_id: str):
+    """Chạy lại các bảng chưa xong; build incremental bỏ qua các dòng đã embed"""
+    try:
+        job = build_jobs.resume(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Job not found")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"job_id": job.id, "status": job.status}
+
+# watermark / thống kê lần build incremental gần nhất của từng bảng
+@app.get("/build/state")
+def build_state():
+    ensure_build_state_table()
+    return {"tables": list_build_states()}
 
 
 @app.post("/sync/{table_name}/insert")
@@ -120,6 +183,18 @@ def update_data_by_keys(
     if not records_list:
         raise HTTPException(status_code=400, detail="Empty data")
 
+    # Tra id_sap cho mọi material_name cần dùng bằng 1 query (thay vì 1 query / record)
+    lookup_names = []
+    if any(isinstance(rec, dict) and rec.get("id_sap") is None for rec in records_list):
+        lookup_names = [
+            str(k["value"])
+            for k in prioritized_keys
+            if k["name"] in ("material_name", "name_material")
+            and k["value"] is not None
+            and str(k["value"]).strip() != ""
+        ]
+    name_to_id_sap = get_id_sap_by_material_names(table_name, lookup_names) if lookup_names else {}
+
     normalized_records: List[Dict[str, Any]] = []
 
     for idx, rec in enumerate(records_list):
@@ -150,13 +225,8 @@ def update_data_by_keys(
                     break
                 # Xử lý key material_name / name_material
                 elif key_name in ("material_name", "name_material"):
-                    material_name = str(key_value)
-                    
-                    # Tra id_sap từ bảng gốc bằng material_name
-                    resolved_id_sap = get_id_sap_by_material_name(
-                        table_name,
-                        material_name
-                    )
+                    # id_sap đã tra sẵn theo lô (name_to_id_sap)
+                    resolved_id_sap = name_to_id_sap.get(str(key_value))
                     if resolved_id_sap is not None:
                         # Tìm thấy → dừng lại
                         break
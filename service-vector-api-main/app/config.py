@@ -21,10 +21,40 @@ class Settings:
     APP_EMBEDDING_MODEL = os.getenv("APP_EMBEDDING_MODEL", "qwen3-embedding:latest")
 
     # embedding chunking (to avoid model context overflow)
-    # Max characters per chunk sent to Ollama embeddings
+    # Max estimated tokens per chunk (words + punctuation), chunks split on line boundaries
+    EMBEDDING_CHUNK_TOKENS = int(os.getenv("EMBEDDING_CHUNK_TOKENS", "512"))
+    # Overlap in tokens between consecutive chunks
+    EMBEDDING_CHUNK_OVERLAP_TOKENS = int(os.getenv("EMBEDDING_CHUNK_OVERLAP_TOKENS", "48"))
+    # Hard cap of characters per chunk sent to Ollama embeddings
     EMBEDDING_CHUNK_SIZE = int(os.getenv("EMBEDDING_CHUNK_SIZE", "3000"))
-    # Overlap in characters between consecutive chunks
-    EMBEDDING_CHUNK_OVERLAP = int(os.getenv("EMBEDDING_CHUNK_OVERLAP", "200"))
+    # Số text tối đa mỗi request batch (/api/embed)
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+
+    # /sync/{table}/update/keys: cache material_name -> id_sap trong process
+    SYNC_KEY_CACHE_TTL = int(os.getenv("SYNC_KEY_CACHE_TTL", "300"))
+    SYNC_KEY_CACHE_MAX = int(os.getenv("SYNC_KEY_CACHE_MAX", "50000"))
+    # Tạo index material_name trên bảng gốc khi tra khóa lần đầu
+    SYNC_CREATE_NAME_INDEX: bool = os.getenv("SYNC_CREATE_NAME_INDEX", "false").strip().lower() == "true"
+
+    # Số dòng mỗi lần lấy từ server-side cursor khi đọc bảng gốc
+    ORIGIN_FETCH_YIELD_PER = int(os.getenv("ORIGIN_FETCH_YIELD_PER", "500"))
+
+    # pipeline build: số worker gọi Ollama song song, kích thước queue giữa các stage
+    VECTOR_BUILD_EMBED_WORKERS = int(os.getenv("VECTOR_BUILD_EMBED_WORKERS", "4"))
+    VECTOR_BUILD_QUEUE_SIZE = int(os.getenv("VECTOR_BUILD_QUEUE_SIZE", "200"))
+    # số bảng được build cùng lúc (chung cho mọi job)
+    VECTOR_BUILD_MAX_CONCURRENT_TABLES = int(os.getenv("VECTOR_BUILD_MAX_CONCURRENT_TABLES", "2"))
+
+    # incremental vector build
+    # Cột dùng làm watermark (lấy cột đầu tiên có trong bảng gốc)
+    VECTOR_BUILD_WATERMARK_COLUMNS = [
+        c.strip() for c in os.getenv("VECTOR_BUILD_WATERMARK_COLUMNS", "updated_at,updatedAt,update_date").split(",") if c.strip()
+    ]
+    # Khóa nguồn = primary key bảng gốc; không có primary key thì dùng cột đầu tiên trong danh sách
+    # này có trong bảng nếu giá trị của nó duy nhất; không có -> dùng hash nội dung
+    VECTOR_BUILD_KEY_COLUMNS = [
+        c.strip() for c in os.getenv("VECTOR_BUILD_KEY_COLUMNS", "id_sap").split(",") if c.strip()
+    ]
 
     # ollama
     OLLAMA_HOST = os.getenv("OLLAMA_HOST")
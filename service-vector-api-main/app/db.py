@@ -3,6 +3,8 @@ from sqlalchemy.engine import Engine
 from datetime import datetime, timezone
 from typing import List, Any, Dict, Optional
 import json
+import threading
+import time
 
 from .config import settings
 from .logger import setup_logger
@@ -43,6 +45,13 @@ except ImportError:
 
 _VECTOR_DB_TUNNEL = None
 
+# cache material_name -> id_sap: {(table, material_name): (id_sap, expires_at)}
+_ID_SAP_CACHE: Dict[tuple, tuple] = {}
+_ID_SAP_CACHE_LOCK = threading.Lock()
+_NAME_INDEXED_TABLES: set = set()
+# bảng vector đã có index trên id_sap trong original_data (dùng cho update_vector_rows)
+_ID_SAP_INDEXED_TABLES: set = set()
+
 
 def _ensure_vector_db_tunnel():
     global _VECTOR_DB_TUNNEL
@@ -166,13 +175,89 @@ def ensure_target_table(table_name: str):
             ADD COLUMN IF NOT EXISTS content_text TEXT,
             ADD COLUMN IF NOT EXISTS embedding DOUBLE PRECISION[],
             ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT NOW(),
-            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW();
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW(),
+            ADD COLUMN IF NOT EXISTS source_key TEXT,
+            ADD COLUMN IF NOT EXISTS row_hash TEXT;
         """
 
         conn.execute(text(alter_sql))
+
+        # Khóa ổn định của dòng gốc (id_sap / primary key), dùng cho upsert và update theo batch
+        conn.execute(text(
+            f'CREATE UNIQUE INDEX IF NOT EXISTS "{table_name}_source_key_uidx" '
+            f'ON public."{table_name}" (source_key)'
+        ))
     logger.info("Table %s is ready in target DB", table_name)
 
-def fetch_rows_from_origin(table_name: str, limit: int | None = None):
+def estimate_origin_row_count(table_name: str) -> Optional[int]:
+    """Số dòng ước lượng (pg_class.reltuples), không quét bảng"""
+    sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:regclass AS regclass)"
+    with origin_engine.connect() as conn:
+        value = conn.execute(text(sql), {"regclass": f'public."{table_name}"'}).scalar()
+    return int(value) if value is not None and value >= 0 else None
+
+class OriginRowStream:
+    """Iterator dòng của 1 server-side cursor trên origin DB.
+
+    close() đóng cursor và trả connection kể cả khi chưa đọc dòng nào (generator chưa
+    chạy thì không có finally để dọn); gọi nhiều lần không sao. Tự close khi đọc hết.
+    """
+
+    def __init__(self, conn, result):
+        self._conn = conn
+        self._result = result
+        self._partitions = result.partitions()
+        self._buffer: List[Any] = []
+        self._pos = 0
+        self._closed = False
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self._pos >= len(self._buffer):
+            if self._closed:
+                raise StopIteration
+            try:
+                self._buffer = next(self._partitions)
+            except StopIteration:
+                self.close()
+                raise
+            self._pos = 0
+            self.count += len(self._buffer)
+        row = self._buffer[self._pos]
+        self._pos += 1
+        return row
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._buffer = []
+        try:
+            self._result.close()
+        finally:
+            self._conn.close()
+            logger.info("Streamed %d rows from origin", self.count)
+
+def stream_query_from_origin(sql: str, params: Dict[str, Any] | None = None, yield_per: int | None = None):
+    """Chạy query trên origin DB bằng server-side cursor (named cursor của psycopg2).
+
+    Trả về (columns, OriginRowStream); mỗi lần chỉ giữ tối đa `yield_per` dòng trong bộ nhớ.
+    Connection được đóng khi đọc hết hoặc khi gọi rows.close().
+    """
+    yield_per = yield_per or settings.ORIGIN_FETCH_YIELD_PER
+    conn = origin_engine.connect()
+    try:
+        result = conn.execution_options(yield_per=yield_per).execute(text(sql), params or {})
+        columns = list(result.keys())
+    except Exception:
+        conn.close()
+        raise
+    return columns, OriginRowStream(conn, result)
+
+def fetch_rows_from_origin(table_name: str, limit: int | None = None, stream: bool = False):
     sql = f'SELECT * FROM public."{table_name}"'
     if limit:
         sql += f" LIMIT {limit}"
@@ -180,6 +265,9 @@ def fetch_rows_from_origin(table_name: str, limit: int | None = None):
     else:
         logger.info("Fetching ALL rows from origin table %s", table_name)
 
+    if stream:
+        return stream_query_from_origin(sql)
+
     with origin_engine.connect() as conn:
         result = conn.execute(text(sql))
         rows = result.fetchall()
@@ -212,6 +300,243 @@ def insert_vector_rows(
         conn.execute(text(insert_sql), serialized_rows)
     logger.info("Inserted %d rows into %s successfully", len(serialized_rows), table_name)
 
+def get_origin_columns(table_name: str) -> List[str]:
+    sql = """
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_schema = 'public' AND table_name = :table_name
+    ORDER BY ordinal_position;
+    """
+    with origin_engine.connect() as conn:
+        rows = conn.execute(text(sql), {"table_name": table_name}).fetchall()
+    return [r[0] for r in rows]
+
+def get_origin_primary_key(table_name: str) -> List[str]:
+    sql = """
+    SELECT a.attname
+    FROM pg_index i
+    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+    WHERE i.indrelid = CAST(:regclass AS regclass) AND i.indisprimary
+    ORDER BY array_position(CAST(i.indkey AS int2[]), a.attnum);
+    """
+    with origin_engine.connect() as conn:
+        rows = conn.execute(text(sql), {"regclass": f'public."{table_name}"'}).fetchall()
+    return [r[0] for r in rows]
+
+def origin_column_is_unique(table_name: str, column: str) -> bool:
+    """True nếu không có 2 dòng cùng giá trị (khác NULL) ở cột `column` của bảng gốc"""
+    sql = f"""
+    SELECT 1 FROM public."{table_name}"
+    WHERE "{column}" IS NOT NULL
+    GROUP BY "{column}"
+    HAVING COUNT(*) > 1
+    LIMIT 1
+    """
+    with origin_engine.connect() as conn:
+        return conn.execute(text(sql)).first() is None
+
+def fetch_changed_rows_from_origin(
+    table_name: str,
+    watermark_column: str,
+    since: Optional[str],
+    limit: int | None = None,
+    stream: bool = False,
+):
+    """Đọc các dòng có watermark >= since (kể cả watermark NULL).
+
+    Dùng >= để không bỏ sót các dòng trùng mốc; dòng không đổi sẽ bị loại bởi row_hash.
+    """
+    sql = f'SELECT * FROM public."{table_name}"'
+    params: Dict[str, Any] = {}
+    if since is not None:
+        sql += f' WHERE "{watermark_column}" >= :since OR "{watermark_column}" IS NULL'
+        params["since"] = since
+    sql += f' ORDER BY "{watermark_column}" NULLS LAST'
+    if limit:
+        sql += f" LIMIT {limit}"
+    logger.info(
+        "Fetching rows changed since %s (column %s) from origin table %s",
+        since, watermark_column, table_name,
+    )
+
+    if stream:
+        return stream_query_from_origin(sql, params)
+
+    with origin_engine.connect() as conn:
+        result = conn.execute(text(sql), params)
+        rows = result.fetchall()
+        columns = result.keys()
+    logger.info("Fetched %d changed rows from origin table %s", len(rows), table_name)
+    return columns, rows
+
+def fetch_origin_key_rows(table_name: str, key_columns: List[str]):
+    """Chỉ đọc các cột khóa của bảng gốc (để phát hiện dòng đã bị xóa)."""
+    cols = ", ".join(f'"{c}"' for c in key_columns)
+    _, rows = stream_query_from_origin(f'SELECT {cols} FROM public."{table_name}"')
+    return rows
+
+def _json_key_expr(key_columns: List[str]) -> str:
+    """Biểu thức SQL tính source_key từ original_data (khớp với build_source_key bên service)"""
+    if not key_columns:
+        return "md5(content_text)"
+    if len(key_columns) == 1:
+        col = key_columns[0]
+        return (
+            f"COALESCE(original_data ->> '{col}', original_data ->> '{col.upper()}', md5(content_text))"
+        )
+    return "concat_ws('|', " + ", ".join(
+        f"COALESCE(original_data ->> '{c}', '')" for c in key_columns
+    ) + ")"
+
+def adopt_legacy_rows(table_name: str, key_columns: List[str], rekey: bool = False):
+    """Gán source_key/row_hash cho các dòng cũ (source_key NULL), không xóa dòng nào.
+
+    Các dòng do bản build / sync cũ tạo ra được nhận lại thay vì embed lại:
+    row_hash = md5(content_text) nên dòng không đổi sẽ không bị embed lần nữa.
+    Nhiều dòng cũ cùng khóa (hoặc khóa đã có dòng giữ): chỉ dòng mới nhất được gán,
+    các dòng còn lại giữ source_key NULL và được log cảnh báo.
+    rekey=True: khóa của bảng đã đổi (vd. id_sap -> primary key), gán lại khóa cho mọi dòng.
+    """
+    key_expr = _json_key_expr(key_columns)
+    with target_engine.begin() as conn:
+        if rekey:
+            conn.execute(text(f'UPDATE public."{table_name}" SET source_key = NULL'))
+        has_legacy = conn.execute(text(
+            f'SELECT 1 FROM public."{table_name}" WHERE source_key IS NULL LIMIT 1'
+        )).first()
+        if not has_legacy:
+            return
+        adopted = conn.execute(text(f"""
+            WITH keyed AS (
+                SELECT id, {key_expr} AS k
+                FROM public."{table_name}"
+                WHERE source_key IS NULL
+            ),
+            ranked AS (
+                SELECT id, k, ROW_NUMBER() OVER (PARTITION BY k ORDER BY id DESC) AS rn
+                FROM keyed
+                WHERE k IS NOT NULL
+            )
+            UPDATE public."{table_name}" t
+            SET source_key = ranked.k,
+                row_hash = COALESCE(t.row_hash, md5(t.content_text))
+            FROM ranked
+            WHERE t.id = ranked.id
+              AND ranked.rn = 1
+              AND NOT EXISTS (
+                  SELECT 1 FROM public."{table_name}" o WHERE o.source_key = ranked.k
+              )
+        """)).rowcount
+        unkeyed = conn.execute(text(
+            f'SELECT COUNT(*) FROM public."{table_name}" WHERE source_key IS NULL'
+        )).scalar()
+    logger.info("Adopted %d legacy rows in %s", adopted, table_name)
+    if unkeyed:
+        logger.warning(
+            "%d rows in %s share a source key with another row and were left unkeyed (not deleted)",
+            unkeyed, table_name,
+        )
+
+def fetch_target_hashes(table_name: str) -> Dict[str, str]:
+    """{source_key: row_hash} của bảng vector"""
+    sql = f'SELECT source_key, row_hash FROM public."{table_name}" WHERE source_key IS NOT NULL'
+    with target_engine.connect() as conn:
+        rows = conn.execute(text(sql)).fetchall()
+    return {r[0]: r[1] for r in rows}
+
+def upsert_vector_rows(
+    table_name: str,
+    rows: List[Dict[str, Any]],
+):
+    """Insert hoặc update theo source_key (unique index tạo trong ensure_target_table)."""
+    if not rows:
+        return
+
+    serialized_rows = []
+    for r in rows:
+        r = r.copy()
+        if isinstance(r.get("original_data"), dict):
+            serialized_data = _serialize_dict(r["original_data"])
+            r["original_data"] = json.dumps(serialized_data, ensure_ascii=False)
+        serialized_rows.append(r)
+
+    upsert_sql = f"""
+    INSERT INTO public."{table_name}"
+        (source_key, row_hash, original_data, content_text, embedding, created_at, updated_at)
+    VALUES
+        (:source_key, :row_hash, CAST(:original_data AS jsonb), :content_text, :embedding, NOW(), NOW())
+    ON CONFLICT (source_key) DO UPDATE SET
+        row_hash      = EXCLUDED.row_hash,
+        original_data = EXCLUDED.original_data,
+        content_text  = EXCLUDED.content_text,
+        embedding     = EXCLUDED.embedding,
+        updated_at    = NOW()
+    """
+    with target_engine.begin() as conn:
+        conn.execute(text(upsert_sql), serialized_rows)
+    logger.info("Upserted %d vector rows into %s", len(serialized_rows), table_name)
+
+def delete_vector_rows_by_keys(table_name: str, source_keys: List[str], chunk_size: int = 1000) -> int:
+    if not source_keys:
+        return 0
+    deleted = 0
+    sql = text(f'DELETE FROM public."{table_name}" WHERE source_key = ANY(:keys)')
+    with target_engine.begin() as conn:
+        for i in range(0, len(source_keys), chunk_size):
+            deleted += conn.execute(sql, {"keys": list(source_keys[i:i + chunk_size])}).rowcount or 0
+    logger.info("Deleted %d vector rows removed at source from %s", deleted, table_name)
+    return deleted
+
+def ensure_build_state_table():
+    with target_engine.begin() as conn:
+        conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS public.vector_build_state (
+            table_name TEXT PRIMARY KEY,
+            key_columns TEXT[],
+            watermark_column TEXT,
+            last_watermark TEXT,
+            rows_embedded INTEGER DEFAULT 0,
+            rows_unchanged INTEGER DEFAULT 0,
+            rows_deleted INTEGER DEFAULT 0,
+            last_run_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """))
+
+def get_build_state(table_name: str) -> Optional[Dict[str, Any]]:
+    with target_engine.connect() as conn:
+        row = conn.execute(
+            text("SELECT * FROM public.vector_build_state WHERE table_name = :t"),
+            {"t": table_name},
+        ).mappings().first()
+    return dict(row) if row else None
+
+def list_build_states() -> List[Dict[str, Any]]:
+    with target_engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT * FROM public.vector_build_state ORDER BY table_name")
+        ).mappings().all()
+    return [dict(r) for r in rows]
+
+def save_build_state(table_name: str, state: Dict[str, Any]):
+    sql = """
+    INSERT INTO public.vector_build_state
+        (table_name, key_columns, watermark_column, last_watermark,
+         rows_embedded, rows_unchanged, rows_deleted, last_run_at)
+    VALUES
+        (:table_name, :key_columns, :watermark_column, :last_watermark,
+         :rows_embedded, :rows_unchanged, :rows_deleted, NOW())
+    ON CONFLICT (table_name) DO UPDATE SET
+        key_columns      = EXCLUDED.key_columns,
+        watermark_column = EXCLUDED.watermark_column,
+        last_watermark   = EXCLUDED.last_watermark,
+        rows_embedded    = EXCLUDED.rows_embedded,
+        rows_unchanged   = EXCLUDED.rows_unchanged,
+        rows_deleted     = EXCLUDED.rows_deleted,
+        last_run_at      = NOW()
+    """
+    with target_engine.begin() as conn:
+        conn.execute(text(sql), {"table_name": table_name, **state})
+
 def insert_origin_rows(
     table_name: str,
     rows: List[Dict[str, Any]],
@@ -251,51 +576,62 @@ def update_origin_rows(
     table_name: str,
     rows: List[Dict[str, Any]],
 ):
+    """Update bảng gốc theo id_sap bằng 1 câu UPDATE ... FROM cho mỗi nhóm cột.
+
+    Các record có cùng tập cột được nạp vào 1 temp table (cùng kiểu cột với bảng gốc)
+    rồi join update; trùng id_sap thì record sau ghi đè record trước.
+    """
     if not rows:
         logger.info("No rows to update in origin table %s", table_name)
         return
 
-    total_updated = 0
-
-    with origin_engine.begin() as conn:
-        for r in rows:
-            if "id_sap" not in r:
-                raise ValueError("Missing 'id_sap' in origin row for update")
-
-            # Đảm bảo luôn có updated_at
-            if "updated_at" not in r or r["updated_at"] is None:
-                r["updated_at"] = datetime.now(timezone.utc)
-                
-            # tách id_sap và các cột cần update
-            id_sap_val = r["id_sap"]
-            columns_to_update = {k: v for k, v in r.items() if k != "id_sap"}
-
-            if not columns_to_update:
-                continue
-            
-            
+    now = datetime.now(timezone.utc)
+    groups: Dict[tuple, Dict[Any, Dict[str, Any]]] = {}
+    for r in rows:
+        if "id_sap" not in r:
+            raise ValueError("Missing 'id_sap' in origin row for update")
 
-            set_clauses = []
-            params: Dict[str, Any] = {"id_sap": id_sap_val}
+        r = dict(r)
+        # Đảm bảo luôn có updated_at
+        if "updated_at" not in r or r["updated_at"] is None:
+            r["updated_at"] = now
 
-            for col, val in columns_to_update.items():
-                # dùng tên cột đúng như key trong JSON
-                set_clauses.append(f'"{col}" = :{col}')
-                params[col] = val
+        columns_to_update = tuple(k for k in r if k != "id_sap")
+        if not columns_to_update:
+            continue
+        groups.setdefault(columns_to_update, {})[r["id_sap"]] = r
 
-            set_sql = ", ".join(set_clauses)
+    total_updated = 0
 
-            print('set_sql',set_sql)
-            
-            update_sql = text(
-                f'UPDATE public."{table_name}" '
+    with origin_engine.begin() as conn:
+        for n, (columns_to_update, by_key) in enumerate(groups.items()):
+            tmp = f"_origin_update_{n}"
+            all_cols = ("id_sap",) + columns_to_update
+            col_names = ", ".join(f'"{c}"' for c in all_cols)
+            # bind param theo vị trí để không phụ thuộc vào ký tự trong tên cột
+            placeholders = ", ".join(f":p{i}" for i in range(len(all_cols)))
+            params = [{f"p{i}": r.get(c) for i, c in enumerate(all_cols)} for r in by_key.values()]
+
+            conn.execute(text(
+                f'CREATE TEMP TABLE {tmp} ON COMMIT DROP AS '
+                f'SELECT {col_names} FROM public."{table_name}" WITH NO DATA'
+            ))
+            conn.execute(text(f"INSERT INTO {tmp} ({col_names}) VALUES ({placeholders})"), params)
+
+            set_sql = ", ".join(f'"{c}" = s."{c}"' for c in columns_to_update)
+            result = conn.execute(text(
+                f'UPDATE public."{table_name}" AS o '
                 f'SET {set_sql} '
-                f'WHERE "id_sap" = :id_sap'
-            )
-
-            result = conn.execute(update_sql, params)
+                f'FROM {tmp} AS s '
+                f'WHERE o."id_sap" = s."id_sap"'
+            ))
             total_updated += result.rowcount or 0
 
+    # Đổi material_name -> cache tra id_sap theo tên cũ không còn đúng
+    renamed = [r["id_sap"] for r in rows if "material_name" in r]
+    if renamed:
+        invalidate_id_sap_cache(table_name, renamed)
+
     logger.info(
         "Updated %d rows in origin table %s",
         total_updated,
@@ -306,55 +642,72 @@ def update_vector_rows(
     table_name: str,
     rows: List[Dict[str, Any]],
 ):
+    """Update bảng vector theo id_sap (original_data) bằng temp table + 1 câu UPDATE ... FROM.
+
+    Khớp theo id_sap chứ không theo source_key (source_key của build là primary key bảng gốc);
+    mọi dòng có cùng id_sap đều được cập nhật như trước. source_key của dòng giữ nguyên.
+    """
     if not rows:
         logger.info("No rows to update in %s", table_name)
         return
 
-    serialized_rows = []
+    now = datetime.now(timezone.utc)
+    by_key: Dict[str, Dict[str, Any]] = {}
 
     for r in rows:
-        r = r.copy()
-        print('id_sap',r.get("id_sap"))
-        print('content_text',r.get("content_text"))
-
         if "id_sap" not in r:
             raise ValueError("Missing 'id_sap' in row for update")
 
-        # Đảm bảo luôn có updated_at
-        if "updated_at" not in r or r["updated_at"] is None:
-            r["updated_at"] = datetime.now(timezone.utc)
-
+        original_data = r.get("original_data")
         # serialize json safely - convert datetime objects first
-        if isinstance(r.get("original_data"), dict):
-            serialized_data = _serialize_dict(r["original_data"])
-            r["original_data"] = json.dumps(
-                serialized_data, ensure_ascii=False
-            )
-
-        serialized_rows.append(r)
+        if isinstance(original_data, dict):
+            original_data = json.dumps(_serialize_dict(original_data), ensure_ascii=False)
+
+        by_key[str(r["id_sap"])] = {
+            "id_sap": str(r["id_sap"]),
+            "original_data": original_data,
+            "content_text": r.get("content_text"),
+            "embedding": r.get("embedding"),
+            # Đảm bảo luôn có updated_at
+            "updated_at": r.get("updated_at") or now,
+        }
 
     logger.info(
         "Updating %d vector rows in target table %s",
-        len(serialized_rows),
+        len(by_key),
         table_name,
     )
 
-    update_sql = f"""
-    UPDATE public."{table_name}"
-    SET
-        original_data = CAST(:original_data AS jsonb),
-        content_text  = :content_text,
-        embedding     = :embedding,
-        updated_at    = :updated_at
-    WHERE
-        COALESCE(
-            CAST(original_data AS jsonb) ->> 'id_sap',
-            CAST(original_data AS jsonb) ->> 'ID_SAP'
-        ) = CAST(:id_sap AS TEXT)
-    """
+    _ensure_vector_id_sap_index(table_name)
 
     with target_engine.begin() as conn:
-        result = conn.execute(text(update_sql), serialized_rows)
+        conn.execute(text("""
+            CREATE TEMP TABLE _vector_update (
+                id_sap TEXT,
+                original_data JSONB,
+                content_text TEXT,
+                embedding DOUBLE PRECISION[],
+                updated_at TIMESTAMPTZ
+            ) ON COMMIT DROP
+        """))
+        conn.execute(
+            text("""
+            INSERT INTO _vector_update (id_sap, original_data, content_text, embedding, updated_at)
+            VALUES (:id_sap, CAST(:original_data AS jsonb), :content_text, :embedding, :updated_at)
+            """),
+            list(by_key.values()),
+        )
+        result = conn.execute(text(f"""
+            UPDATE public."{table_name}" AS v
+            SET
+                original_data = s.original_data,
+                content_text  = s.content_text,
+                embedding     = s.embedding,
+                row_hash      = md5(s.content_text),
+                updated_at    = s.updated_at
+            FROM _vector_update AS s
+            WHERE COALESCE(v.original_data ->> 'id_sap', v.original_data ->> 'ID_SAP') = s.id_sap
+        """))
 
     logger.info(
         "Updated %d rows in %s successfully",
@@ -362,6 +715,92 @@ def update_vector_rows(
         table_name,
     )
 
+def _ensure_vector_id_sap_index(table_name: str):
+    """Index biểu thức id_sap (original_data) trên bảng vector (không unique: 1 id_sap có thể nhiều dòng)"""
+    if table_name in _ID_SAP_INDEXED_TABLES:
+        return
+    try:
+        with target_engine.begin() as conn:
+            conn.execute(text(
+                f'CREATE INDEX IF NOT EXISTS "{table_name}_id_sap_idx" '
+                f'ON public."{table_name}" '
+                "((COALESCE(original_data ->> 'id_sap', original_data ->> 'ID_SAP')))"
+            ))
+        _ID_SAP_INDEXED_TABLES.add(table_name)
+    except Exception:
+        logger.exception("Could not create id_sap index on %s", table_name)
+
+def _ensure_material_name_index(table_name: str):
+    """Tạo index trên material_name của bảng gốc (bật bằng SYNC_CREATE_NAME_INDEX)"""
+    if not settings.SYNC_CREATE_NAME_INDEX or table_name in _NAME_INDEXED_TABLES:
+        return
+    try:
+        with origin_engine.begin() as conn:
+            conn.execute(text(
+                f'CREATE INDEX IF NOT EXISTS "{table_name}_material_name_idx" '
+                f'ON public."{table_name}" ("material_name")'
+            ))
+        _NAME_INDEXED_TABLES.add(table_name)
+    except Exception:
+        logger.exception("Could not create material_name index on %s", table_name)
+
+def invalidate_id_sap_cache(table_name: str, id_saps=None):
+    """Xóa cache material_name -> id_sap của bảng (hoặc chỉ các id_sap đã đổi tên)"""
+    targets = None if id_saps is None else {str(v) for v in id_saps}
+    with _ID_SAP_CACHE_LOCK:
+        for cache_key, (id_sap, _) in list(_ID_SAP_CACHE.items()):
+            if cache_key[0] == table_name and (targets is None or str(id_sap) in targets):
+                del _ID_SAP_CACHE[cache_key]
+
+def get_id_sap_by_material_names(
+    table_name: str,
+    material_names: List[str],
+) -> Dict[str, Any]:
+    """Tra id_sap cho nhiều material_name bằng 1 query `= ANY(:names)`.
+
+    Trả về {material_name: id_sap} cho các tên tìm thấy; kết quả được cache trong process
+    (SYNC_KEY_CACHE_TTL giây), tên không tìm thấy không cache.
+    """
+    names = list(dict.fromkeys(str(n) for n in material_names))
+    if not names:
+        return {}
+
+    now = time.monotonic()
+    found: Dict[str, Any] = {}
+    missing: List[str] = []
+    with _ID_SAP_CACHE_LOCK:
+        for name in names:
+            hit = _ID_SAP_CACHE.get((table_name, name))
+            if hit and hit[1] > now:
+                found[name] = hit[0]
+            else:
+                missing.append(name)
+
+    if missing:
+        _ensure_material_name_index(table_name)
+        query = text(
+            f'SELECT DISTINCT ON ("material_name") "material_name", "id_sap" '
+            f'FROM public."{table_name}" '
+            f'WHERE "material_name" = ANY(:names)'
+        )
+        with origin_engine.connect() as conn:
+            rows = conn.execute(query, {"names": missing}).fetchall()
+
+        expires_at = now + settings.SYNC_KEY_CACHE_TTL
+        with _ID_SAP_CACHE_LOCK:
+            if len(_ID_SAP_CACHE) + len(rows) > settings.SYNC_KEY_CACHE_MAX:
+                _ID_SAP_CACHE.clear()
+            for name, id_sap in rows:
+                found[name] = id_sap
+                if settings.SYNC_KEY_CACHE_TTL > 0:
+                    _ID_SAP_CACHE[(table_name, name)] = (id_sap, expires_at)
+
+    logger.info(
+        "Resolved %d/%d material names in %s (%d from cache)",
+        len(found), len(names), table_name, len(names) - len(missing),
+    )
+    return found
+
 def get_id_sap_by_material_name(
     table_name: str,
     material_name: str,
@@ -370,16 +809,4 @@ def get_id_sap_by_material_name(
 
     Dùng cho API update theo key khi client chỉ gửi material_name.
     """
-
-    query = text(
-        f'SELECT "id_sap" FROM public."{table_name}" '
-        f'WHERE "material_name" = :material_name LIMIT 1'
-    )
-
-    with origin_engine.connect() as conn:
-        row = conn.execute(query, {"material_name": material_name}).first()
-
-    if not row:
-        return None
-
-    return row[0]
\ No newline at end of file
+    return get_id_sap_by_material_names(table_name, [material_name]).get(str(material_name))
@@ -1,7 +1,9 @@
+import hashlib
+import threading
 from datetime import datetime, timezone
 from typing import Dict, Any, Union
 from decimal import Decimal
-from typing import List
+from typing import Callable, List, Optional
 
 from .db import (
     get_origin_tables,
@@ -11,8 +13,22 @@ from .db import (
     update_vector_rows,
     update_origin_rows,
     insert_origin_rows,
+    get_origin_columns,
+    get_origin_primary_key,
+    origin_column_is_unique,
+    fetch_changed_rows_from_origin,
+    fetch_origin_key_rows,
+    adopt_legacy_rows,
+    fetch_target_hashes,
+    upsert_vector_rows,
+    delete_vector_rows_by_keys,
+    ensure_build_state_table,
+    get_build_state,
+    save_build_state,
 )
+from .config import settings
 from .embedding_service import embedding_service
+from .pipeline import VectorBuildPipeline
 from .logger import setup_logger
 
 logger = setup_logger(__name__)
@@ -35,46 +51,230 @@ def row_to_text(columns, row) -> str:
 def row_to_original_data(columns, row) -> Dict[str, Any]:
     return {col: _sanitize_value(row[i]) for i, col in enumerate(columns)}
 
-def process_table(table_name: str, limit: int | None = None, batch_size: int = 50):
-    logger.info("=== Start processing table: %s ===", table_name)
-    ensure_target_table(table_name)
-    columns, rows = fetch_rows_from_origin(table_name, limit=limit)
+def row_hash(content_text: str) -> str:
+    # md5 của content_text -> khớp với md5(content_text) phía Postgres khi nhận dòng cũ
+    return hashlib.md5(content_text.encode("utf-8")).hexdigest()
+
+def build_source_key(key_columns: List[str], original_data: Dict[str, Any], content_hash: str) -> str:
+    """Khóa ổn định của dòng gốc (primary key / id_sap); không có khóa thì dùng hash nội dung"""
+    if not key_columns:
+        return content_hash
+    values = [original_data.get(c) for c in key_columns]
+    if len(values) == 1:
+        return content_hash if values[0] is None else str(values[0])
+    return "|".join("" if v is None else str(v) for v in values)
+
+# {table_name: (key_columns, watermark_column)}, tính lại mỗi lần build bảng
+_BUILD_KEYS: Dict[str, tuple] = {}
+
+def resolve_build_keys(table_name: str):
+    """(key_columns, watermark_column) cho bảng gốc.
+
+    Khóa là primary key của bảng gốc. Không có primary key thì dùng cột đầu tiên trong
+    VECTOR_BUILD_KEY_COLUMNS (id_sap) nếu giá trị của nó duy nhất: bảng kiểu BOM có nhiều
+    dòng cùng id_sap, khóa theo id_sap sẽ gộp các dòng đó lại.
+    """
+    columns = get_origin_columns(table_name)
+    key_columns = get_origin_primary_key(table_name)
+    if not key_columns:
+        for col in settings.VECTOR_BUILD_KEY_COLUMNS:
+            if col not in columns:
+                continue
+            if origin_column_is_unique(table_name, col):
+                key_columns = [col]
+            else:
+                logger.warning("Column %s of %s is not unique, not used as source key", col, table_name)
+            break
+    watermark_column = next(
+        (c for c in settings.VECTOR_BUILD_WATERMARK_COLUMNS if c in columns), None
+    )
+    # Watermark chỉ dùng được khi có khóa để phát hiện dòng bị xóa
+    if not key_columns:
+        watermark_column = None
+    _BUILD_KEYS[table_name] = (key_columns, watermark_column)
+    return key_columns, watermark_column
+
+def _cached_build_keys(table_name: str) -> List[str]:
+    if table_name not in _BUILD_KEYS:
+        resolve_build_keys(table_name)
+    return _BUILD_KEYS[table_name][0]
+
+def _make_render_fn(columns, key_columns, watermark_column, existing, ctx):
+    """row -> {source_key, row_hash, original_data, content_text}, None nếu dòng không đổi.
+
+    Chạy trên 1 thread render duy nhất nên cập nhật ctx không cần lock.
+    """
+    wm_idx = columns.index(watermark_column) if watermark_column else None
+
+    def render(row) -> Optional[Dict[str, Any]]:
+        if wm_idx is not None:
+            wm = row[wm_idx]
+            if wm is not None and (ctx["max_watermark"] is None or wm > ctx["max_watermark"]):
+                ctx["max_watermark"] = wm
 
-    batch = []
-    for idx, row in enumerate(rows, start=1):
         content_text = row_to_text(columns, row)
         if not content_text.strip():
-            continue
+            return None
+
+        original_data = row_to_original_data(columns, row)
+        content_hash = row_hash(content_text)
+        source_key = build_source_key(key_columns, original_data, content_hash)
+        ctx["seen_keys"].add(source_key)
+        if existing.get(source_key) == content_hash:
+            ctx["stats"]["rows_unchanged"] += 1
+            return None
+
+        return {
+            "source_key": source_key,
+            "row_hash": content_hash,
+            "original_data": original_data,
+            "content_text": content_text,
+        }
 
-        try:
-            embedding = embedding_service.embed(content_text)
-        except Exception:
-            logger.exception("Embedding failed at row %d", idx)
-            continue
+    return render
 
-        batch.append(
-            {
-                "original_data": row_to_original_data(columns, row),
-                "content_text": content_text,
-                "embedding": embedding,
-                "updated_at": datetime.now(timezone.utc),
-            }
+def _embed_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    item["embedding"] = embedding_service.embed(item["content_text"])
+    return item
+
+def process_table(
+    table_name: str,
+    limit: int | None = None,
+    batch_size: int = 50,
+    full_refresh: bool = False,
+    embed_workers: int | None = None,
+    stop_event: threading.Event | None = None,
+    on_pipeline: Callable[[VectorBuildPipeline], None] | None = None,
+) -> Dict[str, Any]:
+    """Build vector cho 1 bảng theo kiểu incremental.
+
+    - chỉ đọc các dòng có watermark (updated_at...) >= lần chạy trước, nếu bảng có cột đó
+    - chỉ embed dòng mới / dòng có row_hash thay đổi
+    - upsert theo source_key, xóa vector của các dòng đã bị xóa ở bảng gốc
+    full_refresh=True: đọc và embed lại toàn bộ bảng (vẫn upsert, không tạo bản trùng).
+    stop_event: dừng giữa chừng (cancel job); khi đó không xóa dòng và không tiến watermark.
+    """
+    logger.info("=== Start processing table: %s (full_refresh=%s) ===", table_name, full_refresh)
+    ensure_target_table(table_name)
+    ensure_build_state_table()
+
+    key_columns, watermark_column = resolve_build_keys(table_name)
+    state = get_build_state(table_name) or {}
+    # Khóa đổi so với lần build trước (vd. bản cũ khóa theo id_sap): gán lại source_key
+    # cho các dòng hiện có thay vì embed lại cả bảng
+    rekey = "key_columns" in state and list(state.get("key_columns") or []) != key_columns
+    adopt_legacy_rows(table_name, key_columns, rekey=rekey)
+
+    since = None
+    if (
+        not full_refresh
+        and watermark_column
+        and state.get("watermark_column") == watermark_column
+        and list(state.get("key_columns") or []) == key_columns
+    ):
+        since = state.get("last_watermark")
+
+    existing = {} if full_refresh else fetch_target_hashes(table_name)
+
+    # Stream từ server-side cursor qua pipeline read -> render -> N embed worker -> write,
+    # các stage nối bằng queue có giới hạn nên Ollama, Postgres và CPU chạy song song.
+    if watermark_column:
+        columns, rows = fetch_changed_rows_from_origin(
+            table_name, watermark_column, since, limit=limit, stream=True
         )
+    else:
+        columns, rows = fetch_rows_from_origin(table_name, limit=limit, stream=True)
 
-        if len(batch) >= batch_size:
-            insert_vector_rows(table_name, batch)
-            batch.clear()
+    ctx = {
+        "stats": {"rows_read": 0, "rows_embedded": 0, "rows_unchanged": 0, "rows_failed": 0, "rows_deleted": 0},
+        "seen_keys": set(),
+        "max_watermark": None,
+    }
+    stats = ctx["stats"]
+    new_watermark = since
 
-    if batch:
-        insert_vector_rows(table_name, batch)
+    def write(batch: List[Dict[str, Any]]):
+        upsert_vector_rows(table_name, batch)
+        stats["rows_embedded"] += len(batch)
 
-    logger.info("=== Done table: %s ===", table_name)
-
-def run_all_tables():
-    logger.info("Starting full vector build")
+    try:
+        pipeline = VectorBuildPipeline(
+            render_fn=_make_render_fn(list(columns), key_columns, watermark_column, existing, ctx),
+            embed_fn=_embed_item,
+            write_fn=write,
+            embed_workers=embed_workers or settings.VECTOR_BUILD_EMBED_WORKERS,
+            batch_size=batch_size,
+            queue_size=settings.VECTOR_BUILD_QUEUE_SIZE,
+            stop_event=stop_event,
+        )
+        if on_pipeline:
+            on_pipeline(pipeline)
+    except Exception:
+        rows.close()
+        raise
+    # pipeline (thread đọc) sở hữu rows và close() nó khi đọc xong, bị cancel hoặc lỗi
+    pipeline_stats = pipeline.run(rows)
+    stats["rows_read"] = pipeline_stats["stages"]["read"]["out"]
+    stats["rows_failed"] = pipeline_stats["stages"]["embed"]["errors"]
+    stats["pipeline"] = pipeline_stats
+
+    if pipeline_stats["cancelled"]:
+        # Dòng đã ghi có row_hash nên lần chạy lại sẽ bỏ qua chúng
+        stats["cancelled"] = True
+        logger.info("=== Cancelled table: %s %s ===", table_name, stats)
+        return stats
+    seen_keys = ctx["seen_keys"]
+    max_watermark = ctx["max_watermark"]
+
+    # Xóa vector của các dòng không còn ở bảng gốc (chỉ khi không giới hạn số dòng đọc)
+    if not limit:
+        target = existing or fetch_target_hashes(table_name)
+        origin_keys = set()
+        # Dòng có khóa NULL được khóa bằng hash nội dung (source_key == row_hash)
+        has_null_keys = not key_columns
+        for key_row in (fetch_origin_key_rows(table_name, key_columns) if key_columns else []):
+            if all(v is None for v in key_row):
+                has_null_keys = True
+                continue
+            key_data = {c: _sanitize_value(v) for c, v in zip(key_columns, key_row)}
+            origin_keys.add(build_source_key(key_columns, key_data, ""))
+        full_scan = since is None
+        removed = [
+            k for k, h in target.items()
+            if k not in origin_keys
+            and k not in seen_keys
+            # chỉ xóa được vector khóa bằng hash khi đã đọc lại toàn bộ bảng
+            and not (has_null_keys and h == k and not full_scan)
+        ]
+        stats["rows_deleted"] = delete_vector_rows_by_keys(table_name, removed)
+
+    # Không tiến watermark nếu có dòng embed lỗi, để lần sau đọc lại
+    if max_watermark is not None and not stats["rows_failed"]:
+        new_watermark = str(_sanitize_value(max_watermark))
+
+    save_build_state(
+        table_name,
+        {
+            "key_columns": key_columns,
+            "watermark_column": watermark_column,
+            "last_watermark": new_watermark,
+            "rows_embedded": stats["rows_embedded"],
+            "rows_unchanged": stats["rows_unchanged"],
+            "rows_deleted": stats["rows_deleted"],
+        },
+    )
+
+    logger.info("=== Done table: %s %s ===", table_name, stats)
+    return stats
+
+def run_all_tables(full_refresh: bool = False):
+    logger.info("Starting vector build (full_refresh=%s)", full_refresh)
     for tbl in get_origin_tables():
-        process_table(tbl)
-    logger.info("Finished full vector build")
+        try:
+            process_table(tbl, full_refresh=full_refresh)
+        except Exception:
+            logger.exception("Vector build failed for table %s", tbl)
+    logger.info("Finished vector build")
 
 def record_to_text(data: Dict[str, Any]) -> str:
     parts = []
@@ -102,10 +302,9 @@ def insert_records(
     except Exception:
         logger.exception("Failed to insert into origin table %s", table_name)
 
-    # 1b) Tạo name_embedding và description_embedding cho bảng gốc (nếu cần)
-    # Áp dụng cho các bảng có trường material_name hoặc tương tự
-    origin_embed_rows: List[Dict[str, Any]] = []
-    
+    # Gom toàn bộ text cần embed của request (name, description, content_text),
+    # bỏ trùng và embed theo batch thay vì 3 lần gọi tuần tự cho mỗi record
+    origin_texts: List[tuple] = []
     for idx, record in enumerate(records_list, start=1):
         # Yêu cầu có id_sap để update embedding
         if "id_sap" not in record:
@@ -114,37 +313,35 @@ def insert_records(
 
         # Lấy tên vật liệu (name_text)
         name_text = str(record.get("material_name") or "")
-        
+
         # Tạo mô tả từ các field khác (loại bỏ id_sap và material_name)
         desc_source = {
-            k: v for k, v in record.items() 
+            k: v for k, v in record.items()
             if k not in ["id_sap", "material_name"] and v is not None
         }
         desc_text = record_to_text(desc_source) if desc_source else name_text
+        origin_texts.append((record, name_text, desc_text))
 
-        # Tạo embeddings
-        name_embedding = None
-        description_embedding = None
+    content_texts = [record_to_text(record) for record in records_list]
 
-        try:
-            if name_text.strip():
-                name_embedding = embedding_service.embed(name_text)
-        except Exception:
-            logger.exception("Failed to create name_embedding for record %d", idx)
+    all_texts = [t for _, name, desc in origin_texts for t in (name, desc)] + content_texts
+    vectors = embedding_service.embed_many(all_texts)
 
-        try:
-            if desc_text.strip():
-                description_embedding = embedding_service.embed(desc_text)
-        except Exception:
-            logger.exception("Failed to create description_embedding for record %d", idx)
+    # 1b) name_embedding và description_embedding cho bảng gốc (nếu cần)
+    # Áp dụng cho các bảng có trường material_name hoặc tương tự
+    origin_embed_rows: List[Dict[str, Any]] = []
+
+    for record, name_text, desc_text in origin_texts:
+        name_embedding = vectors.get(name_text) if name_text.strip() else None
+        description_embedding = vectors.get(desc_text) if desc_text.strip() else None
 
         # Chỉ update nếu có ít nhất 1 embedding
         if name_embedding is not None or description_embedding is not None:
             payload: Dict[str, Any] = {"id_sap": record["id_sap"]}
-            
+
             if name_embedding is not None:
                 payload["name_embedding"] = name_embedding
-            
+
             if description_embedding is not None:
                 payload["description_embedding"] = description_embedding
 
@@ -163,17 +360,14 @@ def insert_records(
 
     batch = []
 
-    for idx, record in enumerate(records_list, start=1):
-        content_text = record_to_text(record)
-
+    for idx, (record, content_text) in enumerate(zip(records_list, content_texts), start=1):
         if not content_text.strip():
             logger.warning("Empty content at record %d, skip", idx)
             continue
 
-        try:
-            embedding = embedding_service.embed(content_text)
-        except Exception:
-            logger.exception("Embedding failed at record %d", idx)
+        embedding = vectors.get(content_text)
+        if embedding is None:
+            logger.warning("Embedding failed at record %d, skip", idx)
             continue
 
         batch.append(
@@ -185,8 +379,25 @@ def insert_records(
             }
         )
 
-    if batch:
-        insert_vector_rows(table_name, batch)
+    # Record có đủ cột khóa của bảng (như build) -> upsert theo source_key, không tạo bản trùng
+    key_columns = _cached_build_keys(table_name)
+    keyed, unkeyed = [], []
+    for r in batch:
+        if key_columns and all(r["original_data"].get(c) is not None for c in key_columns):
+            content_hash = row_hash(r["content_text"])
+            keyed.append({
+                "source_key": build_source_key(key_columns, r["original_data"], content_hash),
+                "row_hash": content_hash,
+                "original_data": r["original_data"],
+                "content_text": r["content_text"],
+                "embedding": r["embedding"],
+            })
+        else:
+            unkeyed.append(r)
+    if keyed:
+        upsert_vector_rows(table_name, keyed)
+    if unkeyed:
+        insert_vector_rows(table_name, unkeyed)
 
     logger.info("Inserted %d records into %s", len(batch), table_name)
     
@@ -206,6 +417,9 @@ def update_records(
         logger.exception("Failed to update origin table %s", table_name)
 
     # 2) Update bảng vector (target DB)
+    vectors = embedding_service.embed_many(
+        [record_to_text(record) for record in records if "id_sap" in record]
+    )
     batch = []
 
     for idx, record in enumerate(records, start=1):
@@ -222,10 +436,9 @@ def update_records(
             logger.warning("Empty content at record %d, skip", idx)
             continue
 
-        try:
-            embedding = embedding_service.embed(content_text)
-        except Exception:
-            logger.exception("Embedding failed at record %d", idx)
+        embedding = vectors.get(content_text)
+        if embedding is None:
+            logger.warning("Embedding failed at record %d, skip", idx)
             continue
 
         batch.append(
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# app.logger ghi log vào LOG_DIR (mặc định /app/logs trong container)
+os.environ.setdefault("LOG_DIR", tempfile.mkdtemp(prefix="vector-api-logs-"))
+os.environ.setdefault("OLLAMA_HOST", "http://ollama.test:11434")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from app.build_jobs import BuildJobManager
+
+def wait_for(job, statuses, timeout=5.0):
+    deadline = time.time() + timeout
+    while job.status not in statuses:
+        assert time.time() < deadline, f"job stuck in {job.status}"
+        time.sleep(0.01)
+
+def test_resume_clears_partial_tables_and_resets_started_at():
+    calls = []
+    resets = []
+    fail_once = {"t2": True}
+
+    def process(table, stop_event=None, on_pipeline=None, **params):
+        calls.append(table)
+        if fail_once.pop(table, False):
+            raise RuntimeError("ollama down")
+        return {"cancelled": False}
+
+    def reset(table, since):
+        resets.append((table, since))
+
+    manager = BuildJobManager(process, max_concurrent_tables=1, reset_fn=reset)
+    job = manager.submit(["t1", "t2"])
+    wait_for(job, ("failed",))
+    first_started = job.started_at
+    first_finished = job.finished_at
+    assert job.table_states["t2"]["status"] == "failed"
+
+    time.sleep(0.01)
+    manager.resume(job.id)
+    assert job.started_at is None or job.started_at > first_started
+    wait_for(job, ("completed",))
+
+    # Chỉ xoá các dòng ghi từ lúc job chạy bảng lần đầu (không xoá vector có sẵn từ trước)
+    assert [t for t, _ in resets] == ["t2"]
+    assert first_started <= resets[0][1] <= first_finished
+    assert calls == ["t1", "t2", "t2"]
+    assert job.started_at > first_started
+
+def test_resume_does_not_reset_tables_that_never_started():
+    resets = []
+    release = threading.Event()
+
+    def process(table, stop_event=None, on_pipeline=None, **params):
+        release.wait(5)
+        return {"cancelled": stop_event.is_set()}
+
+    manager = BuildJobManager(process, max_concurrent_tables=1,
+                              reset_fn=lambda table, since: resets.append(table))
+    job = manager.submit(["t1", "t2"])
+    wait_for(job, ("running",))
+    manager.cancel(job.id)
+    release.set()
+    wait_for(job, ("cancelled",))
+
+    # t1 đang chạy khi cancel (ghi dở); t2 bị bỏ qua trước khi chạy
+    manager.resume(job.id)
+    wait_for(job, ("completed", "cancelled"))
+    assert resets == ["t1"]
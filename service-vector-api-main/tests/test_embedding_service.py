@@ -0,0 +1,49 @@
+import math
+
+import pytest
+
+from app import embedding_service as module
+from app.embedding_service import EmbeddingService
+
+class FakeResponse:
+    ok = True
+    status_code = 200
+
+    def __init__(self, data):
+        self._data = data
+        self.text = str(data)
+
+    def json(self):
+        return self._data
+
+@pytest.fixture
+def calls(monkeypatch):
+    recorded = []
+
+    def fake_post(url, json=None, timeout=None):
+        recorded.append((url, json))
+        # Giống /api/embed: mỗi input 1 vector đơn vị
+        return FakeResponse({"embeddings": [[0.6, 0.8] if len(t) % 2 else [1.0, 0.0] for t in json["input"]]})
+
+    monkeypatch.setattr(module.requests, "post", fake_post)
+    return recorded
+
+def norm(v):
+    return math.sqrt(sum(x * x for x in v))
+
+def test_short_and_batched_texts_use_the_same_endpoint(calls):
+    service = EmbeddingService()
+    service.embed("short text")
+    service.embed_many(["a", "bb", "ccc"])
+    assert {url.rsplit("/", 1)[-1] for url, _ in calls} == {"embed"}
+
+def test_pooled_vectors_are_unit_length(calls):
+    service = EmbeddingService()
+    service.chunk_tokens = 4
+    service.chunk_overlap_tokens = 0
+    text = "\n".join(["a b c", "dd ee", "fff ggg hhh", "i j"])
+    vector = service.embed(text)
+    assert len(calls) == 1 and len(calls[0][1]["input"]) > 1
+    assert norm(vector) == pytest.approx(1.0)
+    many = service.embed_many([text, "x"])
+    assert all(norm(v) == pytest.approx(1.0) for v in many.values())
@@ -0,0 +1,133 @@
+import threading
+
+import pytest
+
+from app.pipeline import VectorBuildPipeline
+
+class RowSource:
+    """Iterator có close() (giống OriginRowStream), ghi lại việc đóng"""
+
+    def __init__(self, n):
+        self._it = iter(range(n))
+        self.closed = False
+        self.close_thread = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        return next(self._it)
+
+    def close(self):
+        self.closed = True
+        self.close_thread = threading.current_thread().name
+
+def render(row):
+    return None if row % 10 == 9 else {"id": row}
+
+def embed(item):
+    return {**item, "embedding": [float(item["id"])]}
+
+def make_pipeline(written, **kwargs):
+    params = dict(render_fn=render, embed_fn=embed, write_fn=written.extend,
+                  embed_workers=3, batch_size=4, queue_size=5)
+    params.update(kwargs)
+    return VectorBuildPipeline(**params)
+
+def test_writes_every_rendered_row_and_closes_source():
+    written = []
+    source = RowSource(50)
+    stats = make_pipeline(written).run(source)
+
+    assert sorted(item["id"] for item in written) == [i for i in range(50) if i % 10 != 9]
+    assert stats["stages"]["read"]["out"] == 50
+    assert stats["stages"]["write"]["out"] == 45
+    assert stats["cancelled"] is False
+    assert source.closed and source.close_thread == "vb-read"
+
+def test_embed_errors_are_counted_and_skipped():
+    def flaky_embed(item):
+        if item["id"] == 3:
+            raise RuntimeError("ollama down")
+        return embed(item)
+
+    written = []
+    stats = make_pipeline(written, embed_fn=flaky_embed).run(RowSource(9))
+
+    assert sorted(item["id"] for item in written) == [0, 1, 2, 4, 5, 6, 7, 8]
+    assert stats["stages"]["embed"]["errors"] == 1
+
+def test_cancel_before_start_still_closes_unstarted_source():
+    stop = threading.Event()
+    stop.set()
+    source = RowSource(100)
+    written = []
+    stats = make_pipeline(written, stop_event=stop).run(source)
+
+    assert stats["cancelled"] is True
+    assert written == []
+    assert source.closed
+
+def test_cancel_closes_generator_source_without_error():
+    opened = {"closed": False}
+    stop = threading.Event()
+
+    def rows():
+        try:
+            for i in range(10_000):
+                if i == 20:
+                    stop.set()
+                yield i
+        finally:
+            opened["closed"] = True
+
+    written = []
+    stats = make_pipeline(written, stop_event=stop).run(rows())
+
+    assert stats["cancelled"] is True
+    assert opened["closed"]
+    assert stats["stages"]["read"]["out"] < 10_000
+
+def test_in_flight_embed_is_written_after_cancel():
+    stop = threading.Event()
+    started = threading.Event()
+
+    def slow_embed(item):
+        if item["id"] == 0:
+            started.set()
+            # Cancel xảy ra trong lúc item này đang embed
+            stop.set()
+        return embed(item)
+
+    written = []
+    source = RowSource(1000)
+    stats = make_pipeline(written, embed_fn=slow_embed, embed_workers=1, stop_event=stop).run(source)
+
+    assert started.is_set()
+    assert stats["cancelled"] is True
+    assert 0 in [item["id"] for item in written]
+    assert stats["stages"]["write"]["out"] == stats["stages"]["embed"]["out"]
+    assert source.closed
+
+def test_write_error_is_raised_and_stops_pipeline():
+    def failing_write(batch):
+        raise RuntimeError("disk full")
+
+    source = RowSource(1000)
+    pipeline = make_pipeline([], write_fn=failing_write)
+    with pytest.raises(RuntimeError, match="disk full"):
+        pipeline.run(source)
+    assert source.closed
+    assert pipeline.snapshot()["stages"]["read"]["out"] < 1000
+
+def test_read_error_is_raised():
+    def rows():
+        yield 0
+        yield 1
+        raise ValueError("cursor lost")
+
+    written = []
+    with pytest.raises(ValueError, match="cursor lost"):
+        make_pipeline(written).run(rows())
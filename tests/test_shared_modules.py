@@ -0,0 +1,39 @@
+"""
+Modules copied into several services (each service is deployed on its own).
+These tests fail when one copy is edited without the others.
+"""
+
+import ast
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+RATE_LIMITER_COPIES = [
+    "backend/app/rate_limiter.py",
+    "service-chatbot-main/chatapi/rate_limiter.py",
+    "service-convert-data-main/rate_limiter.py",
+]
+
+def _class_source(path: str, class_name: str) -> str:
+    source = (ROOT / path).read_text(encoding="utf-8")
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.ClassDef) and node.name == class_name:
+            return ast.get_source_segment(source, node)
+    raise AssertionError(f"{class_name} not found in {path}")
+
+def test_adaptive_rate_limiter_copies_are_identical():
+    reference = _class_source(RATE_LIMITER_COPIES[0], "AdaptiveRateLimiter")
+    for path in RATE_LIMITER_COPIES[1:]:
+        assert _class_source(path, "AdaptiveRateLimiter") == reference, path
+
+IDENTICAL_COPIES = [
+    ("service-chatbot-main/chatapi/classify_runner.py", "service-convert-data-main/classify_runner.py"),
+    ("service-chatbot-main/chatapi/classification_cache.py", "service-convert-data-main/classification_cache.py"),
+    ("vector/app/build_jobs.py", "service-vector-api-main/app/build_jobs.py"),
+    ("vector/app/pipeline.py", "service-vector-api-main/app/pipeline.py"),
+    ("vector/app/embedding_service.py", "service-vector-api-main/app/embedding_service.py"),
+]
+
+def test_copied_modules_are_identical():
+    for first, second in IDENTICAL_COPIES:
+        assert (ROOT / first).read_bytes() == (ROOT / second).read_bytes(), f"{first} != {second}"
@@ -1,7 +1,9 @@
-from fastapi import FastAPI, BackgroundTasks, Query
+from fastapi import FastAPI, HTTPException, Query
 from typing import Optional, List
 
-from .db import get_origin_tables
+from .build_jobs import BuildJobManager
+from .config import settings
+from .db import get_origin_tables, estimate_origin_row_count, clear_rows_written_since
 from .main import process_table
 from .logger import setup_logger
 
@@ -12,6 +14,15 @@ app = FastAPI(
     version="1.0.0"
 )
 
+build_jobs = BuildJobManager(
+    process_table,
+    estimate_fn=estimate_origin_row_count,
+    max_concurrent_tables=settings.VECTOR_BUILD_MAX_CONCURRENT_TABLES,
+    # process_table chỉ INSERT: trước khi resume chạy lại, xoá các dòng job đã ghi dở
+    # (created_at >= lúc job bắt đầu bảng); vector của các lần build trước được giữ
+    reset_fn=clear_rows_written_since,
+)
+
 
 @app.get("/health")
 def health():
@@ -29,24 +40,24 @@ def list_tables():
 @app.post("/process/table/{table_name}")
 def process_single_table(
     table_name: str,
-    background_tasks: BackgroundTasks,
     limit: Optional[int] = Query(None),
-    batch_size: int = Query(50)
+    batch_size: int = Query(50),
+    embed_workers: Optional[int] = Query(None),
 ):
     """
-    Xử lý embedding cho 1 table
+    Xử lý embedding cho 1 table (tạo build job)
     """
     logger.info("API request: process table %s", table_name)
-
-    background_tasks.add_task(
-        process_table,
-        table_name,
-        limit,
-        batch_size
-    )
+    try:
+        job = build_jobs.submit(
+            [table_name], limit=limit, batch_size=batch_size, embed_workers=embed_workers
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
     return {
         "status": "accepted",
+        "job_id": job.id,
         "table": table_name,
         "limit": limit,
         "batch_size": batch_size
@@ -55,19 +66,66 @@ def process_single_table(
 
 @app.post("/process/all")
 def process_all_tables(
-    background_tasks: BackgroundTasks,
-    limit: Optional[int] = Query(None)
+    limit: Optional[int] = Query(None),
+    embed_workers: Optional[int] = Query(None),
 ):
     """
-    Xử lý toàn bộ tables
+    Xử lý toàn bộ tables trong 1 job (tối đa VECTOR_BUILD_MAX_CONCURRENT_TABLES bảng cùng lúc)
     """
     tables = get_origin_tables()
-    for tbl in tables:
-        background_tasks.add_task(process_table, tbl, limit)
+    try:
+        job = build_jobs.submit(tables, limit=limit, embed_workers=embed_workers)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
     return {
         "status": "accepted",
+        "job_id": job.id,
         "tables": tables,
         "limit": limit
     }
-  
\ No newline at end of file
+
+
+@app.get("/process/jobs")
+def list_jobs():
+    """
+    Danh sách build job và tiến độ
+    """
+    return {"jobs": [job.progress() for job in build_jobs.list()]}
+
+
+@app.get("/process/jobs/{job_id}")
+def get_job(job_id: str):
+    """
+    Tiến độ 1 job: rows read/embedded/written/failed, rows/sec, ETA
+    """
+    job = build_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.progress()
+
+
+@app.post("/process/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    try:
+        job = build_jobs.cancel(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Job not found")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.post("/process/jobs/{job_id}/resume")
+def resume_job(job_id: str):
+    """
+    Chạy lại các bảng chưa completed từ đầu. Các dòng job này đã ghi dở được xoá trước
+    (created_at >= lúc job bắt đầu bảng); vector có sẵn từ trước job không bị xoá
+    """
+    try:
+        job = build_jobs.resume(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Job not found")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"job_id": job.id, "status": job.status}
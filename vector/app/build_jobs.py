@@ -0,0 +1,250 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from .logger import setup_logger
+
+logger = setup_logger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running", "cancelling")
+TERMINAL_TABLE_STATUSES = ("completed", "failed", "cancelled")
+
+
+def _iso(ts: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else None
+
+
+class BuildJob:
+    def __init__(self, tables: List[str], params: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.tables = tables
+        self.params = params
+        self.status = "queued"
+        self.table_states: Dict[str, Dict[str, Any]] = {
+            t: {"status": "pending", "error": None} for t in tables
+        }
+        self.estimated_rows: Optional[int] = None
+        self.stop_event = threading.Event()
+        self.pipelines: Dict[str, Any] = {}
+        # bảng đã bắt đầu chạy (có thể đã ghi dở) -> thời điểm chạy lần đầu (epoch),
+        # và bảng cần reset_fn trước khi chạy lại (resume)
+        self.started_tables: Dict[str, float] = {}
+        self.reset_tables: set = set()
+        # số dòng đã đọc trước lần resume gần nhất, không tính vào tốc độ / ETA
+        self.rows_before_resume = 0
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def progress(self) -> Dict[str, Any]:
+        totals = {"rows_read": 0, "rows_embedded": 0, "rows_written": 0, "rows_failed": 0}
+        tables = {}
+        for table, state in self.table_states.items():
+            entry = dict(state)
+            pipeline = self.pipelines.get(table)
+            if pipeline is not None:
+                snap = pipeline.snapshot()
+                stages = snap["stages"]
+                entry["rows_read"] = stages["read"]["out"]
+                entry["rows_embedded"] = stages["embed"]["out"]
+                entry["rows_written"] = stages["write"]["out"]
+                entry["rows_failed"] = stages["embed"]["errors"]
+                entry["stages"] = stages
+                for k in totals:
+                    totals[k] += entry[k]
+            tables[table] = entry
+
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        rows_per_sec = max(0, totals["rows_read"] - self.rows_before_resume) / elapsed if elapsed > 0 else 0.0
+        eta_seconds = None
+        if self.status in ACTIVE_STATUSES and self.estimated_rows and rows_per_sec > 0:
+            eta_seconds = round(max(0, self.estimated_rows - totals["rows_read"]) / rows_per_sec, 1)
+
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "params": self.params,
+            "tables_total": len(self.tables),
+            "tables_done": sum(1 for s in self.table_states.values() if s["status"] in TERMINAL_TABLE_STATUSES),
+            **totals,
+            # ước lượng từ pg_class.reltuples, build incremental thường đọc ít hơn
+            "estimated_rows": self.estimated_rows,
+            "elapsed_seconds": round(elapsed, 1),
+            "rows_per_sec": round(rows_per_sec, 2),
+            "eta_seconds": eta_seconds,
+            "created_at": _iso(self.created_at),
+            "started_at": _iso(self.started_at),
+            "finished_at": _iso(self.finished_at),
+            "tables": tables,
+        }
+
+
+class BuildJobManager:
+    """Quản lý job build vector trong process.
+
+    - mỗi job gồm 1 hoặc nhiều bảng; các bảng của mọi job dùng chung 1 pool
+      giới hạn `max_concurrent_tables` bảng chạy cùng lúc
+    - 1 bảng không được build bởi 2 job đang chạy cùng lúc
+    - cancel: dừng pipeline của các bảng đang chạy, bảng chưa chạy bị bỏ qua
+    - resume: chạy lại các bảng chưa completed của job cancelled / failed; nếu có reset_fn,
+      bảng đã ghi dở được reset_fn(table, since) dọn trước khi chạy lại (process_fn không upsert);
+      since là thời điểm job bắt đầu chạy bảng lần đầu, để chỉ xoá các dòng job này đã ghi
+    """
+
+    def __init__(
+        self,
+        process_fn: Callable[..., Any],
+        estimate_fn: Optional[Callable[[str], Optional[int]]] = None,
+        max_concurrent_tables: int = 2,
+        max_history: int = 100,
+        reset_fn: Optional[Callable[[str], Any]] = None,
+    ):
+        self.process_fn = process_fn
+        self.estimate_fn = estimate_fn
+        self.reset_fn = reset_fn
+        self.max_history = max_history
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_concurrent_tables), thread_name_prefix="vector-build"
+        )
+        self._jobs: Dict[str, BuildJob] = {}
+        self._lock = threading.Lock()
+
+    def _busy_tables(self) -> set:
+        return {
+            t
+            for job in self._jobs.values()
+            if job.status in ACTIVE_STATUSES
+            for t, s in job.table_states.items()
+            if s["status"] not in TERMINAL_TABLE_STATUSES
+        }
+
+    def _estimate(self, tables: List[str]) -> Optional[int]:
+        if not self.estimate_fn:
+            return None
+        total = 0
+        for t in tables:
+            try:
+                total += int(self.estimate_fn(t) or 0)
+            except Exception:
+                logger.warning("Could not estimate row count for %s", t)
+        return total or None
+
+    def submit(self, tables: List[str], **params) -> BuildJob:
+        with self._lock:
+            conflict = self._busy_tables() & set(tables)
+            if conflict:
+                raise ValueError(f"Tables already being built: {sorted(conflict)}")
+            job = BuildJob(tables, params)
+            self._jobs[job.id] = job
+            self._trim_history()
+        job.estimated_rows = self._estimate(tables)
+        self._start(job, tables)
+        logger.info("Build job %s queued for %d tables", job.id, len(tables))
+        return job
+
+    def _start(self, job: BuildJob, tables: List[str]):
+        for table in tables:
+            self._executor.submit(self._run_table, job, table)
+
+    def _run_table(self, job: BuildJob, table: str):
+        state = job.table_states[table]
+        if job.stop_event.is_set():
+            state["status"] = "cancelled"
+            self._refresh_status(job)
+            return
+
+        with self._lock:
+            state["status"] = "running"
+            job.started_tables.setdefault(table, time.time())
+            if job.status == "queued":
+                job.status = "running"
+                job.started_at = job.started_at or time.time()
+
+        def on_pipeline(pipeline):
+            job.pipelines[table] = pipeline
+
+        try:
+            if table in job.reset_tables:
+                if self.reset_fn:
+                    logger.info("Build job %s: clearing partial table %s before rerun", job.id, table)
+                    self.reset_fn(table, job.started_tables[table])
+                job.reset_tables.discard(table)
+            result = self.process_fn(
+                table, stop_event=job.stop_event, on_pipeline=on_pipeline, **job.params
+            )
+            cancelled = bool(isinstance(result, dict) and result.get("cancelled"))
+            state["status"] = "cancelled" if cancelled else "completed"
+        except Exception as e:
+            logger.exception("Build job %s failed on table %s", job.id, table)
+            state["status"] = "failed"
+            state["error"] = f"{type(e).__name__}: {e}"[:500]
+        finally:
+            self._refresh_status(job)
+
+    def _refresh_status(self, job: BuildJob):
+        with self._lock:
+            statuses = [s["status"] for s in job.table_states.values()]
+            if any(s not in TERMINAL_TABLE_STATUSES for s in statuses):
+                return
+            if "cancelled" in statuses:
+                job.status = "cancelled"
+            elif "failed" in statuses:
+                job.status = "failed"
+            else:
+                job.status = "completed"
+            job.finished_at = time.time()
+        logger.info("Build job %s finished with status %s", job.id, job.status)
+
+    def _trim_history(self):
+        finished = [j for j in self._jobs.values() if j.status not in ACTIVE_STATUSES]
+        for job in sorted(finished, key=lambda j: j.created_at)[: max(0, len(self._jobs) - self.max_history)]:
+            self._jobs.pop(job.id, None)
+
+    def get(self, job_id: str) -> Optional[BuildJob]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[BuildJob]:
+        return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+    def cancel(self, job_id: str) -> BuildJob:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        with self._lock:
+            if job.status not in ("queued", "running"):
+                raise ValueError(f"Job is {job.status}, cannot cancel")
+            job.status = "cancelling"
+            job.stop_event.set()
+        logger.info("Build job %s cancelling", job_id)
+        return job
+
+    def resume(self, job_id: str) -> BuildJob:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        with self._lock:
+            if job.status not in ("cancelled", "failed"):
+                raise ValueError(f"Job is {job.status}, only cancelled or failed jobs can be resumed")
+            tables = [t for t, s in job.table_states.items() if s["status"] != "completed"]
+            conflict = self._busy_tables() & set(tables)
+            if conflict:
+                raise ValueError(f"Tables already being built: {sorted(conflict)}")
+            job.stop_event = threading.Event()
+            job.status = "queued"
+            job.started_at = None
+            job.finished_at = None
+            for t in tables:
+                if t in job.started_tables:
+                    job.reset_tables.add(t)
+                job.table_states[t] = {"status": "pending", "error": None}
+                job.pipelines.pop(t, None)
+            job.rows_before_resume = sum(
+                p.snapshot()["stages"]["read"]["out"] for p in job.pipelines.values()
+            )
+        self._start(job, tables)
+        logger.info("Build job %s resumed for %d tables", job_id, len(tables))
+        return job
@@ -20,14 +20,27 @@ class Settings:
     # optional: restrict to a specific schema; empty means all user schemas
     ORIGIN_DB_SCHEMA = os.getenv("ORIGIN_DB_SCHEMA", "")
 
+    # Số dòng mỗi lần lấy từ server-side cursor khi đọc bảng gốc
+    ORIGIN_FETCH_YIELD_PER = int(os.getenv("ORIGIN_FETCH_YIELD_PER", "500"))
+
+    # pipeline build: số worker gọi Ollama song song, kích thước queue giữa các stage
+    VECTOR_BUILD_EMBED_WORKERS = int(os.getenv("VECTOR_BUILD_EMBED_WORKERS", "4"))
+    VECTOR_BUILD_QUEUE_SIZE = int(os.getenv("VECTOR_BUILD_QUEUE_SIZE", "200"))
+    # số bảng được build cùng lúc (chung cho mọi job)
+    VECTOR_BUILD_MAX_CONCURRENT_TABLES = int(os.getenv("VECTOR_BUILD_MAX_CONCURRENT_TABLES", "2"))
+
     # embedding model
     APP_EMBEDDING_MODEL = os.getenv("APP_EMBEDDING_MODEL", "qwen3-embedding:latest")
 
     # embedding chunking (to avoid model context overflow)
-    # Max characters per chunk sent to Ollama embeddings
+    # Max estimated tokens per chunk (words + punctuation), chunks split on line boundaries
+    EMBEDDING_CHUNK_TOKENS = int(os.getenv("EMBEDDING_CHUNK_TOKENS", "512"))
+    # Overlap in tokens between consecutive chunks
+    EMBEDDING_CHUNK_OVERLAP_TOKENS = int(os.getenv("EMBEDDING_CHUNK_OVERLAP_TOKENS", "48"))
+    # Hard cap of characters per chunk sent to Ollama embeddings
     EMBEDDING_CHUNK_SIZE = int(os.getenv("EMBEDDING_CHUNK_SIZE", "3000"))
-    # Overlap in characters between consecutive chunks
-    EMBEDDING_CHUNK_OVERLAP = int(os.getenv("EMBEDDING_CHUNK_OVERLAP", "200"))
+    # Số text tối đa mỗi request batch (/api/embed)
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
 
     # ollama
     OLLAMA_HOST = os.getenv("OLLAMA_HOST")
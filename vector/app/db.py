@@ -1,7 +1,7 @@
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
 from datetime import datetime
-from typing import List, Any, Dict
+from typing import List, Any, Dict, Optional
 import json
 
 from .config import settings
@@ -74,7 +74,92 @@ def ensure_target_table(table_name: str):
     logger.info("Table %s is ready in target DB", table_name)
 
 
-def fetch_rows_from_origin(table_name: str, limit: int | None = None):
+def clear_rows_written_since(table_name: str, since: float):
+    """Xoá các vector ghi từ thời điểm `since` (epoch) trở đi, giữ nguyên vector của các lần build trước.
+
+    insert_vector_rows không upsert nên chạy lại 1 bảng ghi dở phải dọn phần đã ghi trước.
+    created_at do process_table gán bằng datetime.utcnow(), nên so sánh cùng kiểu (UTC naive).
+    """
+    with target_engine.begin() as conn:
+        result = conn.execute(
+            text(f'DELETE FROM public."{table_name}" WHERE created_at >= :since'),
+            {"since": datetime.utcfromtimestamp(since)},
+        )
+    logger.info("Cleared %d rows written since %s from %s", result.rowcount, since, table_name)
+
+
+def estimate_origin_row_count(table_name: str) -> Optional[int]:
+    """Số dòng ước lượng (pg_class.reltuples), không quét bảng"""
+    sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:regclass AS regclass)"
+    with origin_engine.connect() as conn:
+        value = conn.execute(text(sql), {"regclass": f'public."{table_name}"'}).scalar()
+    return int(value) if value is not None and value >= 0 else None
+
+
+class OriginRowStream:
+    """Iterator dòng của 1 server-side cursor trên origin DB.
+
+    close() đóng cursor và trả connection kể cả khi chưa đọc dòng nào (generator chưa
+    chạy thì không có finally để dọn); gọi nhiều lần không sao. Tự close khi đọc hết.
+    """
+
+    def __init__(self, conn, result):
+        self._conn = conn
+        self._result = result
+        self._partitions = result.partitions()
+        self._buffer: List[Any] = []
+        self._pos = 0
+        self._closed = False
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self._pos >= len(self._buffer):
+            if self._closed:
+                raise StopIteration
+            try:
+                self._buffer = next(self._partitions)
+            except StopIteration:
+                self.close()
+                raise
+            self._pos = 0
+            self.count += len(self._buffer)
+        row = self._buffer[self._pos]
+        self._pos += 1
+        return row
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._buffer = []
+        try:
+            self._result.close()
+        finally:
+            self._conn.close()
+            logger.info("Streamed %d rows from origin", self.count)
+
+
+def stream_query_from_origin(sql: str, params: Dict[str, Any] | None = None, yield_per: int | None = None):
+    """Chạy query trên origin DB bằng server-side cursor (named cursor của psycopg2).
+
+    Trả về (columns, OriginRowStream); mỗi lần chỉ giữ tối đa `yield_per` dòng trong bộ nhớ.
+    Connection được đóng khi đọc hết hoặc khi gọi rows.close().
+    """
+    yield_per = yield_per or settings.ORIGIN_FETCH_YIELD_PER
+    conn = origin_engine.connect()
+    try:
+        result = conn.execution_options(yield_per=yield_per).execute(text(sql), params or {})
+        columns = list(result.keys())
+    except Exception:
+        conn.close()
+        raise
+    return columns, OriginRowStream(conn, result)
+
+
+def fetch_rows_from_origin(table_name: str, limit: int | None = None, stream: bool = False):
     sql = f'SELECT * FROM public."{table_name}"'
     if limit:
         sql += f" LIMIT {limit}"
@@ -82,6 +167,9 @@ def fetch_rows_from_origin(table_name: str, limit: int | None = None):
     else:
         logger.info("Fetching ALL rows from origin table %s", table_name)
 
+    if stream:
+        return stream_query_from_origin(sql)
+
     with origin_engine.connect() as conn:
         result = conn.execute(text(sql))
         rows = result.fetchall()
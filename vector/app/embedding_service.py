@@ -1,86 +1,192 @@
-import math
+import re
+import numpy as np
 import requests
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from app.config import settings
+from app.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Ước lượng token không cần tokenizer: mỗi từ / dấu câu ~ 1 token
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
 
 class EmbeddingService:
     def __init__(self):
-        # Thống nhất dùng OLLAMA_HOST từ settings
         self.base_url = settings.OLLAMA_HOST.rstrip("/")
         self.model = settings.APP_EMBEDDING_MODEL
+        # Giới hạn cứng số ký tự mỗi chunk (tránh tràn context của model)
         self.chunk_size = max(1, int(getattr(settings, "EMBEDDING_CHUNK_SIZE", 3000)))
-        self.chunk_overlap = max(0, int(getattr(settings, "EMBEDDING_CHUNK_OVERLAP", 200)))
+        self.chunk_tokens = max(1, int(getattr(settings, "EMBEDDING_CHUNK_TOKENS", 512)))
+        self.chunk_overlap_tokens = max(0, int(getattr(settings, "EMBEDDING_CHUNK_OVERLAP_TOKENS", 48)))
+        self.batch_size = max(1, int(getattr(settings, "EMBEDDING_BATCH_SIZE", 32)))
 
     def _embed_single(self, text: str) -> List[float]:
-        url = f"{self.base_url}/api/embeddings"
+        # Cùng endpoint với batch (/api/embed, vector đã chuẩn hoá L2) để mọi vector cùng thang đo;
+        # /api/embeddings cũ trả vector chưa chuẩn hoá
+        return self._embed_batch([text])[0]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # /api/embed nhận list input -> 1 request cho nhiều text
+        url = f"{self.base_url}/api/embed"
         payload = {
             "model": self.model,
-            "prompt": text,
+            "input": texts,
         }
         try:
-            resp = requests.post(url, json=payload, timeout=120)
+            resp = requests.post(url, json=payload, timeout=300)
         except Exception as e:
-            raise RuntimeError(f"Error calling Ollama embeddings: {e}") from e
+            raise RuntimeError(f"Error calling Ollama batch embeddings: {e}") from e
 
         if not resp.ok:
             raise RuntimeError(
-                f"Ollama embedding failed. Status: {resp.status_code}, Body: {resp.text}"
+                f"Ollama batch embedding failed. Status: {resp.status_code}, Body: {resp.text}"
             )
 
         data = resp.json()
-        emb = data.get("embedding")
-        if emb is None or not isinstance(emb, list):
-            raise RuntimeError(f"Unexpected Ollama response: {data}")
-        return emb
-
-    def _chunk_text(self, text: str) -> List[str]:
-        # Simple character-based chunking with overlap
-        n = len(text)
-        if n <= self.chunk_size:
-            return [text]
-        chunks: List[str] = []
-        start = 0
-        step = max(1, self.chunk_size - self.chunk_overlap)
-        while start < n:
-            end = min(n, start + self.chunk_size)
-            chunks.append(text[start:end])
-            if end == n:
-                break
-            start += step
+        embs = data.get("embeddings")
+        if not isinstance(embs, list) or len(embs) != len(texts):
+            raise RuntimeError(f"Unexpected Ollama batch response for {len(texts)} inputs")
+        return embs
+
+    def _embed_texts(self, texts: List[str]) -> Dict[str, Optional[List[float]]]:
+        """Embed list text đã bỏ trùng theo batch; batch lỗi thì gọi lại từng text"""
+        result: Dict[str, Optional[List[float]]] = {}
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            try:
+                result.update(zip(batch, self._embed_batch(batch)))
+                continue
+            except Exception as e:
+                logger.warning("Batch embedding failed (%s), falling back to single requests", e)
+            for t in batch:
+                try:
+                    result[t] = self._embed_single(t)
+                except Exception:
+                    logger.exception("Embedding failed for text (%d chars)", len(t))
+                    result[t] = None
+        return result
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        return len(_TOKEN_RE.findall(text))
+
+    def _split_long_line(self, line: str) -> List[str]:
+        # Dòng quá dài: cắt theo từ, mỗi phần tối đa chunk_tokens token / chunk_size ký tự
+        parts: List[str] = []
+        words = line.split(" ")
+        current: List[str] = []
+        tokens = 0
+        chars = 0
+        for w in words:
+            wt = self.count_tokens(w)
+            if current and (tokens + wt > self.chunk_tokens or chars + len(w) + 1 > self.chunk_size):
+                parts.append(" ".join(current))
+                current, tokens, chars = [], 0, 0
+            current.append(w)
+            tokens += wt
+            chars += len(w) + 1
+        if current:
+            parts.append(" ".join(current))
+        return parts
+
+    def _chunk_text(self, text: str) -> List[Tuple[str, int]]:
+        """Chia text theo token, ưu tiên giữ nguyên dòng ("col: value"); trả về [(chunk, số token)].
+
+        Các chunk liên tiếp chồng nhau tối đa chunk_overlap_tokens token (tính theo dòng).
+        """
+        total = self.count_tokens(text)
+        if total <= self.chunk_tokens and len(text) <= self.chunk_size:
+            return [(text, total)]
+
+        units: List[Tuple[str, int]] = []
+        for line in text.split("\n"):
+            lt = self.count_tokens(line)
+            if lt > self.chunk_tokens or len(line) > self.chunk_size:
+                units.extend((p, self.count_tokens(p)) for p in self._split_long_line(line))
+            else:
+                units.append((line, lt))
+
+        chunks: List[Tuple[str, int]] = []
+        current: List[Tuple[str, int]] = []
+        tokens = 0
+        chars = 0
+        for unit, ut in units:
+            if current and (tokens + ut > self.chunk_tokens or chars + len(unit) + 1 > self.chunk_size):
+                chunks.append(("\n".join(u for u, _ in current), tokens))
+                # overlap: giữ lại các dòng cuối trong giới hạn chunk_overlap_tokens
+                tail: List[Tuple[str, int]] = []
+                tail_tokens = 0
+                for u, t in reversed(current):
+                    if tail_tokens + t > self.chunk_overlap_tokens:
+                        break
+                    tail.insert(0, (u, t))
+                    tail_tokens += t
+                if tail_tokens + ut > self.chunk_tokens:
+                    tail, tail_tokens = [], 0
+                current = tail
+                tokens = tail_tokens
+                chars = sum(len(u) + 1 for u, _ in tail)
+            current.append((unit, ut))
+            tokens += ut
+            chars += len(unit) + 1
+        if current:
+            chunks.append(("\n".join(u for u, _ in current), tokens))
         return chunks
 
     def _mean_pool(self, vectors: List[List[float]], weights: List[float] | None = None) -> List[float]:
         if not vectors:
             raise RuntimeError("No vectors to pool")
         dim = len(vectors[0])
-        for v in vectors:
-            if len(v) != dim:
-                raise RuntimeError("Inconsistent embedding dimensions across chunks")
-        if weights is None:
-            weights = [1.0] * len(vectors)
-        wsum = sum(weights)
-        if wsum == 0:
-            weights = [1.0] * len(vectors)
-            wsum = float(len(vectors))
-        pooled = [0.0] * dim
-        for v, w in zip(vectors, weights):
-            for i in range(dim):
-                pooled[i] += v[i] * w
-        return [x / wsum for x in pooled]
+        if any(len(v) != dim for v in vectors):
+            raise RuntimeError("Inconsistent embedding dimensions across chunks")
+        matrix = np.asarray(vectors, dtype=np.float64)
+        w = np.ones(len(vectors)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if w.sum() == 0:
+            w = np.ones(len(vectors))
+        pooled = np.average(matrix, axis=0, weights=w)
+        # Trung bình của các vector đơn vị không còn độ dài 1: chuẩn hoá lại như vector 1 chunk
+        norm = np.linalg.norm(pooled)
+        return (pooled / norm if norm > 0 else pooled).tolist()
 
     def embed(self, text: str) -> List[float]:
+        chunks = self._chunk_text(text)
         # If short enough, embed directly
-        if len(text) <= self.chunk_size:
+        if len(chunks) == 1:
             return self._embed_single(text)
 
-        # Otherwise, chunk, embed each chunk, then pool (weighted by chunk length)
-        chunks = self._chunk_text(text)
-        vectors: List[List[float]] = []
-        weights: List[float] = []
-        for ch in chunks:
-            vec = self._embed_single(ch)
-            vectors.append(vec)
-            weights.append(float(len(ch)))
-        return self._mean_pool(vectors, weights)
-
-embedding_service = EmbeddingService()
\ No newline at end of file
+        # Otherwise embed all chunks in one batched request, then pool (weighted by token count)
+        chunk_texts = [c for c, _ in chunks]
+        try:
+            vectors = self._embed_batch(chunk_texts)
+        except Exception as e:
+            logger.warning("Batch chunk embedding failed (%s), embedding chunks one by one", e)
+            vectors = [self._embed_single(c) for c in chunk_texts]
+        return self._mean_pool(vectors, [float(max(1, t)) for _, t in chunks])
+
+    def embed_many(self, texts: List[str]) -> Dict[str, Optional[List[float]]]:
+        """Embed nhiều text: bỏ trùng, chia chunk text dài, gửi mọi chunk theo batch (/api/embed).
+
+        Trả về {text: vector}; text có chunk embed lỗi có giá trị None.
+        """
+        unique = [t for t in dict.fromkeys(texts) if t and t.strip()]
+        chunked = {t: self._chunk_text(t) for t in unique}
+        chunk_texts = list(dict.fromkeys(c for chunks in chunked.values() for c, _ in chunks))
+        chunk_vectors = self._embed_texts(chunk_texts)
+
+        result: Dict[str, Optional[List[float]]] = {}
+        for t, chunks in chunked.items():
+            vectors = [chunk_vectors.get(c) for c, _ in chunks]
+            if any(v is None for v in vectors):
+                result[t] = None
+            elif len(vectors) == 1:
+                result[t] = vectors[0]
+            else:
+                result[t] = self._mean_pool(vectors, [float(max(1, n)) for _, n in chunks])
+
+        logger.info(
+            "Embedded %d unique texts as %d chunks (%d requested)",
+            len(unique), len(chunk_texts), len(texts),
+        )
+        return result
+
+embedding_service = EmbeddingService()
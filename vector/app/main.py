@@ -1,5 +1,6 @@
+import threading
 from datetime import datetime
-from typing import Dict, Any
+from typing import Callable, Dict, Any, List, Optional
 from decimal import Decimal
 
 from .db import (
@@ -8,7 +9,9 @@ from .db import (
     fetch_rows_from_origin,
     insert_vector_rows,
 )
+from .config import settings
 from .embedding_service import embedding_service
+from .pipeline import VectorBuildPipeline
 from .logger import setup_logger
 
 logger = setup_logger(__name__)
@@ -35,57 +38,64 @@ def row_to_original_data(columns, row) -> Dict[str, Any]:
     return {col: _sanitize_value(row[i]) for i, col in enumerate(columns)}
 
 
-def process_table(table_name: str, limit: int | None = None, batch_size: int = 50):
-    logger.info("=== Start processing table: %s ===", table_name)
-    ensure_target_table(table_name)
-    columns, rows = fetch_rows_from_origin(table_name, limit=limit)
-    logger.info("Total rows to process in %s: %d", table_name, len(rows))
-
-    batch = []
-    for idx, row in enumerate(rows, start=1):
+def _make_render_fn(table_name: str, columns):
+    def render(row) -> Optional[Dict[str, Any]]:
         content_text = row_to_text(columns, row)
         if not content_text.strip():
-            logger.warning("Row %d in table %s has empty content_text, skipping", idx, table_name)
-            continue
-
-        try:
-            embedding = embedding_service.embed(content_text)
-        except Exception as e:
-            logger.exception(
-                "Failed to generate embedding for row %d in table %s", idx, table_name
-            )
-            continue
-
-        original_data = row_to_original_data(columns, row)
-
-        batch.append(
-            {
-                "original_data": original_data,
-                "content_text": content_text,
-                "embedding": embedding,
-                "created_at": datetime.utcnow(),
-            }
-        )
+            logger.warning("Row in table %s has empty content_text, skipping", table_name)
+            return None
+        return {
+            "original_data": row_to_original_data(columns, row),
+            "content_text": content_text,
+        }
+
+    return render
+
+
+def _embed_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    item["embedding"] = embedding_service.embed(item["content_text"])
+    item["created_at"] = datetime.utcnow()
+    return item
+
+
+def process_table(
+    table_name: str,
+    limit: int | None = None,
+    batch_size: int = 50,
+    embed_workers: int | None = None,
+    stop_event: threading.Event | None = None,
+    on_pipeline: Callable[[VectorBuildPipeline], None] | None = None,
+):
+    logger.info("=== Start processing table: %s ===", table_name)
+    ensure_target_table(table_name)
+    # Stream từ server-side cursor qua pipeline read -> render -> N embed worker -> write,
+    # các stage nối bằng queue có giới hạn nên Ollama, Postgres và CPU chạy song song.
+    columns, rows = fetch_rows_from_origin(table_name, limit=limit, stream=True)
 
-        if len(batch) >= batch_size:
-            insert_vector_rows(table_name, batch)
-            logger.info(
-                "[%s] Inserted batch of %d rows (up to row %d)",
-                table_name,
-                len(batch),
-                idx,
-            )
-            batch.clear()
-
-    if batch:
+    def write(batch: List[Dict[str, Any]]):
         insert_vector_rows(table_name, batch)
-        logger.info(
-            "[%s] Inserted final batch of %d rows",
-            table_name,
-            len(batch),
+        logger.info("[%s] Inserted batch of %d rows", table_name, len(batch))
+
+    try:
+        pipeline = VectorBuildPipeline(
+            render_fn=_make_render_fn(table_name, list(columns)),
+            embed_fn=_embed_item,
+            write_fn=write,
+            embed_workers=embed_workers or settings.VECTOR_BUILD_EMBED_WORKERS,
+            batch_size=batch_size,
+            queue_size=settings.VECTOR_BUILD_QUEUE_SIZE,
+            stop_event=stop_event,
         )
+        if on_pipeline:
+            on_pipeline(pipeline)
+    except Exception:
+        rows.close()
+        raise
+    # pipeline (thread đọc) sở hữu rows và close() nó khi đọc xong, bị cancel hoặc lỗi
+    stats = pipeline.run(rows)
 
     logger.info("=== Done processing table: %s ===", table_name)
+    return stats
 
 
 def main():
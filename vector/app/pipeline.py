@@ -0,0 +1,234 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from .logger import setup_logger
+
+logger = setup_logger(__name__)
+
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, items_in: int, items_out: int, busy: float, errors: int = 0):
+        with self._lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.errors += errors
+            self.busy_seconds += busy
+
+    def snapshot(self, elapsed: float) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "in": self.items_in,
+                "out": self.items_out,
+                "errors": self.errors,
+                "busy_seconds": round(self.busy_seconds, 2),
+                "rate_per_sec": round(self.items_out / elapsed, 2) if elapsed > 0 else 0.0,
+            }
+
+
+class VectorBuildPipeline:
+    """Pipeline đọc -> render text -> N worker embed -> ghi theo batch, nối bằng queue có giới hạn.
+
+    - read: 1 thread duyệt iterator dòng gốc (server-side cursor) và close() nó khi xong / bị dừng
+    - render: render_fn(row) -> item hoặc None (bỏ qua)
+    - embed: `embed_workers` thread gọi embed_fn(item) -> item (lỗi thì đếm và bỏ qua)
+    - write: write_fn(batch) trên thread gọi run(), batch tối đa `batch_size`
+    Queue có giới hạn nên stage nhanh sẽ chờ stage chậm, bộ nhớ không tăng theo kích thước bảng.
+    Lỗi ở read/render/write dừng toàn bộ pipeline và được raise lại từ run().
+    stop_event (cancel từ bên ngoài) dừng đọc và bỏ các dòng chưa embed; item đang embed dở
+    vẫn được embed xong và ghi trước khi run() trả về.
+    """
+
+    def __init__(
+        self,
+        render_fn: Callable[[Any], Optional[Dict[str, Any]]],
+        embed_fn: Callable[[Dict[str, Any]], Dict[str, Any]],
+        write_fn: Callable[[List[Dict[str, Any]]], None],
+        embed_workers: int = 4,
+        batch_size: int = 50,
+        queue_size: int = 200,
+        stop_event: Optional[threading.Event] = None,
+    ):
+        self.render_fn = render_fn
+        self.embed_fn = embed_fn
+        self.write_fn = write_fn
+        self.embed_workers = max(1, embed_workers)
+        self.batch_size = max(1, batch_size)
+        self.queue_size = max(1, queue_size)
+        self.stop_event = stop_event or threading.Event()
+
+        self.stages = {name: StageStats(name) for name in ("read", "render", "embed", "write")}
+        self._abort = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    # ---- queue helpers: không block mãi khi pipeline bị dừng ----
+    def _stopped(self) -> bool:
+        return self._abort.is_set() or self.stop_event.is_set()
+
+    def _put(self, q: queue.Queue, item, abort_only: bool = False) -> bool:
+        """abort_only: chỉ bỏ cuộc khi pipeline lỗi (write stage vẫn nhận item sau khi cancel)"""
+        while True:
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                if self._abort.is_set() or (not abort_only and self._stopped()):
+                    return False
+
+    def _get(self, q: queue.Queue):
+        while True:
+            if self._stopped():
+                return _DONE
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def _fail(self, stage: str, e: BaseException):
+        logger.exception("Pipeline stage %s failed", stage)
+        if self._error is None:
+            self._error = e
+        self._abort.set()
+
+    # ---- stages ----
+    def _read(self, rows: Iterable, out_q: queue.Queue):
+        # Thread này sở hữu iterator: chỉ nó gọi next() và close(), tránh close() từ thread khác
+        # trong lúc next() đang chạy ("generator already executing")
+        try:
+            it = iter(rows)
+            while not self._stopped():
+                start = time.monotonic()
+                try:
+                    row = next(it)
+                except StopIteration:
+                    break
+                self.stages["read"].record(0, 1, time.monotonic() - start)
+                if not self._put(out_q, row):
+                    break
+        except Exception as e:
+            self._fail("read", e)
+        finally:
+            close = getattr(rows, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    logger.warning("Closing row source failed: %s", e)
+            self._put(out_q, _DONE)
+
+    def _render(self, in_q: queue.Queue, out_q: queue.Queue):
+        try:
+            while True:
+                row = self._get(in_q)
+                if row is _DONE:
+                    break
+                start = time.monotonic()
+                item = self.render_fn(row)
+                self.stages["render"].record(1, 0 if item is None else 1, time.monotonic() - start)
+                if item is not None and not self._put(out_q, item):
+                    break
+        except Exception as e:
+            self._fail("render", e)
+        finally:
+            for _ in range(self.embed_workers):
+                self._put(out_q, _DONE)
+
+    def _embed(self, in_q: queue.Queue, out_q: queue.Queue):
+        try:
+            while True:
+                item = self._get(in_q)
+                if item is _DONE:
+                    break
+                start = time.monotonic()
+                try:
+                    result = self.embed_fn(item)
+                except Exception as e:
+                    self.stages["embed"].record(1, 0, time.monotonic() - start, errors=1)
+                    logger.warning("Embedding failed: %s", e)
+                    continue
+                self.stages["embed"].record(1, 1, time.monotonic() - start)
+                if not self._put(out_q, result, abort_only=True):
+                    break
+        finally:
+            self._put(out_q, _DONE, abort_only=True)
+
+    def _flush(self, batch: List[Dict[str, Any]]):
+        start = time.monotonic()
+        self.write_fn(batch)
+        self.stages["write"].record(len(batch), len(batch), time.monotonic() - start)
+
+    def run(self, rows: Iterable) -> Dict[str, Any]:
+        self._started_at = time.monotonic()
+        raw_q: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        text_q: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        emb_q: queue.Queue = queue.Queue(maxsize=self.queue_size)
+
+        threads = [
+            threading.Thread(target=self._read, args=(rows, raw_q), name="vb-read", daemon=True),
+            threading.Thread(target=self._render, args=(raw_q, text_q), name="vb-render", daemon=True),
+        ]
+        threads += [
+            threading.Thread(target=self._embed, args=(text_q, emb_q), name=f"vb-embed-{i}", daemon=True)
+            for i in range(self.embed_workers)
+        ]
+        for t in threads:
+            t.start()
+
+        # write stage chạy trên thread hiện tại; sau cancel vẫn nhận đến khi mọi embed worker xong
+        batch: List[Dict[str, Any]] = []
+        finished_workers = 0
+        try:
+            while finished_workers < self.embed_workers:
+                try:
+                    item = emb_q.get(timeout=0.5)
+                except queue.Empty:
+                    if self._abort.is_set():
+                        break
+                    continue
+                if item is _DONE:
+                    finished_workers += 1
+                    continue
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    self._flush(batch)
+                    batch = []
+            if batch and not self._abort.is_set():
+                self._flush(batch)
+        except Exception as e:
+            self._fail("write", e)
+
+        for t in threads:
+            t.join()
+        self._finished_at = time.monotonic()
+
+        stats = self.snapshot()
+        logger.info("Pipeline finished: %s", stats)
+        if self._error is not None:
+            raise self._error
+        return stats
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Thống kê từng stage (an toàn khi gọi từ thread khác trong lúc chạy)"""
+        if self._started_at is None:
+            elapsed = 0.0
+        else:
+            elapsed = (self._finished_at or time.monotonic()) - self._started_at
+        return {
+            "elapsed_seconds": round(elapsed, 2),
+            "embed_workers": self.embed_workers,
+            "cancelled": self.stop_event.is_set(),
+            "stages": {name: stage.snapshot(elapsed) for name, stage in self.stages.items()},
+        }